@@ -0,0 +1,206 @@
+"""
+Times parsing and building of every packet type in pparser.parse_map, over
+the payloads in a corpus of packets, with the pure Python codec and with
+c_parser, if it has been built.
+
+    python bench_parser.py [-n NUMBER] [--corpus FILE] [--type NAME ...]
+                           [--save-baseline FILE | --baseline FILE]
+
+For each packet type, reports operations per second and the memory a single
+operation allocates at its peak. With --baseline, results are compared with
+ones saved earlier with --save-baseline, and the run fails if any of them
+has slowed down by more than --tolerance. Baselines are only comparable on
+the machine they were saved on.
+"""
+import argparse
+import json
+import sys
+import timeit
+import tracemalloc
+
+import data_parser
+from pparser import parse_map
+from utilities import path
+
+default_corpus = path / "tests" / "corpus" / "packets.json"
+
+
+def load_corpus(corpus_path):
+    """
+    Load a corpus of packet payloads.
+
+    :param corpus_path: Path to a JSON file mapping struct names (as in
+                        parse_map) to lists of hex-encoded payloads.
+    :return: Dictionary of structs to lists of payloads, in parse_map order.
+    """
+    with open(str(corpus_path)) as f:
+        corpus = json.load(f)
+    structs = {cls.__name__: cls for cls in parse_map.values()
+               if cls is not None}
+    unknown = set(corpus).difference(structs)
+    if unknown:
+        raise ValueError("Corpus has payloads for unknown packet types: "
+                         "{}".format(", ".join(sorted(unknown))))
+    return {structs[name]: [bytes.fromhex(payload)
+                            for payload in corpus[name]]
+            for name in structs if name in corpus}
+
+
+def operations(corpus):
+    """
+    Work out what to time for each packet type: parsing every payload in the
+    corpus, and building each of them again from what it parsed to. Types
+    whose parsed form can't be built from are only parsed.
+
+    :param corpus: Dictionary, as returned by load_corpus().
+    :return: List of (name, function) tuples. Each function handles every
+             payload of its type once, and returns how many it handled.
+    """
+    rows = []
+    for cls, payloads in corpus.items():
+        def parse(cls=cls, payloads=payloads):
+            for payload in payloads:
+                cls.parse(payload)
+            return len(payloads)
+        rows.append(("{} parse".format(cls.__name__), parse))
+        try:
+            objs = [cls.parse(payload) for payload in payloads]
+            for obj in objs:
+                cls.build(obj)
+        except Exception:
+            continue
+
+        def build(cls=cls, objs=objs):
+            for obj in objs:
+                cls.build(obj)
+            return len(objs)
+        rows.append(("{} build".format(cls.__name__), build))
+    return rows
+
+
+def ops_per_second(fn, number):
+    """
+    Best of three runs.
+    """
+    count = fn()
+    best = min(timeit.repeat(fn, number=number, repeat=3))
+    return count * number / best
+
+
+def allocated(fn):
+    """
+    Peak memory allocated while running fn once, in bytes per operation.
+    """
+    count = fn()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return (peak - start) / count
+
+
+def measure(rows, number, compiled):
+    """
+    Time every operation with each codec.
+
+    :return: Dictionary of operation names to dictionaries of codec names
+             ("python", "c") to (ops/sec, bytes allocated) tuples.
+    """
+    codecs = [("python", False)] + ([("c", True)] if compiled else [])
+    results = {name: {} for name, _ in rows}
+    for codec, enabled in codecs:
+        data_parser.enable_c_parser(enabled)
+        for name, fn in rows:
+            results[name][codec] = (ops_per_second(fn, number), allocated(fn))
+    data_parser.enable_c_parser()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline.
+
+    :return: Tuple. Dictionary of (operation, codec) to relative change in
+             ops/sec, and list of the (operation, codec) pairs that slowed
+             down by more than the tolerance.
+    """
+    changes = {}
+    regressions = []
+    for name, codecs in results.items():
+        for codec, (ops, _) in codecs.items():
+            try:
+                before = baseline[name][codec][0]
+            except KeyError:
+                continue
+            change = ops / before - 1
+            changes[name, codec] = change
+            if change < -tolerance:
+                regressions.append((name, codec))
+    return changes, regressions
+
+
+def report(results, changes, compiled):
+    row = "{:<30}{:>18}{:>18}{:>11}{:>11}"
+    print(row.format("", "python op/s", "c op/s", "python B", "c B"))
+    for name, codecs in results.items():
+        cells = []
+        for codec in ("python", "c"):
+            if codec not in codecs:
+                cells.append("-")
+                continue
+            ops = "{:.0f}".format(codecs[codec][0])
+            if (name, codec) in changes:
+                ops += " ({:+.0%})".format(changes[name, codec])
+            cells.append(ops)
+        allocs = ["{:.0f}".format(codecs[codec][1]) if codec in codecs
+                  else "-" for codec in ("python", "c")]
+        print(row.format(name, *cells + allocs))
+    if not compiled:
+        print("\nc_parser has not been built; see CYTHON_PARSER.md.")
+
+
+def main(args):
+    corpus = load_corpus(args.corpus)
+    if args.type:
+        corpus = {cls: payloads for cls, payloads in corpus.items()
+                  if cls.__name__ in args.type}
+    compiled = data_parser.enable_c_parser()
+    results = measure(operations(corpus), args.number, compiled)
+    changes, regressions = {}, []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changes, regressions = compare(results, baseline, args.tolerance)
+    report(results, changes, compiled)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if regressions:
+        print("\nSlower than the baseline by more than {:.0%}:".format(
+            args.tolerance))
+        for name, codec in regressions:
+            print("    {} ({})".format(name, codec))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        "\n\n")[0])
+    parser.add_argument("-n", "--number", type=int, default=2000,
+                        help="passes over the corpus per timing run")
+    parser.add_argument("--corpus", default=default_corpus,
+                        help="corpus of packet payloads to use")
+    parser.add_argument("--type", action="append",
+                        help="only time this packet type (by struct name)")
+    parser.add_argument("--baseline",
+                        help="compare with results saved in this file")
+    parser.add_argument("--save-baseline",
+                        help="save the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown allowed against the baseline, as a "
+                             "fraction (default: 0.1)")
+    sys.exit(main(parser.parse_args()))
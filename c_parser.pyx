@@ -1,92 +1,1039 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled codec for the StarryPy packet parser.
+
+Mirrors the primitives and composites of data_parser. Parsers read straight
+out of a data_parser.Cursor's buffer, and builders write into a single
+bytearray. data_parser.enable_c_parser() swaps these in for the pure Python
+implementations, which tests/test/test_c_parser.py checks them against.
+"""
 import struct
+from binascii import unhexlify
+
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, \
+    PyBUF_SIMPLE
+from cpython.bytearray cimport PyByteArray_Resize, PyByteArray_AS_STRING, \
+    PyByteArray_GET_SIZE
+from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.float cimport PyFloat_AsDouble
+from cpython.number cimport PyNumber_Index
+from cpython.ref cimport PyObject
+from cpython.unicode cimport PyUnicode_DecodeUTF8, PyUnicode_AsUTF8AndSize
+from libc.math cimport isinf
+from libc.stdint cimport uint16_t, int16_t, uint32_t, int32_t, uint64_t, \
+    int64_t
 from libc.string cimport memcpy
 
-def parse_variant(object stream):
-    return c_parse_variant(stream)
+# Checked by data_parser before using this module, so that a build left over
+# from an older version of this file is not picked up.
+VERSION = 4
+
+# Nesting limit for Variants, standing in for Python's recursion limit.
+cdef enum:
+    MAX_DEPTH = 500
+
+cdef struct Buf:
+    const unsigned char* p
+    Py_ssize_t pos
+    Py_ssize_t end
+    PyObject* view  # The cursor's memoryview, for handing out slices.
+    int depth
+
+ctypedef object (*reader)(Buf*)
+ctypedef int (*writer)(bytearray, object) except -1
+
+
+cdef object _run(object stream, reader fn):
+    cdef Py_buffer view
+    cdef Buf b
+    buf = stream.buf
+    PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE)
+    try:
+        b.p = <const unsigned char*> view.buf
+        b.pos = stream.pos
+        b.end = stream.end
+        b.view = <PyObject*> buf
+        b.depth = 0
+        res = fn(&b)
+        stream.pos = b.pos
+        return res
+    finally:
+        PyBuffer_Release(&view)
+
+
+#
+## Reading
+#
+
+cdef inline const unsigned char* _need(Buf* b, Py_ssize_t n) except NULL:
+    cdef const unsigned char* p
+    if b.end - b.pos < n:
+        raise struct.error("unpack_from requires a buffer of at least {} "
+                           "bytes".format(b.pos + n))
+    p = b.p + b.pos
+    b.pos += n
+    return p
+
+
+cdef inline uint32_t _be32(const unsigned char* p):
+    return (<uint32_t> p[0] << 24) | (<uint32_t> p[1] << 16) | \
+           (<uint32_t> p[2] << 8) | p[3]
+
+
+cdef inline uint64_t _be64(const unsigned char* p):
+    return (<uint64_t> _be32(p) << 32) | _be32(p + 4)
+
+
+cdef inline unsigned char _byte(Buf* b):
+    # Like data_parser.Byte, reads as 0 once the payload runs out.
+    if b.pos >= b.end:
+        return 0
+    b.pos += 1
+    return b.p[b.pos - 1]
+
+
+cdef bint _vlq_fast(Buf* b, uint64_t* out):
+    """
+    Read a VLQ that fits in 63 bits. Leaves the cursor alone and returns
+    false for longer ones.
+    """
+    cdef uint64_t value = 0
+    cdef Py_ssize_t pos = b.pos
+    cdef unsigned char tmp
+    cdef int n
+    for n in range(9):
+        if pos >= b.end:
+            break
+        tmp = b.p[pos]
+        pos += 1
+        value = (value << 7) | (tmp & 0x7f)
+        if not tmp & 0x80:
+            break
+    else:
+        if pos < b.end:
+            return False
+    b.pos = pos
+    out[0] = value
+    return True
+
+
+cdef object _vlq_slow(Buf* b):
+    cdef unsigned char tmp
+    value = 0
+    while b.pos < b.end:
+        tmp = b.p[b.pos]
+        b.pos += 1
+        value = (value << 7) | (tmp & 0x7f)
+        if not tmp & 0x80:
+            break
+    return value
+
+
+cdef object _vlq(Buf* b):
+    cdef uint64_t value
+    if _vlq_fast(b, &value):
+        return value
+    return _vlq_slow(b)
+
+
+cdef object _svlq(Buf* b):
+    cdef uint64_t value
+    if _vlq_fast(b, &value):
+        if value & 1:
+            return -<int64_t> (value >> 1) - 1
+        return <int64_t> (value >> 1)
+    v = _vlq_slow(b)
+    if v & 1:
+        return -((v >> 1) + 1)
+    return v >> 1
+
+
+cdef Py_ssize_t _size(Buf* b) except -1:
+    """
+    Read a length prefix, cut down to what is left of the payload.
+    """
+    cdef uint64_t value
+    cdef Py_ssize_t left
+    if not _vlq_fast(b, &value):
+        _vlq_slow(b)
+        return b.end - b.pos
+    left = b.end - b.pos
+    if value > <uint64_t> left:
+        return left
+    return <Py_ssize_t> value
+
+
+cdef Py_ssize_t _count(Buf* b) except -1:
+    """
+    Read an element count.
+    """
+    cdef uint64_t value
+    if not _vlq_fast(b, &value) or value > <uint64_t> (b.end + 1) * 64:
+        # More elements than the payload could possibly describe.
+        raise ValueError("Element count out of range")
+    return <Py_ssize_t> value
+
+
+cdef object _uint16(Buf* b):
+    cdef const unsigned char* p = _need(b, 2)
+    return <uint16_t> ((p[0] << 8) | p[1])
+
+
+cdef object _sint16(Buf* b):
+    cdef const unsigned char* p = _need(b, 2)
+    return <int16_t> ((p[0] << 8) | p[1])
+
+
+cdef object _uint32(Buf* b):
+    return _be32(_need(b, 4))
+
+
+cdef object _sint32(Buf* b):
+    return <int32_t> _be32(_need(b, 4))
+
+
+cdef object _uint64(Buf* b):
+    return _be64(_need(b, 8))
+
+
+cdef object _sint64(Buf* b):
+    return <int64_t> _be64(_need(b, 8))
+
+
+cdef object _float32(Buf* b):
+    cdef uint32_t u = _be32(_need(b, 4))
+    cdef float f
+    memcpy(&f, &u, 4)
+    return <double> f
+
+
+cdef object _double(Buf* b):
+    cdef uint64_t u = _be64(_need(b, 8))
+    cdef double d
+    memcpy(&d, &u, 8)
+    return d
 
-def parse_vlq(object stream):
-    return c_parse_vlq(stream)
 
-def parse_svlq(object stream):
-    return c_parse_svlq(stream)
+cdef object _flag(Buf* b):
+    return _need(b, 1)[0] != 0
 
-def parse_dict_variant(object stream):
-    return c_parse_dict_variant(stream)
 
-def parse_variant_variant(object stream):
-    return c_parse_variant_variant(stream)
+cdef object _byte_obj(Buf* b):
+    return _byte(b)
 
-def parse_starbytearray(object stream):
-    return c_parse_starbytearray(stream)
 
-def parse_starstring(object stream):
-    return c_parse_starstring(stream)
+cdef object _uuid(Buf* b):
+    cdef const char* digits = b"0123456789abcdef"
+    cdef char res[32]
+    cdef Py_ssize_t n = b.end - b.pos
+    cdef Py_ssize_t i
+    cdef unsigned char c
+    if n > 16:
+        n = 16
+    for i in range(n):
+        c = b.p[b.pos + i]
+        res[2 * i] = digits[c >> 4]
+        res[2 * i + 1] = digits[c & 0xf]
+    b.pos += n
+    return PyBytes_FromStringAndSize(res, 2 * n)
 
-cdef c_parse_variant(object stream):
-    cdef char x = ord(stream.read(1))
 
+cdef object _take(Buf* b, object length):
+    """
+    Slice of the next `length` bytes, or of what is left if fewer.
+    """
+    cdef Py_ssize_t start = b.pos
+    if length > b.end - start:
+        b.pos = b.end
+    else:
+        b.pos += <Py_ssize_t> length
+    return (<object> b.view)[start:b.pos]
+
+
+cdef object _byte_array(Buf* b):
+    cdef Py_ssize_t n = _size(b)
+    cdef Py_ssize_t start = b.pos
+    b.pos += n
+    return (<object> b.view)[start:b.pos]
+
+
+cdef object _string(Buf* b):
+    cdef Py_ssize_t n = _size(b)
+    cdef const char* s = <const char*> b.p + b.pos
+    b.pos += n
+    try:
+        return PyUnicode_DecodeUTF8(s, n, NULL)
+    except UnicodeDecodeError:
+        return PyBytes_FromStringAndSize(s, n)
+
+
+cdef object _variant(Buf* b):
+    cdef unsigned char x = _byte(b)
     if x == 1:
         return None
     elif x == 2:
-        y = struct.unpack(">d", stream.read(8))[0]
-        return y
+        return _double(b)
     elif x == 3:
-        c = stream.read(1)
-        if c == 1:
-            return True
-        else:
-            return False
+        return _flag(b)
     elif x == 4:
-        return c_parse_svlq(stream)
+        return _svlq(b)
     elif x == 5:
-        return c_parse_starstring(stream)
+        return _string(b)
     elif x == 6:
-        return c_parse_variant_variant(stream)
+        return _variant_variant(b)
     elif x == 7:
-        return c_parse_dict_variant(stream)
-
-cdef int c_parse_vlq(object stream):
-    cdef long long value = 0
-    cdef char tmp
-    while True:
-        try:
-            tmp = ord(stream.read(1))
-            value = (value << 7) | (tmp & 0x7f)
-            if tmp & 0x80 == 0:
-                break
-        except TypeError:
-            break
-    return value
+        return _dict_variant(b)
+    return None
 
-cdef int c_parse_svlq(object stream):
-    cdef long long v = c_parse_vlq(stream)
-    if (v & 1) == 0x00:
-        return v >> 1
-    else:
-        return -((v >> 1) + 1)
 
+cdef object _variant_variant(Buf* b):
+    cdef Py_ssize_t n = _count(b)
+    cdef Py_ssize_t i
+    b.depth += 1
+    if b.depth > MAX_DEPTH:
+        raise RecursionError("Variant nested too deeply")
+    res = [_variant(b) for i in range(n)]
+    b.depth -= 1
+    return res
 
-cdef c_parse_dict_variant(object stream):
-    cdef int i = c_parse_vlq(stream)
+
+cdef object _dict_variant(Buf* b):
+    cdef Py_ssize_t n = _count(b)
+    cdef Py_ssize_t i
+    b.depth += 1
+    if b.depth > MAX_DEPTH:
+        raise RecursionError("Variant nested too deeply")
     c = {}
-    for _ in range(i):
-        key = c_parse_starstring(stream)
-        value = c_parse_variant(stream)
+    for i in range(n):
+        key = _string(b)
+        value = _variant(b)
+        if isinstance(value, bytes):
+            try:
+                value = value.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
         c[key] = value
+    b.depth -= 1
     return c
 
-cdef c_parse_variant_variant(object stream):
-    cdef int i = c_parse_vlq(stream)
-    return [c_parse_variant(stream) for _ in range(i)]
 
-cdef c_parse_starbytearray(object stream):
-    cdef int i = c_parse_vlq(stream)
-    s = stream.read(i)
-    return s
+cdef int _skip_variant(Buf* b) except -1:
+    # Mirrors data_parser._py_skip_variant.
+    cdef unsigned char x = _byte(b)
+    cdef uint64_t value
+    cdef Py_ssize_t n, i
+    if x == 2:
+        b.pos += 8 if b.end - b.pos >= 8 else b.end - b.pos
+    elif x == 3:
+        b.pos += 1 if b.pos < b.end else 0
+    elif x == 4:
+        if not _vlq_fast(b, &value):
+            _vlq_slow(b)
+    elif x == 5:
+        b.pos += _size(b)
+    elif x == 6 or x == 7:
+        n = _count(b)
+        b.depth += 1
+        if b.depth > MAX_DEPTH:
+            raise RecursionError("Variant nested too deeply")
+        for i in range(n):
+            if x == 7:
+                b.pos += _size(b)
+            _skip_variant(b)
+        b.depth -= 1
+    return x
+
+
+cdef object _skip(Buf* b):
+    return _skip_variant(b)
+
+
+cdef object _index_variant(Buf* b):
+    # Mirrors data_parser._py_index_variant.
+    cdef unsigned char x = _byte(b)
+    cdef Py_ssize_t n, i, start
+    if x != 6 and x != 7:
+        raise ValueError("Not a Variant list or dictionary")
+    n = _count(b)
+    entries = []
+    for i in range(n):
+        key = _string(b) if x == 7 else None
+        start = b.pos
+        _skip_variant(b)
+        entries.append((key, start, b.pos))
+    return entries
+
+
+cdef object _string_set(Buf* b):
+    cdef Py_ssize_t n = _count(b)
+    cdef Py_ssize_t i
+    c = []
+    for i in range(n):
+        value = _string(b)
+        if isinstance(value, bytes):
+            try:
+                value = value.decode("utf-8")
+            except UnicodeDecodeError:
+                pass
+        c.append(value)
+    return c
+
+
+cdef object _celestial_coordinates(Buf* b):
+    x = _sint32(b)
+    y = _sint32(b)
+    z = _sint32(b)
+    planet = _sint32(b)
+    satellite = _sint32(b)
+    return {"x": x, "y": y, "z": z, "planet": planet,
+            "satellite": satellite}
+
+
+cdef object _system_location(Buf* b):
+    cdef unsigned char type = _byte(b)
+    if type == 0:  # SYSTEM
+        return {"type": type}
+    elif type == 1:  # COORDINATE
+        d = _celestial_coordinates(b)
+        d["type"] = type
+    elif type == 2:  # ORBIT
+        d = _celestial_coordinates(b)
+        d["type"] = type
+        d["direction"] = _sint32(b)
+        d["enter_time"] = _double(b)
+        x = _float32(b)
+        d["enter_position"] = [x, _float32(b)]
+    elif type == 3:  # UUID
+        d = {"type": type, "uuid": _uuid(b)}
+    elif type == 4:  # LOCATION
+        x = _float32(b)
+        d = {"type": type, "location": [x, _float32(b)]}
+    else:
+        raise ValueError("Unknown system location type {}".format(type))
+    return d
+
+
+cdef object _warp_action(Buf* b):
+    cdef unsigned char warp_type = _byte(b)
+    cdef unsigned char world_id, target
+    d = {"warp_type": warp_type}
+    if warp_type == 1:  # TO_WORLD
+        world_id = _byte(b)
+        d["world_id"] = world_id
+        if world_id == 1:  # CELESTIAL_WORLD
+            d["celestial_coordinates"] = _celestial_coordinates(b)
+        elif world_id == 2:  # PLAYER_WORLD
+            d["ship_id"] = _uuid(b)
+        elif world_id == 3:  # UNIQUE_WORLD
+            d["world_name"] = _string(b)
+            d["is_instance"] = _byte(b)
+            if d["is_instance"] == 1:
+                d["instance_id"] = _uuid(b)
+            d["has_threatlevel"] = _byte(b)
+            if d["has_threatlevel"] == 1:
+                d["threatlevel"] = _float32(b)
+        target = _byte(b)
+        d["warp_target"] = target
+        if target == 1:  # ENTITY
+            d["teleporter"] = _string(b)
+        elif target == 2:  # COORDINATES
+            d["pos_x"] = _uint32(b)
+            d["pos_y"] = _uint32(b)
+        elif target == 3:  # ASTEROID
+            d["pos_x"] = _float32(b)
+    elif warp_type == 2:  # TO_PLAYER
+        d["player_id"] = _uuid(b)
+    elif warp_type == 3:  # TO_ALIAS
+        d["alias_id"] = _sint32(b)
+    return d
+
+
+cdef object _chat_header(Buf* b):
+    cdef unsigned char mode = _byte(b)
+    if mode == 0 or mode == 1:
+        channel = _string(b)
+    else:
+        channel = ""
+        _byte(b)
+    return {"mode": mode, "channel": channel, "client_id": _uint16(b)}
+
+
+cdef object _client_context_set(Buf* b):
+    cdef Py_ssize_t n, i
+    total_length = _vlq(b)
+    d = {"total_length": total_length}
+    if total_length < 100:
+        _vlq(b)
+    n = _count(b)
+    d["number_of_sets"] = n
+    for i in range(n):
+        d[i] = _variant(b)
+    return d
+
+
+cdef object _world_chunks(Buf* b):
+    cdef Py_ssize_t n = _count(b)
+    cdef Py_ssize_t i
+    c = []
+    for i in range(n):
+        v1 = _vlq(b)
+        c1 = _take(b, v1)
+        sep = _byte(b)
+        v2 = _vlq(b)
+        c2 = _take(b, v2)
+        c.append((i, v1, c1, sep, v2, c2))
+    return {"length": n, "content": c}
+
+
+cdef object _status_effect_list(Buf* b):
+    cdef Py_ssize_t n = _count(b)
+    cdef Py_ssize_t i
+    cdef unsigned char type
+    res = []
+    for i in range(n):
+        effect = _string(b)
+        type = _byte(b)
+        if type == 0:
+            res.append(effect)
+        elif type == 1:
+            res.append({"effect": effect, "duration": _float32(b)})
+    return res
+
+
+cdef object _entity_message(Buf* b):
+    res = {}
+    res["target_unique"] = _flag(b)
+    if res["target_unique"]:
+        res["unique_id"] = _string(b)
+    else:
+        res["target_id"] = _sint32(b)
+    res["message_name"] = _string(b)
+    res["message_args"] = _variant_variant(b)
+    res["message_uuid"] = _uuid(b)
+    res["client_id"] = _uint16(b)
+    return res
+
+
+cdef object _entity_message_response(Buf* b):
+    res = {}
+    res["success_level"] = _byte(b)
+    if res["success_level"] == 1:
+        res["error"] = _string(b)
+    else:
+        res["result"] = _variant(b)
+    res["message_uuid"] = _uuid(b)
+    return res
+
+
+def parse_vlq(stream, ctx=None):
+    return _run(stream, _vlq)
+
+def parse_svlq(stream, ctx=None):
+    return _run(stream, _svlq)
 
-cdef c_parse_starstring(object stream):
-    s = c_parse_starbytearray(stream)
+def parse_uint16(stream, ctx=None):
+    return _run(stream, _uint16)
+
+def parse_sint16(stream, ctx=None):
+    return _run(stream, _sint16)
+
+def parse_uint32(stream, ctx=None):
+    return _run(stream, _uint32)
+
+def parse_sint32(stream, ctx=None):
+    return _run(stream, _sint32)
+
+def parse_uint64(stream, ctx=None):
+    return _run(stream, _uint64)
+
+def parse_sint64(stream, ctx=None):
+    return _run(stream, _sint64)
+
+def parse_float32(stream, ctx=None):
+    return _run(stream, _float32)
+
+def parse_double(stream, ctx=None):
+    return _run(stream, _double)
+
+def parse_flag(stream, ctx=None):
+    return _run(stream, _flag)
+
+def parse_byte(stream, ctx=None):
+    return _run(stream, _byte_obj)
+
+def parse_uuid(stream, ctx=None):
+    return _run(stream, _uuid)
+
+def parse_starbytearray(stream, ctx=None):
+    return _run(stream, _byte_array)
+
+def parse_starstring(stream, ctx=None):
+    return _run(stream, _string)
+
+def parse_variant(stream, ctx=None):
+    return _run(stream, _variant)
+
+def parse_variant_variant(stream, ctx=None):
+    return _run(stream, _variant_variant)
+
+def parse_dict_variant(stream, ctx=None):
+    return _run(stream, _dict_variant)
+
+def skip_variant(stream):
+    return _run(stream, _skip)
+
+def index_variant(stream):
+    return _run(stream, _index_variant)
+
+def parse_string_set(stream, ctx=None):
+    return _run(stream, _string_set)
+
+def parse_celestial_coordinates(stream, ctx=None):
+    return _run(stream, _celestial_coordinates)
+
+def parse_system_location(stream, ctx=None):
+    return _run(stream, _system_location)
+
+def parse_warp_action(stream, ctx=None):
+    return _run(stream, _warp_action)
+
+def parse_chat_header(stream, ctx=None):
+    return _run(stream, _chat_header)
+
+def parse_client_context_set(stream, ctx=None):
+    return _run(stream, _client_context_set)
+
+def parse_world_chunks(stream, ctx=None):
+    return _run(stream, _world_chunks)
+
+def parse_status_effect_list(stream, ctx=None):
+    return _run(stream, _status_effect_list)
+
+def parse_entity_message(stream, ctx=None):
+    return _run(stream, _entity_message)
+
+def parse_entity_message_response(stream, ctx=None):
+    return _run(stream, _entity_message_response)
+
+
+def parse_client_connect(stream, ctx):
+    """
+    Parse a whole ClientConnect packet into ctx, the way the function
+    data_parser.compile_struct() generates for it does.
+    """
+    cdef Py_buffer view
+    cdef Buf b
+    buf = stream.buf
+    PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE)
     try:
-        return str(s, encoding="utf-8")
-    except UnicodeDecodeError:
-        return s
+        b.p = <const unsigned char*> view.buf
+        b.pos = stream.pos
+        b.end = stream.end
+        b.view = <PyObject*> buf
+        b.depth = 0
+        ctx["asset_digest"] = _byte_array(&b)
+        ctx["allow_mismatch"] = _flag(&b)
+        ctx["uuid"] = _uuid(&b)
+        ctx["name"] = _string(&b)
+        ctx["species"] = _string(&b)
+        ctx["shipdata"] = _world_chunks(&b)
+        ctx["ship_level"] = _uint32(&b)
+        ctx["max_fuel"] = _uint32(&b)
+        ctx["crew_size"] = _uint32(&b)
+        ctx["fuel_efficiency"] = _float32(&b)
+        ctx["ship_speed"] = _float32(&b)
+        ctx["ship_capabilities"] = _string_set(&b)
+        ctx["intro_complete"] = _flag(&b)
+        ctx["account"] = _string(&b)
+        stream.pos = b.pos
+        return ctx
+    finally:
+        PyBuffer_Release(&view)
+
+
+#
+## Writing
+#
+
+cdef inline int _put(bytearray out, const void* src, Py_ssize_t n) except -1:
+    cdef Py_ssize_t size = PyByteArray_GET_SIZE(out)
+    PyByteArray_Resize(out, size + n)
+    memcpy(PyByteArray_AS_STRING(out) + size, src, n)
+    return 0
+
+
+cdef int _put_buffer(bytearray out, object obj) except -1:
+    cdef Py_buffer view
+    PyObject_GetBuffer(obj, &view, PyBUF_SIMPLE)
+    try:
+        _put(out, view.buf, view.len)
+    finally:
+        PyBuffer_Release(&view)
+    return 0
+
+
+cdef int _put_int(bytearray out, object obj, int size, bint signed,
+                  char format) except -1:
+    cdef unsigned char tmp[8]
+    cdef uint64_t u
+    cdef int64_t s
+    cdef int i
+    try:
+        v = PyNumber_Index(obj)
+        if signed:
+            s = v
+            if size < 8 and not (-(<int64_t> 1 << (8 * size - 1)) <= s <
+                                 (<int64_t> 1 << (8 * size - 1))):
+                raise OverflowError
+            u = <uint64_t> s
+        else:
+            u = v
+            if size < 8 and u >> (8 * size):
+                raise OverflowError
+    except TypeError:
+        raise struct.error("required argument is not an integer")
+    except OverflowError:
+        raise struct.error("'{}' format requires a number in range".format(
+            chr(format)))
+    for i in range(size):
+        tmp[size - 1 - i] = u & 0xff
+        u >>= 8
+    return _put(out, tmp, size)
+
+
+cdef int _w_uint16(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 2, False, b"H")
+
+cdef int _w_sint16(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 2, True, b"h")
+
+cdef int _w_uint32(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 4, False, b"L")
+
+cdef int _w_sint32(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 4, True, b"l")
+
+cdef int _w_uint64(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 8, False, b"Q")
+
+cdef int _w_sint64(bytearray out, object obj) except -1:
+    return _put_int(out, obj, 8, True, b"q")
+
+
+cdef double _as_double(object obj) except? -1:
+    try:
+        return PyFloat_AsDouble(obj)
+    except TypeError:
+        raise struct.error("required argument is not a float")
+
+
+cdef int _w_float32(bytearray out, object obj) except -1:
+    cdef double d = _as_double(obj)
+    cdef float f = <float> d
+    cdef uint32_t u
+    cdef unsigned char tmp[4]
+    if isinf(f) and not isinf(d):
+        raise OverflowError("float too large to pack with f format")
+    memcpy(&u, &f, 4)
+    tmp[0] = u >> 24
+    tmp[1] = u >> 16
+    tmp[2] = u >> 8
+    tmp[3] = u
+    return _put(out, tmp, 4)
+
+
+cdef int _w_double(bytearray out, object obj) except -1:
+    cdef double d = _as_double(obj)
+    cdef uint64_t u
+    cdef unsigned char tmp[8]
+    cdef int i
+    memcpy(&u, &d, 8)
+    for i in range(8):
+        tmp[7 - i] = u & 0xff
+        u >>= 8
+    return _put(out, tmp, 8)
+
+
+cdef int _w_flag(bytearray out, object obj) except -1:
+    cdef unsigned char c = 1 if obj else 0
+    return _put(out, &c, 1)
+
+
+cdef int _w_byte(bytearray out, object obj) except -1:
+    # Same checks as bytearray.append().
+    cdef unsigned char c
+    v = PyNumber_Index(obj)
+    if not 0 <= v <= 0xff:
+        raise ValueError("byte must be in range(0, 256)")
+    c = v
+    return _put(out, &c, 1)
+
+
+cdef int _w_vlq(bytearray out, object obj) except -1:
+    cdef unsigned char tmp[10]
+    cdef uint64_t value
+    cdef int n = 10
+    v = int(obj)
+    if obj == 0:
+        tmp[0] = 0
+        return _put(out, tmp, 1)
+    if v <= 0:
+        # data_parser.VLQ builds nothing for these.
+        return 0
+    if v > 0xffffffffffffffff:
+        return _w_vlq_slow(out, v)
+    value = v
+    n -= 1
+    tmp[n] = value & 0x7f
+    value >>= 7
+    while value:
+        n -= 1
+        tmp[n] = (value & 0x7f) | 0x80
+        value >>= 7
+    return _put(out, &tmp[n], 10 - n)
+
+
+cdef int _w_vlq_slow(bytearray out, object value) except -1:
+    res = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        res.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    out.extend(res)
+    return 0
+
+
+cdef int _w_svlq(bytearray out, object obj) except -1:
+    value = abs(obj * 2)
+    if obj < 0:
+        value -= 1
+    return _w_vlq(out, value)
+
+
+cdef int _w_byte_array(bytearray out, object obj) except -1:
+    _w_vlq(out, len(obj))
+    return _put_buffer(out, obj)
+
+
+cdef int _w_string(bytearray out, object obj) except -1:
+    cdef const char* s
+    cdef Py_ssize_t n
+    if type(obj) is not str:
+        return _w_byte_array(out, obj.encode("utf-8"))
+    s = PyUnicode_AsUTF8AndSize(obj, &n)
+    _w_vlq(out, n)
+    return _put(out, s, n)
+
+
+cdef int _w_uuid(bytearray out, object obj) except -1:
+    return _put_buffer(out, obj)
+
+
+cdef int _w_variant(bytearray out, object obj) except -1:
+    cdef unsigned char x
+    if obj is None:
+        x = 1
+        return _put(out, &x, 1)
+    elif isinstance(obj, bool):
+        x = 3
+        _put(out, &x, 1)
+        return _w_flag(out, obj)
+    elif isinstance(obj, float):
+        x = 2
+        _put(out, &x, 1)
+        return _w_double(out, obj)
+    elif isinstance(obj, int):
+        x = 4
+        _put(out, &x, 1)
+        return _w_svlq(out, obj)
+    elif isinstance(obj, str):
+        x = 5
+        _put(out, &x, 1)
+        return _w_string(out, obj)
+    elif isinstance(obj, bytes):
+        x = 5
+        _put(out, &x, 1)
+        return _w_byte_array(out, obj)
+    elif isinstance(obj, dict):
+        x = 7
+        _put(out, &x, 1)
+        return _w_dict_variant(out, obj)
+    elif isinstance(obj, (list, tuple)):
+        x = 6
+        _put(out, &x, 1)
+        return _w_variant_variant(out, obj)
+    from data_parser import VariantView
+    if isinstance(obj, VariantView):
+        return _put_buffer(out, obj.raw)
+    raise TypeError("Cannot build a Variant from {}".format(
+        type(obj).__name__))
+
+
+cdef int _w_variant_variant(bytearray out, object obj) except -1:
+    _w_vlq(out, len(obj))
+    for value in obj:
+        _w_variant(out, value)
+    return 0
+
+
+cdef int _w_dict_variant(bytearray out, object obj) except -1:
+    _w_vlq(out, len(obj))
+    for key, value in obj.items():
+        _w_string(out, key)
+        _w_variant(out, value)
+    return 0
+
+
+cdef int _w_celestial_coordinates(bytearray out, object obj) except -1:
+    _w_sint32(out, obj["world_x"])
+    _w_sint32(out, obj["world_y"])
+    _w_sint32(out, obj["world_z"])
+    _w_sint32(out, obj["world_planet"])
+    _w_sint32(out, obj["world_satellite"])
+    return 0
+
+
+cdef int _w_system_location(bytearray out, object obj) except -1:
+    type = obj["type"]
+    _w_byte(out, type)
+    if type == 1:  # COORDINATE
+        _w_celestial_coordinates(out, obj)
+    elif type == 2:  # ORBIT
+        _w_celestial_coordinates(out, obj)
+        _w_sint32(out, obj["direction"])
+        _w_double(out, obj["enter_time"])
+        _w_float32(out, obj["enter_position"][0])
+        _w_float32(out, obj["enter_position"][1])
+    elif type == 3:  # UUID
+        _w_uuid(out, obj["uuid"])
+    elif type == 4:  # LOCATION
+        _w_float32(out, obj["location"][0])
+        _w_float32(out, obj["location"][1])
+    return 0
+
+
+cdef int _w_warp_action(bytearray out, object obj) except -1:
+    warp_type = obj["warp_type"]
+    _w_byte(out, warp_type)
+    if warp_type == 1:  # TO_WORLD
+        world_id = obj["world_id"]
+        _w_byte(out, world_id)
+        if world_id == 1:  # CELESTIAL_WORLD
+            _w_celestial_coordinates(out, obj["celestial_coordinates"])
+        elif world_id == 2:  # PLAYER_WORLD
+            _w_uuid(out, unhexlify(obj["ship_id"]))
+        elif world_id == 3:  # UNIQUE_WORLD
+            _w_string(out, obj["world_name"])
+            _w_byte(out, obj["is_instance"])
+            if obj["is_instance"] == 1:
+                _w_uuid(out, unhexlify(obj["instance_id"]))
+            _w_byte(out, obj["has_threatlevel"])
+            if obj["has_threatlevel"] == 1:
+                _w_float32(out, obj["threatlevel"])
+        target = obj["warp_target"]
+        _w_byte(out, target)
+        if target == 1:  # ENTITY
+            _w_string(out, obj["teleporter"])
+        elif target == 2:  # COORDINATES
+            _w_uint32(out, obj["pos_x"])
+            _w_uint32(out, obj["pos_y"])
+        elif target == 3:  # ASTEROID
+            _w_float32(out, obj["pos_x"])
+    elif warp_type == 2:  # TO_PLAYER
+        _w_uuid(out, unhexlify(obj["player_id"]))
+    elif warp_type == 3:  # TO_ALIAS
+        _w_sint32(out, obj["alias_id"])
+    return 0
+
+
+cdef int _w_chat_header(bytearray out, object obj) except -1:
+    mode = obj["mode"]
+    _w_byte(out, mode)
+    if mode == 0:
+        _w_string(out, obj["channel"])
+    else:
+        _w_byte(out, 0)
+    return _w_uint16(out, obj["client_id"])
+
+
+cdef int _w_status_effect_list(bytearray out, object obj) except -1:
+    _w_vlq(out, len(obj))
+    for status in obj:
+        if isinstance(status, dict):
+            _w_string(out, status["effect"])
+            _w_byte(out, 1)
+            _w_float32(out, status["duration"])
+        else:
+            _w_string(out, status)
+            _w_byte(out, 0)
+    return 0
+
+
+cdef int _w_entity_message(bytearray out, object obj) except -1:
+    _w_flag(out, obj["target_unique"])
+    if obj["target_unique"]:
+        _w_string(out, obj["unique_id"])
+    else:
+        _w_sint32(out, obj["target_id"])
+    _w_string(out, obj["message_name"])
+    _w_variant_variant(out, obj["message_args"])
+    _w_uuid(out, unhexlify(obj["message_uuid"]))
+    return _w_uint16(out, obj["client_id"])
+
+
+cdef int _w_entity_message_response(bytearray out, object obj) except -1:
+    _w_byte(out, obj["success_level"])
+    if obj["success_level"] == 1:
+        _w_string(out, obj["error"])
+    else:
+        _w_variant(out, obj["result"])
+    return _w_uuid(out, unhexlify(obj["message_uuid"]))
+
+
+cdef class Builder:
+    """
+    Build side of a struct. Calling it returns the bytes for an object, and
+    into() appends them to a bytearray instead.
+    """
+    cdef writer fn
+
+    def __call__(self, obj, ctx=None):
+        out = bytearray()
+        self.fn(out, obj)
+        return bytes(out)
+
+    def into(self, obj, bytearray out, ctx=None):
+        self.fn(out, obj)
+
+
+cdef Builder _builder(writer fn):
+    cdef Builder builder = Builder.__new__(Builder)
+    builder.fn = fn
+    return builder
+
+
+build_vlq = _builder(_w_vlq)
+build_svlq = _builder(_w_svlq)
+build_uint16 = _builder(_w_uint16)
+build_sint16 = _builder(_w_sint16)
+build_uint32 = _builder(_w_uint32)
+build_sint32 = _builder(_w_sint32)
+build_uint64 = _builder(_w_uint64)
+build_sint64 = _builder(_w_sint64)
+build_float32 = _builder(_w_float32)
+build_double = _builder(_w_double)
+build_flag = _builder(_w_flag)
+build_byte = _builder(_w_byte)
+build_uuid = _builder(_w_uuid)
+build_starbytearray = _builder(_w_byte_array)
+build_starstring = _builder(_w_string)
+build_variant = _builder(_w_variant)
+build_variant_variant = _builder(_w_variant_variant)
+build_dict_variant = _builder(_w_dict_variant)
+build_celestial_coordinates = _builder(_w_celestial_coordinates)
+build_system_location = _builder(_w_system_location)
+build_warp_action = _builder(_w_warp_action)
+build_chat_header = _builder(_w_chat_header)
+build_status_effect_list = _builder(_w_status_effect_list)
+build_entity_message = _builder(_w_entity_message)
+build_entity_message_response = _builder(_w_entity_message_response)
@@ -0,0 +1,574 @@
+"""
+StarryPy Cluster
+
+Lets several proxy worker processes, all accepting players on the same listen
+port, act as one server. A supervisor process starts the workers and hosts a
+ClusterHub, which every worker connects to over a local Unix socket. Through
+the hub the workers relay broadcasts, keep track of who is online anywhere on
+the server, and keep their copies of the player database in step. The hub is
+the only process that has the database file open.
+"""
+
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import shelve
+import signal
+import struct
+import sys
+import tempfile
+
+from utilities import DotDict
+
+logger = logging.getLogger("starrypy.cluster")
+
+_length = struct.Struct(">I")
+
+
+@asyncio.coroutine
+def read_message(reader):
+    """
+    Read a single message off of a cluster connection.
+
+    :param reader: Stream to read from.
+    :return: Dictionary. The message.
+    """
+    size = _length.unpack((yield from reader.readexactly(_length.size)))[0]
+    return pickle.loads((yield from reader.readexactly(size)))
+
+
+def write_message(writer, message):
+    """
+    Send a single message down a cluster connection.
+
+    :param writer: Stream to write to.
+    :param message: Dictionary. The message.
+    :return: Null.
+    """
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    writer.write(_length.pack(len(data)) + data)
+
+
+def digest(value):
+    """
+    Fingerprint a database entry, to tell whether it has changed.
+    """
+    return hashlib.md5(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).digest()
+
+
+class TrackedStorage(DotDict):
+    """
+    A plugin's storage inside a worker. Plugins hold on to their storage and
+    change it in place, so any lookup or change in it marks it to be checked
+    at the next sync. It is sent to other processes as a plain DotDict.
+    """
+    def __init__(self, entries, mark):
+        super().__init__({})
+        dict.update(self, entries)
+        object.__setattr__(self, "_mark", mark)
+
+    def __reduce__(self):
+        return DotDict, ({},), None, None, iter(self.items())
+
+    def __getattr__(self, item):
+        self._mark()
+        return super().__getattr__(item)
+
+    def __setattr__(self, key, value):
+        self._mark()
+        super().__setattr__(key, value)
+
+    def __getitem__(self, key):
+        self._mark()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self._mark()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._mark()
+        super().__delitem__(key)
+
+    def get(self, key, default=None):
+        self._mark()
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._mark()
+        return super().setdefault(key, default)
+
+    def pop(self, key, *default):
+        self._mark()
+        return super().pop(key, *default)
+
+
+class ClusterSection(dict):
+    """
+    One section of a ClusterShelf. Entries that are looked up may be changed
+    in place by whoever looked them up, so like a writeback shelf, every
+    entry looked up or changed is marked to be checked at the next sync.
+    Entries only iterated over are not; code that changes those has to mark
+    them itself, with ClusterShelf.mark_dirty().
+    """
+    def __init__(self, shelf, name, entries):
+        super().__init__()
+        self._shelf = shelf
+        self._name = name
+        for key, value in entries.items():
+            dict.__setitem__(self, key, self._wrap(key, value))
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def _wrap(self, key, value):
+        if self._name in ClusterShelf.storage_sections and \
+                isinstance(value, dict) and \
+                not isinstance(value, TrackedStorage):
+            return TrackedStorage(value, functools.partial(
+                self._shelf.mark_dirty, self._name, key))
+        return value
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._shelf.mark_dirty(self._name, key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, self._wrap(key, value))
+        self._shelf.mark_dirty(self._name, key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._shelf.mark_dirty(self._name, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        self._shelf.mark_dirty(self._name, key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._shelf.mark_dirty(self._name, key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        for key in self:
+            self._shelf.mark_dirty(self._name, key)
+        super().clear()
+
+
+class ClusterShelf(dict):
+    """
+    Stand-in for the player database shelf inside a worker. Holds each
+    section of the database (players, planets, bans, ...) in memory, starting
+    from the copy handed over by the hub. Only entries that have been looked
+    up, changed or explicitly marked since the last sync are checked for
+    changes, by comparing fingerprints, and sent back to the hub
+    periodically; entries changed by other workers are merged in place, so
+    that anything holding on to them (connections, plugin storage) keeps
+    seeing the current version.
+    """
+    # Sections holding plugin storage, which is handed out once and then
+    # changed in place.
+    storage_sections = ("plugins",)
+
+    def __init__(self, client, sections):
+        super().__init__()
+        self._client = client
+        self._dirty = set()
+        self._watched = set()
+        self._digests = {}
+        for name, section in sections.items():
+            dict.__setitem__(self, name, self._section(name, section))
+
+    def _section(self, name, section):
+        if isinstance(section, dict):
+            return ClusterSection(self, name, section)
+        return section
+
+    def __setitem__(self, name, section):
+        section = self._section(name, section)
+        super().__setitem__(name, section)
+        if isinstance(section, dict):
+            for key in section:
+                self.mark_dirty(name, key)
+
+    def mark_dirty(self, section, key):
+        """
+        Mark an entry to be checked for changes at the next sync.
+
+        :param section: Name of the section the entry is in.
+        :param key: Key of the entry.
+        :return: Null.
+        """
+        self._dirty.add((section, key))
+
+    def watch(self, section, key):
+        """
+        Check an entry for changes at every sync for as long as it has a
+        connection on this worker, for entries (such as connected players)
+        that are changed through references held elsewhere.
+
+        :param section: Name of the section the entry is in.
+        :param key: Key of the entry.
+        :return: Null.
+        """
+        self._watched.add((section, key))
+
+    def changes(self):
+        """
+        Collect the entries that changed since the last call, out of those
+        that have been marked or are being watched.
+
+        :return: Tuple. List of (section, key, value) updates, and list of
+                 (section, key) deletions.
+        """
+        updates = []
+        deletes = []
+        dirty, self._dirty = self._dirty, set()
+        for name, key in dirty | self._watched:
+            section = dict.get(self, name)
+            known = self._digests.setdefault(name, {})
+            if not isinstance(section, dict) or key not in section:
+                known.pop(key, None)
+                self._watched.discard((name, key))
+                deletes.append((name, key))
+                continue
+            value = dict.__getitem__(section, key)
+            d = digest(value)
+            if known.get(key) != d:
+                known[key] = d
+                updates.append((name, key, value))
+            if getattr(value, "connection", None) is None:
+                self._watched.discard((name, key))
+        return updates, deletes
+
+    def apply(self, updates, deletes):
+        """
+        Merge in changes made by another worker.
+
+        :param updates: List of (section, key, value) updates.
+        :param deletes: List of (section, key) deletions.
+        :return: Null.
+        """
+        for name, key, value in updates:
+            if name not in self:
+                self[name] = {}
+            section = dict.__getitem__(self, name)
+            local = dict.get(section, key)
+            if isinstance(local, dict) and isinstance(value, dict):
+                local.clear()
+                dict.update(local, value)
+            elif local is not None and type(local) is type(value) and \
+                    hasattr(local, "__dict__"):
+                if getattr(local, "connection", None) is not None:
+                    # Connected here: this worker knows best about the state
+                    # of the connection itself.
+                    for attr in getattr(local, "local_state", ()):
+                        setattr(value, attr, getattr(local, attr))
+                local.__dict__.update(value.__dict__)
+            else:
+                section[key] = value
+                self._dirty.discard((name, key))
+            self._digests.setdefault(name, {})[key] = digest(
+                dict.__getitem__(section, key))
+        for name, key in deletes:
+            section = dict.get(self, name)
+            if isinstance(section, dict):
+                dict.pop(section, key, None)
+            self._digests.get(name, {}).pop(key, None)
+
+    def sync(self):
+        self._client.push_changes()
+
+    def close(self):
+        self.sync()
+
+
+class ClusterClient:
+    """
+    A worker's connection to the cluster hub.
+    """
+    def __init__(self, path, worker_id, sync_interval=5):
+        self.path = path
+        self.worker_id = worker_id
+        self.sync_interval = sync_interval
+        self.shelf = None
+        self.roster = {}
+        self._reader = None
+        self._writer = None
+        self._handlers = {}
+        self._tasks = []
+
+    @asyncio.coroutine
+    def connect(self):
+        """
+        Connect to the hub, and collect the current state of the server from
+        it: the player database, and who is online on the other workers.
+
+        :return: Null.
+        """
+        self._reader, self._writer = \
+            yield from asyncio.open_unix_connection(self.path)
+        write_message(self._writer, {"op": "hello", "worker": self.worker_id})
+        snapshot = yield from read_message(self._reader)
+        self.shelf = ClusterShelf(self, snapshot["db"])
+        self.roster = snapshot["roster"]
+        self._tasks = [asyncio.ensure_future(self._listen()),
+                       asyncio.ensure_future(self._sync())]
+
+    def subscribe(self, op, handler):
+        """
+        Register a handler for messages of a given type coming in from other
+        workers. Handlers may be coroutines.
+
+        :param op: Message type.
+        :param handler: Callable, given the message.
+        :return: Null.
+        """
+        self._handlers.setdefault(op, []).append(handler)
+
+    def publish(self, op, **kwargs):
+        """
+        Send a message to all other workers.
+
+        :param op: Message type.
+        :param kwargs: Message contents.
+        :return: Null.
+        """
+        if self._writer is None or self._writer.transport.is_closing():
+            return
+        kwargs["op"] = op
+        kwargs["worker"] = self.worker_id
+        write_message(self._writer, kwargs)
+
+    def push_changes(self):
+        """
+        Send any local changes to the player database to the hub.
+
+        :return: Null.
+        """
+        if self.shelf is None:
+            return
+        updates, deletes = self.shelf.changes()
+        if updates or deletes:
+            self.publish("db_update", updates=updates, deletes=deletes)
+
+    @asyncio.coroutine
+    def close(self):
+        """
+        Push out any last database changes, and disconnect from the hub.
+
+        :return: Null.
+        """
+        for task in self._tasks:
+            task.cancel()
+        if self._writer is not None:
+            self.push_changes()
+            yield from self._writer.drain()
+            self._writer.close()
+
+    @asyncio.coroutine
+    def _sync(self):
+        while True:
+            yield from asyncio.sleep(self.sync_interval)
+            try:
+                self.push_changes()
+            except Exception:
+                logger.exception("Error while syncing the player database.")
+
+    @asyncio.coroutine
+    def _listen(self):
+        try:
+            while True:
+                message = yield from read_message(self._reader)
+                op = message["op"]
+                if op == "db_update":
+                    self.shelf.apply(message["updates"], message["deletes"])
+                elif op == "player_online":
+                    self.roster[message["uuid"]] = message
+                elif op == "player_offline":
+                    self.roster.pop(message["uuid"], None)
+                for handler in self._handlers.get(op, ()):
+                    try:
+                        res = handler(message)
+                        if asyncio.iscoroutine(res):
+                            asyncio.ensure_future(res)
+                    except Exception:
+                        logger.exception("Error in cluster message handler.")
+        except asyncio.IncompleteReadError:
+            logger.warning("Lost connection to the cluster hub.")
+
+
+class ClusterHub:
+    """
+    Central relay for all workers. Owns the player database file, applying
+    the changes workers send in, and keeps the server-wide roster of online
+    players.
+    """
+    def __init__(self, path, db_path, sync_interval=5):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.shelf = shelve.open(db_path, writeback=True)
+        self.roster = {}
+        self._workers = {}
+        self._server = None
+        self._syncer = None
+
+    @asyncio.coroutine
+    def start(self):
+        self._server = yield from asyncio.start_unix_server(self._handle,
+                                                            self.path)
+        self._syncer = asyncio.ensure_future(self._sync())
+
+    def close(self):
+        if self._syncer is not None:
+            self._syncer.cancel()
+        if self._server is not None:
+            self._server.close()
+        self.shelf.close()
+
+    def snapshot(self):
+        """
+        Current state of the server, for a newly connected worker.
+
+        :return: Dictionary.
+        """
+        return {"db": {name: self.shelf[name] for name in self.shelf.keys()},
+                "roster": dict(self.roster)}
+
+    def apply(self, updates, deletes):
+        for name, key, value in updates:
+            if name not in self.shelf:
+                self.shelf[name] = {}
+            self.shelf[name][key] = value
+        for name, key in deletes:
+            if name in self.shelf:
+                self.shelf[name].pop(key, None)
+
+    def relay(self, message, source=None):
+        for worker, writer in self._workers.items():
+            if worker != source:
+                write_message(writer, message)
+
+    @asyncio.coroutine
+    def _handle(self, reader, writer):
+        worker = None
+        try:
+            hello = yield from read_message(reader)
+            worker = hello["worker"]
+            write_message(writer, self.snapshot())
+            self._workers[worker] = writer
+            logger.info("Worker {} joined the cluster.".format(worker))
+            while True:
+                message = yield from read_message(reader)
+                op = message["op"]
+                if op == "db_update":
+                    self.apply(message["updates"], message["deletes"])
+                elif op == "player_online":
+                    self.roster[message["uuid"]] = message
+                elif op == "player_offline":
+                    self.roster.pop(message["uuid"], None)
+                self.relay(message, source=worker)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception:
+            logger.exception("Error while handling worker {}.".format(worker))
+        finally:
+            self._workers.pop(worker, None)
+            writer.close()
+            if worker is not None:
+                logger.info("Worker {} left the cluster.".format(worker))
+                for uuid, entry in list(self.roster.items()):
+                    if entry["worker"] == worker:
+                        del self.roster[uuid]
+                        self.relay({"op": "player_offline", "uuid": uuid,
+                                    "worker": worker})
+
+    @asyncio.coroutine
+    def _sync(self):
+        while True:
+            yield from asyncio.sleep(self.sync_interval)
+            self.shelf.sync()
+
+
+class Supervisor:
+    """
+    Starts the worker processes, restarts any that die, and hosts the hub
+    they all talk through.
+    """
+    def __init__(self, script, workers, db_path, sync_interval=5):
+        self.script = str(script)
+        self.workers = workers
+        self._dir = tempfile.mkdtemp(prefix="starrypy-")
+        self.path = os.path.join(self._dir, "cluster.sock")
+        self.hub = ClusterHub(self.path, db_path, sync_interval)
+        self._processes = {}
+        self._stopping = False
+
+    @asyncio.coroutine
+    def run(self):
+        yield from self.hub.start()
+        yield from asyncio.wait([asyncio.ensure_future(self._watch(i))
+                                 for i in range(self.workers)])
+
+    @asyncio.coroutine
+    def stop(self, timeout=30):
+        """
+        Ask every worker to shut down cleanly, wait for them to do so, and
+        then close the hub (and with it, the player database).
+
+        :param timeout: Seconds to wait before giving up on a worker.
+        :return: Null.
+        """
+        self._stopping = True
+        running = [p for p in self._processes.values()
+                   if p.returncode is None]
+        for process in running:
+            process.send_signal(signal.SIGINT)
+        if running:
+            _, pending = yield from asyncio.wait(
+                [asyncio.ensure_future(p.wait()) for p in running],
+                timeout=timeout)
+            for process in running:
+                if process.returncode is None:
+                    process.kill()
+        self.hub.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(self._dir)
+        except OSError:
+            pass
+
+    @asyncio.coroutine
+    def _watch(self, worker):
+        while not self._stopping:
+            process = yield from asyncio.create_subprocess_exec(
+                sys.executable, self.script,
+                "--worker", str(worker), "--cluster", self.path,
+                start_new_session=True)
+            self._processes[worker] = process
+            logger.info("Started worker {} (pid {}).".format(worker,
+                                                             process.pid))
+            code = yield from process.wait()
+            if not self._stopping:
+                logger.warning("Worker {} exited with code {}; "
+                               "restarting.".format(worker, code))
+                yield from asyncio.sleep(1)
@@ -1,15 +1,15 @@
 import binascii
 import copy
 import functools
-import io
+import logging
 import struct
+import zlib
 from collections import OrderedDict
-from io import BytesIO
+from collections.abc import Mapping, Sequence
 try:
     import c_parser
-    use_c_parser = True
 except ImportError:
-    use_c_parser = False
+    c_parser = None
 
 from utilities import DotDict, WarpType, WarpWorldType, SpawnTargetType, \
     SystemLocationType
@@ -89,10 +89,68 @@ class OrderedDotDict(OrderedDict, DotDict):
 cm = composed(classmethod, functools.lru_cache())
 
 
+class Cursor:
+    """
+    Read position within a packet payload. Walks a memoryview of the payload
+    with an integer offset, so that primitives can unpack values in place
+    with unpack_from(), and byte arrays can be handed out as slices of the
+    payload instead of copies.
+
+    read() and peek() are there for parsers written against file-like
+    streams.
+    """
+    __slots__ = ("buf", "data", "pos", "end")
+
+    def __init__(self, data):
+        buf = memoryview(data)
+        if buf.format != "B" or buf.ndim != 1:
+            buf = buf.cast("B")
+        self.buf = buf
+        # Short strings decode faster out of a bytes slice than a view.
+        self.data = data if isinstance(data, bytes) else buf
+        self.pos = 0
+        self.end = len(buf)
+
+    def unpack(self, fmt):
+        """
+        Unpack values in place, and move past them.
+
+        :param fmt: Precompiled struct.Struct.
+        :return: Tuple of unpacked values.
+        """
+        res = fmt.unpack_from(self.buf, self.pos)
+        self.pos += fmt.size
+        return res
+
+    def take(self, n):
+        """
+        Hand out the next n bytes (or what is left, if fewer) as a slice of
+        the payload, without copying them.
+
+        :param n: Number of bytes.
+        :return: Memoryview.
+        """
+        start = self.pos
+        end = start + n
+        if end > self.end:
+            end = self.end
+        self.pos = end
+        return self.buf[start:end]
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.end - self.pos
+        return self.take(n).tobytes()
+
+    def peek(self, n=0):
+        return self.buf[self.pos:]
+
+
 class MetaStruct(type):
     @classmethod
     def __prepare__(mcs, name, bases):
-        return OrderedDict({'_struct_fields': [], '_cache': {}})
+        return OrderedDict({'_struct_fields': [], '_cache': {},
+                            '_compiled': None, '_partials': {}})
 
     def __new__(mcs, name, bases, clsdict):
         for key, value in clsdict.items():
@@ -106,12 +164,12 @@ class MetaStruct(type):
 class Struct(metaclass=MetaStruct):
     @classmethod
     def parse(cls, string, ctx=None):
-        if not isinstance(string, io.BufferedReader):
-            if not isinstance(string, BytesIO):
-                if isinstance(string, str):
-                    string = bytes(string, encoding="utf-8")
-                string = BytesIO(string)
-            string = io.BufferedReader(string)
+        if not isinstance(string, Cursor):
+            if isinstance(string, str):
+                string = bytes(string, encoding="utf-8")
+            elif hasattr(string, "read"):
+                string = string.read()
+            string = Cursor(string)
 
         # FIXME: Stream caching appears to be causing a parsing issue.
         # Disabling for now...
@@ -129,16 +187,80 @@ class Struct(metaclass=MetaStruct):
         #     cacher.set(cls, res, d)
         return res
 
+    @classmethod
+    def parse_partial(cls, string, fields, ctx=None):
+        """
+        Parse only as far into a struct as it takes to get at the given
+        fields, leaving out whatever follows the last of them. Structs that
+        can't be cut short are parsed in full.
+
+        :param string: Data to parse.
+        :param fields: Names of the fields wanted.
+        :param ctx: Context.
+        :return: Dictionary, holding at least the fields wanted.
+        """
+        key = frozenset(fields)
+        try:
+            parser = cls._partials[key]
+        except KeyError:
+            parser = cls._partials[key] = cls._partial_parser(key)
+        if parser is None:
+            return cls.parse(string, ctx)
+        if not isinstance(string, Cursor):
+            string = Cursor(string)
+        if ctx is None:
+            ctx = {}
+        return parser(string, ctx)
+
+    @classmethod
+    def _partial_parser(cls, fields):
+        """
+        Work out how to parse just the given fields of a struct. For
+        declarative structs, that is a parser for the fields up to and
+        including the last one wanted.
+
+        :param fields: Frozenset of field names.
+        :return: Function taking (stream, ctx), or None to parse in full.
+        """
+        names = [name for name, _ in cls._struct_fields]
+        if not fields <= set(names):
+            return None
+        count = max([names.index(name) + 1 for name in fields] or [0])
+        if count == len(names):
+            return None
+        return compile_struct(cls, count)[0]
+
+    @classmethod
+    def field_spans(cls, string, fields):
+        """
+        Find where the given fields of a declarative struct lie in its
+        payload, walking only as far as the last of them.
+
+        :param string: Payload of the struct.
+        :param fields: Names of the fields wanted.
+        :return: Dictionary of field names to (start, end) tuples.
+        """
+        names = [name for name, _ in cls._struct_fields]
+        missing = set(fields).difference(names)
+        if missing:
+            raise KeyError("{} has no fields {}".format(
+                cls.__name__, ", ".join(sorted(missing))))
+        count = max([names.index(name) + 1 for name in fields] or [0])
+        stream = Cursor(string)
+        ctx = {}
+        spans = {}
+        for name, struct in cls._struct_fields[:count]:
+            start = stream.pos
+            ctx[name] = struct.parse_stream(stream, ctx)
+            spans[name] = (start, stream.pos)
+        return spans
+
     @classmethod
     def parse_stream(cls, stream, ctx=None):
         if cls._struct_fields:
-            for name, struct in cls._struct_fields:
-                try:
-                    ctx[name] = struct.parse(stream, ctx=ctx)
-                except:
-                    print("Context at time of failure:", ctx)
-                    raise
-            res = ctx
+            if cls._compiled is None:
+                cls._compiled = compile_struct(cls)
+            res = cls._compiled[0](stream, ctx)
         else:
             res = cls._parse(stream, ctx=ctx)
 
@@ -151,300 +273,721 @@ class Struct(metaclass=MetaStruct):
         if ctx is None:
             ctx = {}
         if cls._struct_fields:
-            for name, struct in cls._struct_fields:
-                try:
-                    if name in obj:
-                        res += struct.build(obj[name], ctx=ctx)
-                    else:
-                        res += struct.build(None, ctx=ctx)
-                except:
-                    print("Context at time of failure:", ctx)
-                    raise
+            out = bytearray()
+            cls.build_into(obj, out, ctx)
+            res += out
         else:
             res = cls._build(obj, ctx=ctx)
         return res
 
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
+    def build_into(cls, obj, out, ctx=None):
+        """
+        Build an object onto the end of a bytearray, rather than into bytes
+        of its own.
+
+        :param obj: Object to build.
+        :param out: Bytearray to append to.
+        :param ctx: Context.
+        :return: The bytearray.
+        """
+        if ctx is None:
+            ctx = {}
+        if cls._struct_fields:
+            if cls._compiled is None:
+                cls._compiled = compile_struct(cls)
+            cls._compiled[1](obj, out, ctx)
+        else:
+            cls._build_into(obj, out, ctx)
+        return out
+
+    @classmethod
+    def build_packet(cls, packet_id, obj, compressed=None):
+        """
+        Build an object as the payload of a packet, and frame it, all in one
+        buffer. The payload is built after some room left for the header,
+        which is filled in once the payload's length is known.
+
+        :param packet_id: ID value of packet.
+        :param obj: Object to build.
+        :param compressed: Whether to compress the payload; see
+                           compress_payload().
+        :return: Bytearray. The whole packet.
+        """
+        out = bytearray(_header_room)
+        cls.build_into(obj, out)
+        return frame_packet(out, packet_id, compressed)
+
+    @classmethod
+    def _parse_fields(cls, stream, ctx):
+        """
+        Parse a declarative struct one field at a time. This is what the
+        functions generated by compile_struct() do in one go; it is kept
+        around as the reference they are checked against.
+        """
+        for name, struct in cls._struct_fields:
+            try:
+                ctx[name] = struct.parse(stream, ctx=ctx)
+            except:
+                print("Context at time of failure:", ctx)
+                raise
+        return ctx
+
+    @classmethod
+    def _build_fields(cls, obj, ctx):
+        """
+        Build a declarative struct one field at a time; see _parse_fields().
+        """
+        res = b''
+        for name, struct in cls._struct_fields:
+            try:
+                if name in obj:
+                    res += struct.build(obj[name], ctx=ctx)
+                else:
+                    res += struct.build(None, ctx=ctx)
+            except:
+                print("Context at time of failure:", ctx)
+                raise
+        return res
+
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
         raise NotImplementedError
 
     @classmethod
     def _build(cls, obj, ctx: OrderedDotDict):
-        raise NotImplementedError
+        if cls._build_into.__func__ is Struct._build_into.__func__:
+            raise NotImplementedError
+        out = bytearray()
+        cls._build_into(obj, out, ctx)
+        return bytes(out)
 
+    @classmethod
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += cls._build(obj, ctx=ctx)
 
-class VLQ(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict) -> int:
-            return c_parser.parse_vlq(stream)
+
+# Room left at the front of a packet for its header: the packet ID, and a
+# SignedVLQ length of up to 64 bits.
+_header_room = 11
+
+
+def frame_packet(out, packet_id, compressed=None):
+    """
+    Fill in the header of a packet built by Struct.build_packet(), in the
+    room left for it at the front of the buffer.
+
+    :param out: Bytearray. Header room followed by the payload.
+    :param packet_id: ID value of packet.
+    :param compressed: Whether to compress the payload; see
+                       compress_payload().
+    :return: Bytearray. The whole packet.
+    """
+    if compressed is not False:
+        payload, compressed = compress_payload(out[_header_room:], compressed)
+        if compressed:
+            out[_header_room:] = payload
+    size = len(out) - _header_room
+    header = bytearray()
+    Byte._build_into(packet_id, header, None)
+    SignedVLQ._build_into(-size if compressed else size, header, None)
+    start = _header_room - len(header)
+    out[start:_header_room] = header
+    # Removing bytes from the front of a bytearray only moves its start.
+    del out[:start]
+    return out
+
+
+# Payloads of packets the proxy builds are compressed if they are at least
+# this many bytes long (0 to never compress them), at this zlib level.
+compress_size = 256
+compress_level = 6
+
+# Recently compressed payloads, and what they compressed to, so that the same
+# message going out to every player is only compressed once.
+_compressed = OrderedDict()
+_compressed_count = 64
+
+
+def configure_compression(size, level=6):
+    """
+    Set when and how hard packets built by the proxy are compressed.
+
+    :param size: Compress payloads at least this many bytes long. 0 to never
+                 compress them.
+    :param level: zlib compression level, from 1 (fastest) to 9 (smallest).
+    :return: Null.
+    """
+    global compress_size, compress_level
+    if level != compress_level:
+        _compressed.clear()
+    compress_size = size
+    compress_level = level
+
+
+def compress_payload(data, compressed=None):
+    """
+    Compress the payload of a packet about to be sent, reusing the result if
+    the same payload has been compressed recently.
+
+    :param data: Payload.
+    :param compressed: True to compress the payload, or None to compress it
+                       only if it is at least compress_size bytes long and
+                       comes out smaller.
+    :return: Tuple. Payload to send, and whether it is compressed.
+    """
+    if compressed is None and not 0 < compress_size <= len(data):
+        return data, False
+    key = bytes(data)
+    try:
+        payload = _compressed[key]
+    except KeyError:
+        payload = zlib.compress(key, compress_level)
+        _compressed[key] = payload
+        if len(_compressed) > _compressed_count:
+            _compressed.popitem(last=False)
     else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict) -> int:
-            value = 0
-            while True:
-                try:
-                    tmp = ord(stream.read(1))
-                    value = (value << 7) | (tmp & 0x7f)
-                    if tmp & 0x80 == 0:
-                        break
-                except TypeError:  # If the stream is empty.
-                    break
-            return value
+        _compressed.move_to_end(key)
+    if compressed is None and len(payload) >= len(data):
+        return data, False
+    return payload, True
+
+
+# Precompiled formats for the fixed-width primitives.
+_uint16 = struct.Struct(">H")
+_sint16 = struct.Struct(">h")
+_uint32 = struct.Struct(">L")
+_sint32 = struct.Struct(">l")
+_uint64 = struct.Struct(">Q")
+_sint64 = struct.Struct(">q")
+_float32 = struct.Struct(">f")
+_double = struct.Struct(">d")
+_flag = struct.Struct(">?")
+_coordinates = struct.Struct(">lllll")
+
+
+class VLQ(Struct):
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict) -> int:
+        buf = stream.buf
+        pos = stream.pos
+        end = stream.end
+        value = 0
+        while pos < end:  # Stop early if the stream runs out.
+            tmp = buf[pos]
+            pos += 1
+            value = (value << 7) | (tmp & 0x7f)
+            if tmp & 0x80 == 0:
+                break
+        stream.pos = pos
+        return value
 
     @classmethod
-    def _build(cls, obj, ctx):
-        result = bytearray()
+    def _build_into(cls, obj, out, ctx):
         value = int(obj)
         if obj == 0:
-            result = bytearray(b'\x00')
-        else:
-            while value > 0:
-                byte = value & 0x7f
-                value >>= 7
-                if value != 0:
-                    byte |= 0x80
-                result.insert(0, byte)
-            if len(result) > 1:
-                result[0] |= 0x80
-                result[-1] ^= 0x80
-        return bytes(result)
+            out.append(0)
+        elif value > 0:  # Negative values have no encoding, and build empty.
+            for shift in range(value.bit_length() // 7 * 7, 0, -7):
+                if value >> shift:
+                    out.append((value >> shift) & 0x7f | 0x80)
+            out.append(value & 0x7f)
 
 
 class SignedVLQ(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_svlq(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            v = VLQ.parse(stream, ctx)
-            if (v & 1) == 0x00:
-                return v >> 1
-            else:
-                return -((v >> 1) + 1)
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        v = VLQ._parse(stream, ctx)
+        if (v & 1) == 0x00:
+            return v >> 1
+        else:
+            return -((v >> 1) + 1)
 
     @classmethod
-    def _build(cls, obj, ctx):
+    def _build_into(cls, obj, out, ctx):
         value = abs(obj * 2)
         if obj < 0:
             value -= 1
-        return VLQ.build(value, ctx)
+        VLQ._build_into(value, out, ctx)
 
 
 class UBInt16(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">H", stream.read(2))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_uint16)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">H", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _uint16.pack(obj)
 
 
 class SBInt16(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">h", stream.read(2))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_sint16)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">h", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _sint16.pack(obj)
 
 
 class UBInt32(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">L", stream.read(4))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_uint32)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">L", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _uint32.pack(obj)
 
 
 class SBInt32(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">l", stream.read(4))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_sint32)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">l", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _sint32.pack(obj)
 
 class UBInt64(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">Q", stream.read(8))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_uint64)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">Q", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _uint64.pack(obj)
 
 
 class SBInt64(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">q", stream.read(8))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_sint64)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">q", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _sint64.pack(obj)
 
 
 class BFloat32(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">f", stream.read(4))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_float32)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">f", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _float32.pack(obj)
 
 
 class StarByteArray(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_starbytearray(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            length = VLQ.parse(stream, ctx)
-            return stream.read(length)
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        length = VLQ._parse(stream, ctx)
+        return stream.take(length)
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return VLQ.build(len(obj), ctx) + obj
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        VLQ._build_into(len(obj), out, ctx)
+        out += obj
 
 
 class StarString(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_starstring(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            data = StarByteArray.parse(stream, ctx)
-            try:
-                return data.decode("utf-8")
-            except UnicodeDecodeError:
-                return data
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        length = VLQ._parse(stream, ctx)
+        start = stream.pos
+        end = start + length
+        if end > stream.end:
+            end = stream.end
+        stream.pos = end
+        data = stream.data[start:end]
+        try:
+            return str(data, "utf-8")
+        except UnicodeDecodeError:
+            return bytes(data)
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return StarByteArray.build(obj.encode("utf-8"), ctx)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        StarByteArray._build_into(obj.encode("utf-8"), out, ctx)
 
 
 class Byte(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return int.from_bytes(stream.read(1), byteorder="big", signed=False)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        if stream.pos >= stream.end:
+            return 0
+        stream.pos += 1
+        return stream.buf[stream.pos - 1]
 
     @classmethod
-    def _build(cls, obj: int, ctx: OrderedDotDict):
-        return obj.to_bytes(1, byteorder="big", signed=False)
+    def _build_into(cls, obj: int, out: bytearray, ctx: OrderedDotDict):
+        out.append(obj)
 
 
 class Flag(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">?", stream.read(1))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_flag)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">?", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _flag.pack(obj)
 
 
 class BDouble(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return struct.unpack(">d", stream.read(8))[0]
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return stream.unpack(_double)[0]
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        return struct.pack(">d", obj)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _double.pack(obj)
 
 
 class UUID(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        return binascii.hexlify(stream.read(16))
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        return binascii.hexlify(stream.take(16))
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        res = b''
-        res += obj
-        return res
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += obj
 
 
 class VariantVariant(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_variant_variant(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            l = VLQ.parse(stream, ctx)
-            return [Variant.parse(stream, ctx) for _ in range(l)]
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        l = VLQ._parse(stream, ctx)
+        return [Variant._parse(stream, ctx) for _ in range(l)]
+
+    @classmethod
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        VLQ._build_into(len(obj), out, ctx)
+        for value in obj:
+            Variant._build_into(value, out, ctx)
 
 
 class DictVariant(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_dict_variant(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            l = VLQ.parse(stream, ctx)
-            c = {}
-            for _ in range(l):
-                key = StarString.parse(stream, ctx)
-                value = Variant.parse(stream, ctx)
-                if isinstance(value, bytes):
-                    try:
-                        value = value.decode('utf-8')
-                    except UnicodeDecodeError:
-                        pass
-                c[key] = value
-            return c
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        l = VLQ._parse(stream, ctx)
+        c = {}
+        for _ in range(l):
+            key = StarString._parse(stream, ctx)
+            value = Variant._parse(stream, ctx)
+            if isinstance(value, bytes):
+                try:
+                    value = value.decode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+            c[key] = value
+        return c
+
+    @classmethod
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        VLQ._build_into(len(obj), out, ctx)
+        for key, value in obj.items():
+            StarString._build_into(key, out, ctx)
+            Variant._build_into(value, out, ctx)
 
 
 class Variant(Struct):
-    if use_c_parser:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            return c_parser.parse_variant(stream)
-    else:
-        @classmethod
-        def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-            x = Byte.parse(stream, ctx)
-            if x == 1:
-                return None
-            elif x == 2:
-                return BDouble.parse(stream, ctx)
-            elif x == 3:
-                return Flag.parse(stream, ctx)
-            elif x == 4:
-                return SignedVLQ.parse(stream, ctx)
-            elif x == 5:
-                return StarString.parse(stream, ctx)
-            elif x == 6:
-                return VariantVariant.parse(stream, ctx)
-            elif x == 7:
-                return DictVariant.parse(stream, ctx)
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        x = Byte._parse(stream, ctx)
+        if x == 1:
+            return None
+        elif x == 2:
+            return BDouble._parse(stream, ctx)
+        elif x == 3:
+            return Flag._parse(stream, ctx)
+        elif x == 4:
+            return SignedVLQ._parse(stream, ctx)
+        elif x == 5:
+            return StarString._parse(stream, ctx)
+        elif x == 6:
+            return VariantVariant._parse(stream, ctx)
+        elif x == 7:
+            return DictVariant._parse(stream, ctx)
+
+    @classmethod
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        if obj is None:
+            out.append(1)
+        elif isinstance(obj, bool):
+            out.append(3)
+            Flag._build_into(obj, out, ctx)
+        elif isinstance(obj, float):
+            out.append(2)
+            BDouble._build_into(obj, out, ctx)
+        elif isinstance(obj, int):
+            out.append(4)
+            SignedVLQ._build_into(obj, out, ctx)
+        elif isinstance(obj, str):
+            out.append(5)
+            StarString._build_into(obj, out, ctx)
+        elif isinstance(obj, bytes):
+            # Strings that were not valid UTF-8 are parsed as bytes.
+            out.append(5)
+            StarByteArray._build_into(obj, out, ctx)
+        elif isinstance(obj, dict):
+            out.append(7)
+            DictVariant._build_into(obj, out, ctx)
+        elif isinstance(obj, (list, tuple)):
+            out.append(6)
+            VariantVariant._build_into(obj, out, ctx)
+        elif isinstance(obj, VariantView):
+            out += obj.raw
+        else:
+            raise TypeError("Cannot build a Variant from {}".format(
+                type(obj).__name__))
+
+
+def _py_skip_variant(stream):
+    """
+    Move past a Variant without decoding it. Walks the Variant with a stack
+    rather than recursively, and reads lengths inline, as this is the inner
+    loop of LazyVariant.
+
+    :param stream: Cursor at the start of the Variant.
+    :return: The Variant's type.
+    """
+    buf = stream.buf
+    end = stream.end
+    pos = stream.pos
+    first = None
+    stack = []
+    left = 1
+    keyed = False
+    while True:
+        while not left:
+            if not stack:
+                stream.pos = pos
+                return first
+            left, keyed = stack.pop()
+        left -= 1
+        if keyed:
+            n = 0
+            while pos < end:
+                b = buf[pos]
+                pos += 1
+                n = (n << 7) | (b & 0x7f)
+                if not b & 0x80:
+                    break
+            pos = min(pos + n, end)
+        if pos < end:
+            x = buf[pos]
+            pos += 1
+        else:
+            x = 0
+        if first is None:
+            first = x
+        if x == 2:
+            pos = min(pos + 8, end)
+        elif x == 3:
+            pos = min(pos + 1, end)
+        elif 4 <= x <= 7:
+            n = 0
+            while pos < end:
+                b = buf[pos]
+                pos += 1
+                n = (n << 7) | (b & 0x7f)
+                if not b & 0x80:
+                    break
+            if x == 5:
+                pos = min(pos + n, end)
+            elif x != 4:
+                if n > (end + 1) * 64:
+                    # More elements than the payload could describe.
+                    raise ValueError("Element count out of range")
+                if len(stack) >= _max_variant_depth:
+                    raise RecursionError("Variant nested too deeply")
+                stack.append((left, keyed))
+                left = n
+                keyed = x == 7
+
+
+def _py_index_variant(stream):
+    """
+    Find where the entries of a Variant list or dictionary are, without
+    decoding them, and move past it.
+
+    :param stream: Cursor at the start of the Variant.
+    :return: List of (key, start, end) tuples, one for each entry. Keys are
+             None for lists.
+    """
+    x = Byte._parse(stream, None)
+    if x != 6 and x != 7:
+        raise ValueError("Not a Variant list or dictionary")
+    count = VLQ._parse(stream, None)
+    if count > (stream.end + 1) * 64:
+        raise ValueError("Element count out of range")
+    entries = []
+    for _ in range(count):
+        key = StarString._parse(stream, None) if x == 7 else None
+        start = stream.pos
+        _skip_variant(stream)
+        entries.append((key, start, stream.pos))
+    return entries
+
+
+# Nesting limit for skipping Variants, as in c_parser.
+_max_variant_depth = 500
+
+# Replaced by their c_parser counterparts when the compiled codec is in use.
+_skip_variant = _py_skip_variant
+_index_variant = _py_index_variant
+
+
+class VariantView:
+    """
+    Base for the read-only views LazyVariant hands out in place of
+    dictionaries and lists. A view holds on to the raw bytes of its Variant,
+    finds where its entries are the first time one is looked up, and only
+    decodes the entries that are looked at.
+    """
+    __slots__ = ("raw", "_entries", "_offsets", "_values")
+
+    def __init__(self, raw, entries=None, base=0):
+        self.raw = raw
+        # Entries found while parsing, positioned relative to `base`.
+        self._entries = (entries, base) if entries is not None else None
+        self._offsets = None
+        self._values = {}
+
+    def materialize(self):
+        """
+        Decode the whole Variant, as Variant.parse() would have.
+
+        :return: Dictionary or list.
+        """
+        return Variant.parse(self.raw)
+
+    def _walk(self):
+        """
+        :return: Tuple. List of (key, start, end) tuples for the entries of
+                 the Variant, and the position in `raw` they are relative to.
+        """
+        if self._entries is None:
+            return _index_variant(Cursor(self.raw)), 0
+        entries, self._entries = self._entries, None
+        return entries
+
+    def _value(self, span):
+        try:
+            return self._values[span]
+        except KeyError:
+            pass
+        start, end = span
+        x = self.raw[start]
+        if x == 6:
+            value = VariantList(self.raw[start:end])
+        elif x == 7:
+            value = VariantDict(self.raw[start:end])
+        else:
+            stream = Cursor(self.raw)
+            stream.pos = start
+            value = Variant._parse(stream, None)
+        self._values[span] = value
+        return value
+
+    def __reduce__(self):
+        # Pickled and copied as the plain dictionary or list.
+        value = self.materialize()
+        return type(value), (value,)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.materialize())
+
+
+class VariantDict(VariantView, Mapping):
+    __slots__ = ()
+
+    def _index(self):
+        if self._offsets is None:
+            entries, base = self._walk()
+            self._offsets = {key: (start - base, end - base)
+                             for key, start, end in entries}
+        return self._offsets
+
+    def __getitem__(self, key):
+        value = self._value(self._index()[key])
+        if isinstance(value, bytes):
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return value
+
+    def __contains__(self, key):
+        return key in self._index()
+
+    def __iter__(self):
+        return iter(self._index())
+
+    def __len__(self):
+        return len(self._index())
+
+
+class VariantList(VariantView, Sequence):
+    __slots__ = ()
+
+    def _index(self):
+        if self._offsets is None:
+            entries, base = self._walk()
+            self._offsets = [(start - base, end - base)
+                             for _, start, end in entries]
+        return self._offsets
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._value(self._index()[index])
+
+    def __len__(self):
+        return len(self._index())
+
+    def __eq__(self, other):
+        if isinstance(other, (list, VariantList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+
+class LazyVariant(Struct):
+    """
+    A Variant that is only decoded as far as it is looked at. Dictionaries
+    and lists come back as VariantDict and VariantList views of the payload;
+    anything else is decoded straight away. Views are built back into
+    exactly the bytes they were parsed from.
+    """
+    @classmethod
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        start = stream.pos
+        if start >= stream.end or stream.buf[start] not in (6, 7):
+            return Variant._parse(stream, ctx)
+        # Finding the end of the Variant means walking its entries anyway,
+        # so note where they are on the way.
+        entries = _index_variant(stream)
+        raw = stream.buf[start:stream.pos]
+        if raw[0] == 6:
+            return VariantList(raw, entries, start)
+        return VariantDict(raw, entries, start)
+
+    @classmethod
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        Variant._build_into(obj, out, ctx)
 
 
 class StringSet(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        l = VLQ.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        l = VLQ._parse(stream, ctx)
         c = []
         for _ in range(l):
-            value = StarString.parse(stream, ctx)
+            value = StarString._parse(stream, ctx)
             if isinstance(value, bytes):
                 try:
                     value = value.decode('utf-8')
@@ -456,12 +999,12 @@ class StringSet(Struct):
 
 class CelestialCoordinates(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        world_x = SBInt32.parse(stream, ctx)
-        world_y = SBInt32.parse(stream, ctx)
-        world_z = SBInt32.parse(stream, ctx)
-        world_planet = SBInt32.parse(stream, ctx)
-        world_satellite = SBInt32.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        world_x = SBInt32._parse(stream, ctx)
+        world_y = SBInt32._parse(stream, ctx)
+        world_z = SBInt32._parse(stream, ctx)
+        world_planet = SBInt32._parse(stream, ctx)
+        world_satellite = SBInt32._parse(stream, ctx)
         return {"x": world_x,
                 "y": world_y,
                 "z": world_z,
@@ -469,71 +1012,65 @@ class CelestialCoordinates(Struct):
                 "satellite": world_satellite}
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        res = b''
-        res += SBInt32.build(obj["world_x"], ctx)
-        res += SBInt32.build(obj["world_y"], ctx)
-        res += SBInt32.build(obj["world_z"], ctx)
-        res += SBInt32.build(obj["world_planet"], ctx)
-        res += SBInt32.build(obj["world_satellite"], ctx)
-        return res
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        out += _coordinates.pack(obj["world_x"], obj["world_y"],
+                                 obj["world_z"], obj["world_planet"],
+                                 obj["world_satellite"])
 
 
 class SystemLocation(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        type = Byte.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        type = Byte._parse(stream, ctx)
         if type == SystemLocationType.SYSTEM:
             d = {"type": type}
         elif type == SystemLocationType.COORDINATE:
-            d = CelestialCoordinates.parse(stream, ctx)
+            d = CelestialCoordinates._parse(stream, ctx)
             d["type"] = type
         elif type == SystemLocationType.ORBIT:
-            d = CelestialCoordinates.parse(stream, ctx)
+            d = CelestialCoordinates._parse(stream, ctx)
             d["type"] = type
-            d["direction"] = SBInt32.parse(stream, ctx)
-            d["enter_time"] = BDouble.parse(stream, ctx)
-            x = BFloat32.parse(stream, ctx)
-            y = BFloat32.parse(stream, ctx)
+            d["direction"] = SBInt32._parse(stream, ctx)
+            d["enter_time"] = BDouble._parse(stream, ctx)
+            x = BFloat32._parse(stream, ctx)
+            y = BFloat32._parse(stream, ctx)
             d["enter_position"] = [x, y]
         elif type == SystemLocationType.UUID:
-            id = UUID.parse(stream, ctx)
+            id = UUID._parse(stream, ctx)
             d = {"type": type, "uuid": id}
         elif type == SystemLocationType.LOCATION:
-            x = BFloat32.parse(stream, ctx)
-            y = BFloat32.parse(stream, ctx)
+            x = BFloat32._parse(stream, ctx)
+            y = BFloat32._parse(stream, ctx)
             d = {"type": type, "location": [x, y]}
         return d
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDict):
-        res = b''
-        res += Byte.build(obj["type"], ctx)
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDict):
+        Byte._build_into(obj["type"], out, ctx)
         if obj["type"] == SystemLocationType.COORDINATE:
-            res += CelestialCoordinates.build(obj, ctx)
+            CelestialCoordinates._build_into(obj, out, ctx)
         elif obj["type"] == SystemLocationType.ORBIT:
-            res += CelestialCoordinates.build(obj, ctx)
-            res += SBInt32.build(obj["direction"], ctx)
-            res += BDouble.build(obj["enter_time"], ctx)
-            res += BFloat32.build(obj["enter_position"][0], ctx)
-            res += BFloat32.build(obj["enter_position"][1], ctx)
+            CelestialCoordinates._build_into(obj, out, ctx)
+            SBInt32._build_into(obj["direction"], out, ctx)
+            BDouble._build_into(obj["enter_time"], out, ctx)
+            BFloat32._build_into(obj["enter_position"][0], out, ctx)
+            BFloat32._build_into(obj["enter_position"][1], out, ctx)
         elif obj["type"] == SystemLocationType.UUID:
-            res += UUID.build(obj["uuid"])
+            UUID._build_into(obj["uuid"], out, ctx)
         elif obj["type"] == SystemLocationType.LOCATION:
-            res += BFloat32.build(obj["location"][0], ctx)
-            res += BFloat32.build(obj["location"][1], ctx)
-        return res
+            BFloat32._build_into(obj["location"][0], out, ctx)
+            BFloat32._build_into(obj["location"][1], out, ctx)
 
 
 class WarpAction(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        warp_type = Byte.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        warp_type = Byte._parse(stream, ctx)
         d = {"warp_type": warp_type}
 
         if warp_type == WarpType.TO_WORLD:
             # warp_type 1
-            world_id = Byte.parse(stream, ctx)
+            world_id = Byte._parse(stream, ctx)
             d["world_id"] = world_id
 
             if world_id == WarpWorldType.CELESTIAL_WORLD:
@@ -542,131 +1079,126 @@ class WarpAction(Struct):
                                                                         ctx)
             elif world_id == WarpWorldType.PLAYER_WORLD:
                 # world_id 2
-                d["ship_id"] = UUID.parse(stream, ctx)
+                d["ship_id"] = UUID._parse(stream, ctx)
             elif world_id == WarpWorldType.UNIQUE_WORLD:
                 # world_id 3
-                d["world_name"] = StarString.parse(stream, ctx)
-                d["is_instance"] = Byte.parse(stream, ctx)
+                d["world_name"] = StarString._parse(stream, ctx)
+                d["is_instance"] = Byte._parse(stream, ctx)
                 if d["is_instance"] == 1:
-                    d["instance_id"] = UUID.parse(stream, ctx)
-                d["has_threatlevel"] = Byte.parse(stream, ctx)
+                    d["instance_id"] = UUID._parse(stream, ctx)
+                d["has_threatlevel"] = Byte._parse(stream, ctx)
                 if d["has_threatlevel"] == 1:
-                    d["threatlevel"] = BFloat32.parse(stream, ctx)
+                    d["threatlevel"] = BFloat32._parse(stream, ctx)
 
-            d["warp_target"] = Byte.parse(stream, ctx)
+            d["warp_target"] = Byte._parse(stream, ctx)
             if d["warp_target"] == SpawnTargetType.ENTITY:
-                d["teleporter"] = StarString.parse(stream, ctx)
+                d["teleporter"] = StarString._parse(stream, ctx)
             elif d["warp_target"] == SpawnTargetType.COORDINATES:
-                d["pos_x"] = UBInt32.parse(stream, ctx)
-                d["pos_y"] = UBInt32.parse(stream, ctx)
+                d["pos_x"] = UBInt32._parse(stream, ctx)
+                d["pos_y"] = UBInt32._parse(stream, ctx)
             elif d["warp_target"] == SpawnTargetType.ASTEROID:
-                d["pos_x"] = BFloat32.parse(stream, ctx)
+                d["pos_x"] = BFloat32._parse(stream, ctx)
 
         elif warp_type == WarpType.TO_PLAYER:
             # warp_type 2
-            d["player_id"] = UUID.parse(stream, ctx)
+            d["player_id"] = UUID._parse(stream, ctx)
 
         elif warp_type == WarpType.TO_ALIAS:
             # warp_type 3
-            d["alias_id"] = SBInt32.parse(stream, ctx)
+            d["alias_id"] = SBInt32._parse(stream, ctx)
 
         return d
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        res = b''
-        res += Byte.build(obj["warp_type"])
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        Byte._build_into(obj["warp_type"], out, ctx)
 
         if obj["warp_type"] == WarpType.TO_WORLD:
-            res += Byte.build(obj["world_id"])
+            Byte._build_into(obj["world_id"], out, ctx)
 
             if obj["world_id"] == WarpWorldType.CELESTIAL_WORLD:
-                res += CelestialCoordinates.build(obj["celestial_coordinates"])
+                CelestialCoordinates._build_into(
+                    obj["celestial_coordinates"], out, ctx)
             elif obj["world_id"] == WarpWorldType.PLAYER_WORLD:
-                res += UUID.build(binascii.unhexlify(obj["ship_id"]))
+                out += binascii.unhexlify(obj["ship_id"])
             elif obj["world_id"] == WarpWorldType.UNIQUE_WORLD:
-                res += StarString.build(obj["world_name"])
-                res += Byte.build(obj["is_instance"])
+                StarString._build_into(obj["world_name"], out, ctx)
+                Byte._build_into(obj["is_instance"], out, ctx)
                 if obj["is_instance"] == 1:
-                    res += UUID.build(binascii.unhexlify(obj["instance_id"]))
-                res += Byte.build(obj["has_threatlevel"])
+                    out += binascii.unhexlify(obj["instance_id"])
+                Byte._build_into(obj["has_threatlevel"], out, ctx)
                 if obj["has_threatlevel"] == 1:
-                    res += BFloat32.build(obj["threatlevel"])
+                    BFloat32._build_into(obj["threatlevel"], out, ctx)
 
-            res += Byte.build(obj["warp_target"])
+            Byte._build_into(obj["warp_target"], out, ctx)
             if obj["warp_target"] == SpawnTargetType.ENTITY:
-                res += StarString.build(obj["teleporter"])
-            elif obj["warp_target"] == SpawnTargetType.COORDINATE:
-                res += UBInt32.build(obj["pos_x"])
-                res += UBInt32.build(obj["pos_y"])
+                StarString._build_into(obj["teleporter"], out, ctx)
+            elif obj["warp_target"] == SpawnTargetType.COORDINATES:
+                UBInt32._build_into(obj["pos_x"], out, ctx)
+                UBInt32._build_into(obj["pos_y"], out, ctx)
             elif obj["warp_target"] == SpawnTargetType.ASTEROID:
-                res += BFloat32.build(obj["pos_x"])
+                BFloat32._build_into(obj["pos_x"], out, ctx)
 
         elif obj["warp_type"] == WarpType.TO_PLAYER:
-            res += UUID.build(binascii.unhexlify(obj["player_id"]))
+            out += binascii.unhexlify(obj["player_id"])
 
         elif obj["warp_type"] == WarpType.TO_ALIAS:
-            res += SBInt32.build(obj["alias_id"])
-
-        return res
+            SBInt32._build_into(obj["alias_id"], out, ctx)
 
 
 class ChatHeader(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        mode = Byte.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        mode = Byte._parse(stream, ctx)
         if mode == 0 or mode == 1:
-            channel = StarString.parse(stream, ctx)
-            client_id = UBInt16.parse(stream, ctx)
+            channel = StarString._parse(stream, ctx)
+            client_id = UBInt16._parse(stream, ctx)
         else:
             channel = ""
-            _ = Byte.parse(stream, ctx)
-            client_id = UBInt16.parse(stream, ctx)
+            _ = Byte._parse(stream, ctx)
+            client_id = UBInt16._parse(stream, ctx)
         return {"mode": mode,
                 "channel": channel,
                 "client_id": client_id}
 
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        res = b''
-        res += Byte.build(obj["mode"])
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        Byte._build_into(obj["mode"], out, ctx)
         if obj["mode"] == 0:
-            res += StarString.build(obj["channel"])
-            res += UBInt16.build(obj["client_id"])
+            StarString._build_into(obj["channel"], out, ctx)
         else:
-            res += Byte.build(0)
-            res += UBInt16.build(obj["client_id"])
-        return res
+            out.append(0)
+        UBInt16._build_into(obj["client_id"], out, ctx)
 
 
 class ClientContextSet(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
         d = {}
-        total_length = VLQ.parse(stream, ctx)
+        total_length = VLQ._parse(stream, ctx)
         d["total_length"] = total_length
         if total_length < 100:
-            sub_length = VLQ.parse(stream, ctx)
-        l = VLQ.parse(stream, ctx)
+            sub_length = VLQ._parse(stream, ctx)
+        l = VLQ._parse(stream, ctx)
         d["number_of_sets"] = l
         for i in range(l):
-            d[i] = Variant.parse(stream, ctx)
+            d[i] = Variant._parse(stream, ctx)
         return d
 
 
 class WorldChunks(Struct):
     @classmethod
-    def _parse(cls, stream: BytesIO, ctx: OrderedDict):
-        l = VLQ.parse(stream, ctx)
+    def _parse(cls, stream: Cursor, ctx: OrderedDict):
+        l = VLQ._parse(stream, ctx)
         d = {}
         c = []
         n = 0
         for _ in range(l):
-            v1 = VLQ.parse(stream, ctx)
-            c1 = stream.read(v1)
-            sep = Byte.parse(stream, ctx)
-            v2 = VLQ.parse(stream, ctx)
-            c2 = stream.read(v2)
+            v1 = VLQ._parse(stream, ctx)
+            c1 = stream.take(v1)
+            sep = Byte._parse(stream, ctx)
+            v2 = VLQ._parse(stream, ctx)
+            c2 = stream.take(v2)
             c.append((n, v1, c1, sep, v2, c2))
             n += 1
         d['length'] = l
@@ -677,32 +1209,29 @@ class WorldChunks(Struct):
 class StatusEffectList(Struct):
     @classmethod
     def _parse(cls, stream, ctx=None):
-        len = VLQ.parse(stream, ctx)
+        len = VLQ._parse(stream, ctx)
         res = []
         for i in range(len):
-            effect = StarString.parse(stream, ctx)
-            type = Byte.parse(stream, ctx)
+            effect = StarString._parse(stream, ctx)
+            type = Byte._parse(stream, ctx)
             if type == 0:
                 res.append(effect)
             elif type == 1:
-                duration = BFloat32.parse(stream, ctx)
+                duration = BFloat32._parse(stream, ctx)
                 res.append({"effect": effect, "duration": duration})
         return res
 
     @classmethod
-    def _build(cls, obj, ctx=None):
-        res = b''
-        len = len(obj)
-        res += VLQ.build(len, ctx)
+    def _build_into(cls, obj, out, ctx=None):
+        VLQ._build_into(len(obj), out, ctx)
         for status in obj:
             if isinstance(status, dict):
-                res += StarString.build(status["effect"], ctx)
-                res += Byte.build(1, ctx)
-                res += BFloat32.build(status["duration"], ctx)
+                StarString._build_into(status["effect"], out, ctx)
+                out.append(1)
+                BFloat32._build_into(status["duration"], out, ctx)
             else:
-                res += StarString.build(status)
-                res += Byte.build(0, ctx)
-        return res
+                StarString._build_into(status, out, ctx)
+                out.append(0)
 
 
 
@@ -723,7 +1252,119 @@ class GreedyArray(Struct):
             return res
 
 
+# Primitives that always take up the same number of bytes, with the format
+# character struct uses for each of them. Runs of these in a declarative
+# struct are read and written with a single precompiled struct.Struct.
+_fixed_formats = {UBInt16: "H", SBInt16: "h", UBInt32: "L", SBInt32: "l",
+                  UBInt64: "Q", SBInt64: "q", BFloat32: "f", BDouble: "d",
+                  Flag: "?", Byte: "B", UUID: "16s"}
+
+
+def _is_leaf(struct, method):
+    """
+    Check whether a struct is a plain primitive, whose _parse/_build can be
+    called directly without going through parse()/build().
+    """
+    return (not struct._struct_fields and
+            getattr(struct, method).__func__ is
+            getattr(Struct, method).__func__)
+
+
+def compile_struct(cls, count=None):
+    """
+    Generate specialized parse and build functions for a declarative struct,
+    in place of walking its fields one by one each time.
+
+    :param cls: Struct class with declared fields.
+    :param count: Only handle this many of the struct's leading fields.
+    :return: Tuple. Parse function taking (stream, ctx), and build function
+             taking (obj, out, ctx) that appends to the bytearray `out`.
+    """
+    namespace = {"hexlify": binascii.hexlify}
+    fields = cls._struct_fields[:count]
+
+    def name_for(prefix, obj):
+        key = "{}{}".format(prefix, len(namespace))
+        namespace[key] = obj
+        return key
+
+    def runs(packable):
+        """
+        Split the fields into runs of fixed-width primitives (for which
+        `packable` is true) and single fields of any other kind.
+        """
+        run = []
+        for name, field in fields:
+            if field in _fixed_formats and packable(field):
+                run.append((name, field))
+                continue
+            if run:
+                yield run
+                run = []
+            yield name, field
+        if run:
+            yield run
+
+    def value(name):
+        return "(obj[{0!r}] if {0!r} in obj else None)".format(name)
+
+    parse = ["def parse(stream, ctx):", "    try:"]
+    for item in runs(lambda field: True):
+        if isinstance(item, list):
+            s = struct.Struct(">" + "".join(_fixed_formats[field]
+                                            for _, field in item))
+            names = ["v{}".format(i) for i in range(len(item))]
+            parse.append(
+                "        {}, = {}.unpack_from(stream.buf, stream.pos)".format(
+                    ", ".join(names), name_for("_s", s)))
+            parse.append("        stream.pos += {}".format(s.size))
+            for (name, field), v in zip(item, names):
+                if field is UUID:
+                    v = "hexlify({})".format(v)
+                parse.append("        ctx[{!r}] = {}".format(name, v))
+        else:
+            name, field = item
+            call = "_parse" if _is_leaf(field, "parse_stream") \
+                else "parse_stream"
+            parse.append("        ctx[{!r}] = {}.{}(stream, ctx)".format(
+                name, name_for("_f", field), call))
+    parse += ["    except:",
+              "        print('Context at time of failure:', ctx)",
+              "        raise",
+              "    return ctx"]
+
+    # UUIDs are handed back hexlified, but built from raw bytes as given, so
+    # they are left to UUID._build_into.
+    build = ["def build(obj, out, ctx):", "    try:"]
+    for item in runs(lambda field: field is not UUID):
+        if isinstance(item, list):
+            s = struct.Struct(">" + "".join(_fixed_formats[field]
+                                            for _, field in item))
+            build.append("        out += {}.pack({})".format(
+                name_for("_s", s),
+                ", ".join(value(name) for name, _ in item)))
+        else:
+            name, field = item
+            if _is_leaf(field, "build"):
+                call = "{}._build_into({}, out, ctx)"
+            elif field.build.__func__ is Struct.build.__func__:
+                call = "{}.build_into({}, out, ctx=ctx)"
+            else:
+                call = "out += {}.build({}, ctx=ctx)"
+            build.append("        " + call.format(name_for("_f", field),
+                                                  value(name)))
+    build += ["    except:",
+              "        print('Context at time of failure:', ctx)",
+              "        raise"]
+
+    source = "\n".join(parse + build) + "\n"
+    exec(compile(source, "<struct {}>".format(cls.__name__), "exec"),
+         namespace)
+    return namespace["parse"], namespace["build"]
+
+
 class SpawnCoordinates(Struct):
+
     x = BFloat32
     y = BFloat32
 
@@ -737,7 +1378,7 @@ class ProtocolRequest(Struct):
 
 
 class ProtocolResponse(Struct):
-    """packet type 1 """
+    """packet type: 1 """
     server_response = Byte
 
 
@@ -791,7 +1432,7 @@ class PlayerWarpResult(Struct):
 
 
 class ClientConnect(Struct):
-    """packet type: 11 """
+    """packet type: 12 """
     asset_digest = StarByteArray
     allow_mismatch = Flag
     uuid = UUID
@@ -810,18 +1451,18 @@ class ClientConnect(Struct):
 
 
 class ClientDisconnectRequest(Struct):
-    """packet type: 12 """
+    """packet type: 13 """
     request = Byte
 
 
 class PlayerWarp(Struct):
-    """packet type: 14 """
+    """packet type: 15 """
     warp_action = WarpAction
     deploy = Flag
 
 
 class FlyShip(Struct):
-    """packet type: 15 """
+    """packet type: 16 """
     world_x = SBInt32
     world_y = SBInt32
     world_z = SBInt32
@@ -829,20 +1470,20 @@ class FlyShip(Struct):
 
 
 class ChatSent(Struct):
-    """packet type: 16 """
+    """packet type: 17 """
     message = StarString
     send_mode = Byte
 
 
 class ClientContextUpdate(Struct):
-    """packet type: 18 """
+    """packet type: 19 """
     contexts = ClientContextSet
     # Incomplete implementation
 
 
 class WorldStart(Struct):
-    """packet type: 19 """
-    template_data = Variant
+    """packet type: 20 """
+    template_data = LazyVariant
     sky_data = StarByteArray
     weather_data = StarByteArray
     spawn = SpawnCoordinates
@@ -851,19 +1492,19 @@ class WorldStart(Struct):
     dungeon_id_gravity = Byte
     dungeon_id_breathable = Byte
     protected_dungeon_ids = Byte
-    world_properties = Variant
+    world_properties = LazyVariant
     client_id = UBInt16
     local_interpolation = Flag
     # Incomplete implementation
 
 
 class WorldStop(Struct):
-    """packet type: 20 """
+    """packet type: 21 """
     reason = StarString
 
 
 class GiveItem(Struct):
-    """packet type: 29 """
+    """packet type: 30 """
     name = StarString
     count = VLQ
     variant_type = Byte
@@ -871,7 +1512,7 @@ class GiveItem(Struct):
 
 
 class EntityInteractResult(Struct):
-    """packet type: 31 """
+    """packet type: 50 """
     interaction_type = UBInt32
     target_id = UBInt32
     entity_data = Variant
@@ -879,13 +1520,13 @@ class EntityInteractResult(Struct):
 
 
 class ModifyTileList(Struct):
-    """packet type: 35 """
+    """packet type: 37 """
     brush_size = VLQ
     # Incomplete implementation
 
 
 class SpawnEntity(Struct):
-    """packet type: 39 """
+    """packet type: 41 """
     spawn_type = Byte
     payload_size = VLQ
     payload = StarString
@@ -894,7 +1535,7 @@ class SpawnEntity(Struct):
 
 
 class EntityInteract(Struct):
-    """packet type: 40 """
+    """packet type: 49 """
     source_id = UBInt32
     source_x = BFloat32
     source_y = BFloat32
@@ -905,7 +1546,7 @@ class EntityInteract(Struct):
 
 
 class EntityCreate(Struct):
-    """packet type: 45"""
+    """packet type: 46 """
     entity_type = Byte
     store_data = StarByteArray
     first_net_state = StarByteArray
@@ -940,75 +1581,196 @@ class DamageNotification(Struct):
 
 
 class EntityMessage(Struct):
-    """packet type: 51"""
+    """packet type: 54 """
+    _head = frozenset(['target_unique', 'unique_id', 'target_id',
+                       'message_name'])
+
     @classmethod
     def _parse(cls, stream, ctx=None):
+        res = cls._parse_head(stream, ctx)
+        res['message_args'] = VariantVariant._parse(stream, ctx)
+        res['message_uuid'] = UUID._parse(stream, ctx)
+        res['client_id'] = UBInt16._parse(stream, ctx) # 0 when message is
+        # sent to or from server, client id of sender when sent to other client
+        return res
+
+    @classmethod
+    def _parse_head(cls, stream, ctx=None):
+        """
+        Parse who a message is for and what it is called, which is as much
+        as most hooks need, without the arguments that follow.
+        """
         res = {}
-        res['target_unique'] = Flag.parse(stream, ctx)
+        res['target_unique'] = Flag._parse(stream, ctx)
         if res['target_unique']:
-            res['unique_id'] = StarString.parse(stream, ctx)
+            res['unique_id'] = StarString._parse(stream, ctx)
         else:
-            res['target_id'] = SBInt32.parse(stream, ctx)
-        res['message_name'] = StarString.parse(stream, ctx)
-        res['message_args'] = VariantVariant.parse(stream, ctx)
-        res['message_uuid'] = UUID.parse(stream, ctx)
-        res['client_id'] = UBInt16.parse(stream, ctx) # 0 when message is
-        # sent to or from server, client id of sender when sent to other client
+            res['target_id'] = SBInt32._parse(stream, ctx)
+        res['message_name'] = StarString._parse(stream, ctx)
         return res
 
-    def _build(cls, obj, ctx=None):
-        res = b''
-        res += Flag.build(obj['target_unique'])
+    @classmethod
+    def _partial_parser(cls, fields):
+        if fields <= cls._head:
+            return cls._parse_head
+        return None
+
+    @classmethod
+    def _build_into(cls, obj, out, ctx=None):
+        Flag._build_into(obj['target_unique'], out, ctx)
         if obj['target_unique']:
-            res += StarString.build(obj['unique_id'])
+            StarString._build_into(obj['unique_id'], out, ctx)
         else:
-            res += SBInt32.build(obj['target_id'])
-        res += StarString.build(obj['message_name'])
-        res += VariantVariant.build(obj['message_args'])
-        res += UUID.build(obj['message_uuid'])
-        res += UBInt16.build(obj['connection_id'])
-        return res
+            SBInt32._build_into(obj['target_id'], out, ctx)
+        StarString._build_into(obj['message_name'], out, ctx)
+        VariantVariant._build_into(obj['message_args'], out, ctx)
+        out += binascii.unhexlify(obj['message_uuid'])
+        UBInt16._build_into(obj['client_id'], out, ctx)
 
 
 class EntityMessageResponse(Struct):
     @classmethod
     def _parse(cls, stream, ctx=None):
         res = {}
-        res['success_level'] = Byte.parse(stream, ctx) # 1 is a failure, 2 is a success
+        res['success_level'] = Byte._parse(stream, ctx) # 1 is a failure, 2 is a success
         if res['success_level'] == 1:
-            res['error'] = StarString.parse(stream, ctx)
+            res['error'] = StarString._parse(stream, ctx)
         else:
-            res['result'] = Variant.parse(stream, ctx)
-        res['message_uuid'] = UUID.parse(stream, ctx)
+            res['result'] = Variant._parse(stream, ctx)
+        res['message_uuid'] = UUID._parse(stream, ctx)
         return res
 
     @classmethod
-    def _build(cls, obj, ctx=None):
-        res = b''
-        res += Byte.build(obj['success_level'])
+    def _build_into(cls, obj, out, ctx=None):
+        Byte._build_into(obj['success_level'], out, ctx)
         if obj['success_level'] == 1:
-            res += StarString.build(obj['error'])
+            StarString._build_into(obj['error'], out, ctx)
         else:
-            res += Variant.build(obj['result'])
-        res += obj['message_uuid']
-        return res
+            Variant._build_into(obj['result'], out, ctx)
+        out += binascii.unhexlify(obj['message_uuid'])
 
 class StepUpdate(Struct):
-    """packet type: 54"""
+    """packet type: 57 """
     heartbeat = VLQ
 
 
 
 class BasePacket(Struct):
     @classmethod
-    def _build(cls, obj, ctx: OrderedDotDict):
-        res = b''
-        res += Byte.build(obj['id'], ctx)
-        v = len(obj['data'])
-        if 'compressed' in ctx and ctx['compressed']:
-            v = -abs(v)
-        res += SignedVLQ.build(v)
-        if not isinstance(obj['data'], bytes):
+    def _build_into(cls, obj, out: bytearray, ctx: OrderedDotDict):
+        if isinstance(obj['data'], str):
             obj['data'] = bytes(obj['data'].encode("utf-8"))
-        res += obj['data']
-        return res
+        data, compressed = obj['data'], obj.get('compressed')
+        if compressed is not False:
+            data, compressed = compress_payload(data, compressed)
+        Byte._build_into(obj['id'], out, ctx)
+        SignedVLQ._build_into(-len(data) if compressed else len(data), out,
+                              ctx)
+        out += data
+
+
+#
+## Compiled codec
+#
+
+logger = logging.getLogger("starrypy.data_parser")
+
+# Version of c_parser.pyx this module expects; a build of an older version
+# is ignored rather than trusted.
+C_PARSER_VERSION = 4
+
+# Structs with a compiled counterpart, and the suffix of its parse_* function
+# and build_* builder in c_parser.
+_c_codec = {
+    VLQ: "vlq",
+    SignedVLQ: "svlq",
+    UBInt16: "uint16",
+    SBInt16: "sint16",
+    UBInt32: "uint32",
+    SBInt32: "sint32",
+    UBInt64: "uint64",
+    SBInt64: "sint64",
+    BFloat32: "float32",
+    BDouble: "double",
+    Flag: "flag",
+    Byte: "byte",
+    UUID: "uuid",
+    StarByteArray: "starbytearray",
+    StarString: "starstring",
+    Variant: "variant",
+    VariantVariant: "variant_variant",
+    DictVariant: "dict_variant",
+    StringSet: "string_set",
+    CelestialCoordinates: "celestial_coordinates",
+    SystemLocation: "system_location",
+    WarpAction: "warp_action",
+    ChatHeader: "chat_header",
+    ClientContextSet: "client_context_set",
+    WorldChunks: "world_chunks",
+    StatusEffectList: "status_effect_list",
+    EntityMessage: "entity_message",
+    EntityMessageResponse: "entity_message_response"
+}
+
+# Declarative structs parsed in one go by c_parser, in place of the function
+# compile_struct() generates.
+_c_structs = {
+    ClientConnect: "client_connect"
+}
+
+# The pure Python methods that the compiled ones stand in for.
+_py_codec = {(cls, method): cls.__dict__.get(method)
+             for cls in _c_codec
+             for method in ("_parse", "_build", "_build_into")}
+
+use_c_parser = False
+
+
+def enable_c_parser(enabled=True):
+    """
+    Switch the structs in _c_codec between c_parser and their pure Python
+    implementations. Both produce the same results; the compiled codec is
+    only used if it has been built, and is the version this module expects.
+
+    :param enabled: Boolean. Whether to use the compiled codec if possible.
+    :return: Boolean. Whether the compiled codec is now in use.
+    """
+    global use_c_parser, _skip_variant, _index_variant
+    if enabled and c_parser is None:
+        enabled = False
+    elif enabled and getattr(c_parser, "VERSION", None) != C_PARSER_VERSION:
+        logger.warning("Ignoring c_parser, as it was built from an older "
+                       "version of c_parser.pyx. Rebuild it with "
+                       "'python build_parser.py build_ext --inplace'.")
+        enabled = False
+    for cls, name in _c_codec.items():
+        methods = {}
+        if enabled:
+            methods["_parse"] = getattr(c_parser, "parse_" + name)
+            if _py_codec[cls, "_build_into"] is not None:
+                builder = getattr(c_parser, "build_" + name)
+                methods["_build"] = builder
+                methods["_build_into"] = builder.into
+        for method in ("_parse", "_build", "_build_into"):
+            if method in methods:
+                setattr(cls, method, staticmethod(methods[method]))
+            elif _py_codec[cls, method] is not None:
+                setattr(cls, method, _py_codec[cls, method])
+            elif method in cls.__dict__:
+                delattr(cls, method)
+    for cls, name in _c_structs.items():
+        cls._compiled = compile_struct(cls)
+        if enabled:
+            cls._compiled = (getattr(c_parser, "parse_" + name),
+                             cls._compiled[1])
+    if enabled:
+        _skip_variant = c_parser.skip_variant
+        _index_variant = c_parser.index_variant
+    else:
+        _skip_variant = _py_skip_variant
+        _index_variant = _py_index_variant
+    use_c_parser = enabled
+    return enabled
+
+
+enable_c_parser()
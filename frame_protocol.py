@@ -0,0 +1,319 @@
+"""
+StarryPy Frame Protocol
+
+Provides an alternative connection core for the proxy, built on
+asyncio.Protocol rather than on streams. Incoming bytes are split into frames
+in place; runs of frames no plugin is interested in are forwarded to the
+other side of the connection as memoryview slices of the received data,
+without ever being copied into a packet.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+from utilities import decode_frame_header
+
+logger = logging.getLogger("starrypy.frame_protocol")
+
+
+class FrameProtocol(asyncio.Protocol):
+    """
+    One side (client or upstream server) of a proxied connection.
+
+    Acts as both the reader and the writer for its side: frames read off of
+    this side are handed out by read_frame(), while write()/drain() send
+    data out to this side. Frames that need to be looked at are queued in
+    order; anything that arrives while nothing is queued or being processed,
+    and that no plugin hooks, goes directly to the peer protocol. If such a
+    frame is at least `cut_through_size` bytes long, it is passed on piece by
+    piece as it arrives, without waiting for the rest of it; `output` must
+    then be an OutputScheduler.
+
+    Once `max_queued` frames are queued, reading from this side stops until
+    the queue has drained to half of that (the "pipeline_queue_size"
+    setting). The same counters as PacketPipeline keeps are kept here, so
+    that stats() reports alike for either transport.
+    """
+    def __init__(self, is_hooked, *, max_queued, cut_through_size=0,
+                 on_connection_made=None):
+        self.transport = None
+        self.peer = None
+        self.output = None
+        self._loop = asyncio.get_event_loop()
+        self._is_hooked = is_hooked
+        self._on_connection_made = on_connection_made
+        self._max_queued = max_queued
+        self._cut_through_size = cut_through_size
+        self._cutting = 0
+        self._buffer = bytearray()
+        self._frames = collections.deque()
+        self._holding = False
+        self._read_waiter = None
+        self._drain_waiters = collections.deque()
+        self._pause_reasons = set()
+        self._write_paused = False
+        self._closed = False
+        self._stalled_since = None
+        self.max_depth = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.queued = 0
+        self.forwarded = 0
+        self.streamed = 0
+
+    @property
+    def depth(self):
+        """
+        Number of frames waiting for the plugin stage.
+        """
+        return len(self._frames)
+
+    def stats(self):
+        """
+        Snapshot of the frame queue's counters, in the same shape as
+        PacketPipeline.stats().
+
+        :return: Dictionary.
+        """
+        stall_time = self.stall_time
+        if self._stalled_since is not None:
+            stall_time += time.monotonic() - self._stalled_since
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "stalls": self.stalls,
+                "stall_time": stall_time,
+                "queued": self.queued,
+                "forwarded": self.forwarded,
+                "streamed": self.streamed}
+
+    def pair(self, peer):
+        """
+        Connect this protocol with the protocol for the other side of the
+        connection, so that frames can be forwarded between them. Forwarded
+        frames are written to `output`, which defaults to the peer itself.
+
+        :param peer: FrameProtocol for the other side.
+        :return: Null.
+        """
+        self.peer = peer
+        peer.peer = self
+        self.output = peer
+        peer.output = self
+
+    # asyncio.Protocol interface
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._on_connection_made is not None:
+            self._on_connection_made(self)
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._wake_reader()
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("Connection lost"))
+        if self.peer is not None:
+            self.peer._resume_reading("peer_write")
+
+    def data_received(self, data):
+        if self._cutting:
+            # Still in the middle of a frame being cut through.
+            view = memoryview(data)
+            taken = min(self._cutting, len(data))
+            self.output.write_cut_through(view[:taken])
+            self._cutting -= taken
+            if self._cutting:
+                return
+            self.output.end_cut_through()
+            if taken == len(data):
+                return
+            data = bytes(view[taken:])
+        if self._buffer:
+            # Only flatten the carried-over bytes once they hold at least one
+            # complete frame (or the start of one to cut through); large
+            # frames arrive over many reads.
+            self._buffer.extend(data)
+            header = decode_frame_header(self._buffer)
+            if header is None or \
+                    (len(self._buffer) < header[2] + abs(header[1]) and
+                     not self._can_cut_through(header[0], header[1])):
+                return
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        view = memoryview(data)
+        end = len(data)
+        offset = 0
+        run_start = None
+        while True:
+            header = decode_frame_header(data, offset)
+            if header is None:
+                break
+            packet_type, packet_size, header_length = header
+            frame_end = offset + header_length + abs(packet_size)
+            if frame_end > end:
+                if self._can_cut_through(packet_type, packet_size):
+                    if run_start is not None:
+                        self.output.write(view[run_start:offset])
+                        run_start = None
+                    self.streamed += 1
+                    self.output.begin_cut_through()
+                    self.output.write_cut_through(view[offset:])
+                    self._cutting = frame_end - end
+                    offset = end
+                break
+            if self._can_forward(packet_type):
+                self.forwarded += 1
+                if run_start is None:
+                    run_start = offset
+            else:
+                if run_start is not None:
+                    self.output.write(view[run_start:offset])
+                    run_start = None
+                self._frames.append((packet_type, packet_size,
+                                     data[offset:frame_end], header_length))
+                self.queued += 1
+            offset = frame_end
+        if run_start is not None:
+            self.output.write(view[run_start:offset])
+        if offset < end:
+            self._buffer.extend(view[offset:])
+        if self._frames:
+            self._wake_reader()
+            depth = len(self._frames)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            if depth >= self._max_queued and self._stalled_since is None:
+                self.stalls += 1
+                self._stalled_since = time.monotonic()
+                self._pause_reading("queue")
+
+    def eof_received(self):
+        self._closed = True
+        self._wake_reader()
+
+    def pause_writing(self):
+        self._write_paused = True
+        if self.peer is not None:
+            self.peer._pause_reading("peer_write")
+
+    def resume_writing(self):
+        self._write_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        if self.peer is not None:
+            self.peer._resume_reading("peer_write")
+
+    # Reader interface
+
+    @asyncio.coroutine
+    def read_frame(self):
+        """
+        Hand out the next frame that needs to be looked at, in the same
+        format utilities.read_frame uses. Until the next call, the frame
+        handed out counts as in flight, so nothing can overtake it.
+
+        :return: Tuple. Packet type, signed packet size, raw frame bytes and
+                 header length.
+        """
+        self._holding = False
+        while not self._frames:
+            if self._closed:
+                raise asyncio.IncompleteReadError(bytes(self._buffer), None)
+            self._read_waiter = self._loop.create_future()
+            try:
+                yield from self._read_waiter
+            finally:
+                self._read_waiter = None
+        frame = self._frames.popleft()
+        self._holding = True
+        if self._stalled_since is not None and \
+                len(self._frames) <= self._max_queued // 2:
+            self.stall_time += time.monotonic() - self._stalled_since
+            self._stalled_since = None
+            self._resume_reading("queue")
+        return frame
+
+    def buffered(self):
+        """
+        Count the bytes received from this side that have not been read yet.
+
+        :return: Integer.
+        """
+        return len(self._buffer) + sum(len(frame[2]) for frame in self._frames)
+
+    def at_eof(self):
+        """
+        Check whether this side has closed and every frame has been read.
+
+        :return: Boolean.
+        """
+        return self._closed and not self._frames
+
+    # Writer interface
+
+    def write(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def writelines(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.writelines(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        if self._closed:
+            raise ConnectionResetError("Connection lost")
+        if self._write_paused:
+            # Anything may be draining this side: the plugin stage as well
+            # as messages and broadcasts sent from elsewhere.
+            waiter = self._loop.create_future()
+            self._drain_waiters.append(waiter)
+            try:
+                yield from waiter
+            finally:
+                self._drain_waiters.remove(waiter)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    # Internals
+
+    def _can_forward(self, packet_type):
+        """
+        A frame can skip the queue only if nobody hooks it, there is
+        somewhere to send it to, and no earlier frame is still waiting to be sent.
+        """
+        return (self.output is not None and
+                not self._frames and
+                not self._holding and
+                not self._is_hooked(packet_type))
+
+    def _can_cut_through(self, packet_type, packet_size):
+        return (self._cut_through_size > 0 and
+                abs(packet_size) >= self._cut_through_size and
+                self._can_forward(packet_type))
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    def _pause_reading(self, reason):
+        if not self._pause_reasons and self.transport is not None:
+            self.transport.pause_reading()
+        self._pause_reasons.add(reason)
+
+    def _resume_reading(self, reason):
+        if reason not in self._pause_reasons:
+            return
+        self._pause_reasons.discard(reason)
+        if not self._pause_reasons and self.transport is not None \
+                and not self.transport.is_closing():
+            self.transport.resume_reading()
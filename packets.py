@@ -1,69 +1,120 @@
-from utilities import BiDict
+from collections import namedtuple
 
-packets = BiDict({
-    'protocol_request': 0,
-    'protocol_response': 1,
-    'server_disconnect': 2,
-    'connect_success': 3,
-    'connect_failure': 4,
-    'handshake_challenge': 5,
-    'chat_received': 6,
-    'universe_time_update': 7,
-    'celestial_response': 8,
-    'player_warp_result': 9,
-    'planet_type_update': 10,
-    'pause': 11,
-    'client_connect': 12,
-    'client_disconnect_request': 13,
-    'handshake_response': 14,
-    'player_warp': 15,
-    'fly_ship': 16,
-    'chat_sent': 17,
-    'celestial_request': 18,
-    'client_context_update': 19,
-    'world_start': 20,
-    'world_stop': 21,
-    'world_layout_update': 22,
-    'world_parameters_update': 23,
-    'central_structure_update': 24,
-    'tile_array_update': 25,
-    'tile_update': 26,
-    'tile_liquid_update': 27,
-    'tile_damage_update': 28,
-    'tile_modification_failure': 29,
-    'give_item': 30,
-    'environment_update': 31,
-    'update_tile_protection': 32,
-    'set_dungeon_gravity': 33,
-    'set_dungeon_breathable': 34,
-    'set_player_start': 35,
-    'find_unique_entity_response': 36,
-    'modify_tile_list': 37,
-    'damage_tile_group': 38,
-    'collect_liquid': 39,
-    'request_drop': 40,
-    'spawn_entity': 41,
-    'connect_wire': 42,
-    'disconnect_all_wires': 43,
-    'world_client_state_update': 44,
-    'find_unique_entity': 45,
-    'entity_create': 46,
-    'entity_update': 47,
-    'entity_destroy': 48,
-    'entity_interact': 49,
-    'entity_interact_result': 50,
-    'hit_request': 51,
-    'damage_request': 52,
-    'damage_notification': 53,
-    'entity_message': 54,
-    'entity_message_response': 55,
-    'update_world_properties': 56,
-    'step_update': 57,
-    'system_world_start': 58,
-    'system_world_update': 59,
-    'system_object_create': 60,
-    'system_object_destroy': 61,
-    'system_ship_create': 62,
-    'system_ship_destroy': 63,
-    'system_object_spawn': 64})
+from data_parser import *
+from utilities import BiDict, Direction, ParsePolicy
 
+PacketType = namedtuple("PacketType", ["id", "name", "struct", "direction",
+                                       "size", "policy", "cached"])
+PacketType.__doc__ = """
+Everything the proxy knows about one type of packet.
+
+    id: Integer ID of the packet, as sent on the wire.
+    name: Name of the packet; hooks on it are called on_<name>.
+    struct: Struct its payload is parsed with, or None if it isn't parsed.
+    direction: Direction the packet is sent in, or None if it goes both ways.
+    size: Typical size of its payload, in bytes.
+    policy: When its payload is parsed (see below).
+    cached: Whether its parsed form is worth keeping in the packet cache.
+
+Parse policies:
+
+    NEVER: Not parsed; hooks get an empty parsed form.
+    LAZY: Parsed the first time a hook looks at data["parsed"], so packets
+          that every hook passes over without reading are never parsed.
+    EAGER: Parsed before the hooks are called.
+    OFFLOAD: Parsed before the hooks are called, on the parse thread pool
+             if at least "parse_offload_size" bytes long.
+"""
+
+_C = Direction.TO_CLIENT
+_S = Direction.TO_SERVER
+_NEVER = ParsePolicy.NEVER
+_LAZY = ParsePolicy.LAZY
+_EAGER = ParsePolicy.EAGER
+_OFFLOAD = ParsePolicy.OFFLOAD
+
+# Packets that carry a fresh nonce, UUID or client ID every time they are
+# sent are never seen twice, and aren't cached; caching them only pushes out
+# packets that are.
+_packet_types = [
+    # id, name, struct, direction, size, policy, cached
+    (0, 'protocol_request', ProtocolRequest, _S, 4, _EAGER, True),
+    (1, 'protocol_response', ProtocolResponse, _C, 16, _EAGER, True),
+    (2, 'server_disconnect', ServerDisconnect, _C, 32, _EAGER, True),
+    (3, 'connect_success', ConnectSuccess, _C, 96, _EAGER, False),
+    (4, 'connect_failure', ConnectFailure, _C, 64, _EAGER, True),
+    (5, 'handshake_challenge', HandshakeChallenge, _C, 64, _EAGER, False),
+    (6, 'chat_received', ChatReceived, _C, 96, _EAGER, True),
+    (7, 'universe_time_update', None, _C, 8, _NEVER, True),
+    (8, 'celestial_response', None, _C, 4096, _NEVER, True),
+    (9, 'player_warp_result', PlayerWarpResult, _C, 32, _EAGER, True),
+    (10, 'planet_type_update', None, _C, 32, _NEVER, True),
+    (11, 'pause', None, _C, 1, _NEVER, True),
+    (12, 'client_connect', ClientConnect, _S, 262144, _OFFLOAD, False),
+    (13, 'client_disconnect_request', ClientDisconnectRequest, _S, 1,
+     _EAGER, True),
+    (14, 'handshake_response', None, _S, 64, _NEVER, True),
+    (15, 'player_warp', PlayerWarp, _S, 32, _EAGER, True),
+    (16, 'fly_ship', FlyShip, _S, 32, _EAGER, True),
+    (17, 'chat_sent', ChatSent, _S, 64, _EAGER, True),
+    (18, 'celestial_request', None, _S, 64, _NEVER, True),
+    (19, 'client_context_update', ClientContextUpdate, None, 256, _LAZY,
+     True),
+    (20, 'world_start', WorldStart, _C, 131072, _OFFLOAD, False),
+    (21, 'world_stop', WorldStop, _C, 16, _EAGER, True),
+    (22, 'world_layout_update', None, _C, 4096, _NEVER, True),
+    (23, 'world_parameters_update', None, _C, 1024, _NEVER, True),
+    (24, 'central_structure_update', None, _C, 4096, _NEVER, True),
+    (25, 'tile_array_update', None, _C, 8192, _NEVER, True),
+    (26, 'tile_update', None, _C, 32, _NEVER, True),
+    (27, 'tile_liquid_update', None, _C, 16, _NEVER, True),
+    (28, 'tile_damage_update', None, _C, 32, _NEVER, True),
+    (29, 'tile_modification_failure', None, _C, 64, _NEVER, True),
+    (30, 'give_item', GiveItem, _C, 64, _EAGER, True),
+    (31, 'environment_update', None, _C, 1024, _NEVER, True),
+    (32, 'update_tile_protection', None, _C, 8, _NEVER, True),
+    (33, 'set_dungeon_gravity', None, _C, 8, _NEVER, True),
+    (34, 'set_dungeon_breathable', None, _C, 8, _NEVER, True),
+    (35, 'set_player_start', None, _C, 16, _NEVER, True),
+    (36, 'find_unique_entity_response', None, _C, 32, _NEVER, True),
+    (37, 'modify_tile_list', ModifyTileList, _S, 64, _LAZY, True),
+    (38, 'damage_tile_group', None, _S, 64, _NEVER, True),
+    (39, 'collect_liquid', None, _S, 32, _NEVER, True),
+    (40, 'request_drop', None, _S, 8, _NEVER, True),
+    (41, 'spawn_entity', SpawnEntity, _S, 512, _LAZY, True),
+    (42, 'connect_wire', None, _S, 32, _NEVER, True),
+    (43, 'disconnect_all_wires', None, _S, 16, _NEVER, True),
+    (44, 'world_client_state_update', None, _S, 64, _NEVER, True),
+    (45, 'find_unique_entity', None, _S, 32, _NEVER, True),
+    (46, 'entity_create', EntityCreate, None, 1024, _LAZY, True),
+    (47, 'entity_update', None, None, 256, _NEVER, True),
+    (48, 'entity_destroy', None, None, 16, _NEVER, True),
+    (49, 'entity_interact', EntityInteract, None, 40, _EAGER, True),
+    (50, 'entity_interact_result', EntityInteractResult, None, 256, _LAZY,
+     True),
+    (51, 'hit_request', None, None, 128, _NEVER, True),
+    (52, 'damage_request', DamageRequest, None, 256, _LAZY, True),
+    (53, 'damage_notification', DamageNotification, None, 256, _LAZY, True),
+    (54, 'entity_message', EntityMessage, None, 256, _LAZY, False),
+    (55, 'entity_message_response', EntityMessageResponse, None, 64, _LAZY,
+     False),
+    (56, 'update_world_properties', DictVariant, None, 128, _LAZY, True),
+    (57, 'step_update', StepUpdate, None, 2, _EAGER, True),
+    (58, 'system_world_start', None, _C, 2048, _NEVER, True),
+    (59, 'system_world_update', None, _C, 256, _NEVER, True),
+    (60, 'system_object_create', None, _C, 256, _NEVER, True),
+    (61, 'system_object_destroy', None, _C, 16, _NEVER, True),
+    (62, 'system_ship_create', None, _C, 128, _NEVER, True),
+    (63, 'system_ship_destroy', None, _C, 16, _NEVER, True),
+    (64, 'system_object_spawn', None, _S, 128, _NEVER, True)]
+
+# Indexed by packet ID. Covers every ID a packet header can carry, so a
+# lookup never fails; IDs the protocol doesn't use are never parsed.
+registry = tuple(
+    PacketType(*_packet_types[packet_id]) if packet_id < len(_packet_types)
+    else PacketType(packet_id, "unknown_{}".format(packet_id), None, None, 0,
+                    _NEVER, False)
+    for packet_id in range(256))
+
+packets = BiDict({info.name: info.id
+                  for info in registry[:len(_packet_types)]})
@@ -0,0 +1,141 @@
+"""
+StarryPy Packet Pipeline
+
+Splits one direction of a proxied connection into stages, so that a slow
+plugin hook does not hold up reading and decoding of the frames behind it.
+The reader stage pulls frames off the wire and hands them to the plugin
+stage through a bounded queue; the plugin stage runs the hooks and passes
+the results on to the connection's output scheduler, which acts as the
+writer stage.
+"""
+
+import asyncio
+import logging
+import time
+
+from utilities import cut_through
+
+logger = logging.getLogger("starrypy.pipeline")
+
+
+class PacketPipeline:
+    """
+    Reader and plugin stages for one direction of a connection.
+
+    Frames always leave in the order they arrived. While nothing is queued
+    or being worked on, frames nobody hooks are written out by the reader
+    stage directly, without going through the queue at all; those of at
+    least `cut_through_size` bytes are passed on piece by piece as they
+    arrive, rather than being read in whole first.
+    """
+    def __init__(self, connection, reader, output, direction, maxsize=256,
+                 cut_through_size=0):
+        self.connection = connection
+        self.direction = direction
+        self._reader = reader
+        self._output = output
+        self._queue = asyncio.Queue(maxsize)
+        self._in_flight = 0
+        self.cut_through_size = cut_through_size
+        self.max_depth = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.queued = 0
+        self.forwarded = 0
+        self.streamed = 0
+
+    @property
+    def depth(self):
+        """
+        Number of frames waiting for the plugin stage.
+        """
+        return self._queue.qsize()
+
+    def stats(self):
+        """
+        Snapshot of the pipeline's counters.
+
+        :return: Dictionary.
+        """
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "stalls": self.stalls,
+                "stall_time": self.stall_time,
+                "queued": self.queued,
+                "forwarded": self.forwarded,
+                "streamed": self.streamed}
+
+    @asyncio.coroutine
+    def run(self):
+        """
+        Run both stages until the reader stage runs out of frames. Anything
+        already queued is still handed to the plugins before returning.
+
+        :return: Null.
+        """
+        plugin_stage = asyncio.ensure_future(self._plugin_stage())
+        try:
+            try:
+                yield from self._reader_stage()
+            except asyncio.IncompleteReadError:
+                yield from self._queue.put(None)
+                yield from plugin_stage
+                raise
+        finally:
+            if not plugin_stage.done():
+                plugin_stage.cancel()
+
+    @asyncio.coroutine
+    def _reader_stage(self):
+        connection = self.connection
+        queue = self._queue
+        offer = self._cut_through if self.cut_through_size > 0 else None
+        while True:
+            frame = yield from connection.read_frame(self._reader, offer)
+            if frame is None:
+                continue
+            if self._in_flight == 0 and \
+                    not connection.is_hooked(frame[0], self.direction):
+                self.forwarded += 1
+                self._output.write(frame[2])
+                yield from self._output.drain()
+                continue
+            self._in_flight += 1
+            self.queued += 1
+            if queue.full():
+                self.stalls += 1
+                start = time.monotonic()
+                yield from queue.put(frame)
+                self.stall_time += time.monotonic() - start
+            else:
+                queue.put_nowait(frame)
+            depth = queue.qsize()
+            if depth > self.max_depth:
+                self.max_depth = depth
+
+    @asyncio.coroutine
+    def _cut_through(self, packet_type, packet_size, head, remaining):
+        if self._in_flight or abs(packet_size) < self.cut_through_size or \
+                self.connection.is_hooked(packet_type, self.direction):
+            return False
+        self.streamed += 1
+        yield from cut_through(self._reader, self._output, remaining, head)
+        return True
+
+    @asyncio.coroutine
+    def _plugin_stage(self):
+        connection = self.connection
+        queue = self._queue
+        while True:
+            frame = yield from queue.get()
+            if frame is None:
+                return
+            try:
+                yield from connection.handle_frame(frame, self.direction)
+            except Exception as err:
+                logger.error("Plugin stage exception occurred:"
+                             "{}: {}".format(err.__class__.__name__, err))
+                connection.die()
+                return
+            finally:
+                self._in_flight -= 1
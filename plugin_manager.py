@@ -7,8 +7,9 @@ from types import ModuleType
 
 from base_plugin import BasePlugin
 from configuration_manager import ConfigurationManager
+from packets import registry
 from pparser import PacketParser
-from utilities import detect_overrides
+from utilities import detect_overrides, Direction
 
 
 class PluginManager:
@@ -24,6 +25,17 @@ class PluginManager:
         self._resolved = False
         self._overrides = set()
         self._override_cache = set()
+        # Indexed by packet type. Until the overrides have been detected,
+        # assume every packet type is of interest to someone.
+        self.hooked_types = (True,) * 256
+        # Indexed by direction, then packet type.
+        self.hooked_directions = (self.hooked_types,) * len(Direction)
+        # Indexed by direction, then action. Fields of the parsed packet the
+        # hooks on it read, or None if they need all of them.
+        self.hook_fields = ({},) * len(Direction)
+        # Indexed by direction, then packet type. Hooks that plugins
+        # override, as built by _build_hooks.
+        self._hooks = ((None,) * 256,) * len(Direction)
         self._packet_parser = PacketParser(self.config)
         self._factory = factory
         self.logger = logging.getLogger("starrypy.plugin_manager")
@@ -34,19 +46,32 @@ class PluginManager:
     @asyncio.coroutine
     def do(self, connection, action: str, packet: dict):
         """
-        Calls an action on all loaded plugins.
+        Calls an action on all loaded plugins that hook it. Filter hooks are
+        called in order of priority, until one of them drops the packet.
+        Observer hooks are called after that; those that opted in with
+        utilities.observer see dropped packets too.
         """
         try:
-            if ("on_%s" % action) in self._overrides:
-                packet = yield from self._packet_parser.parse(packet)
-                send_flag = True
-                for plugin in self._plugins.values():
-                    p = getattr(plugin, "on_%s" % action)
-                    if not (yield from p(packet, connection)):
-                        send_flag = False
-                return send_flag
-            else:
+            direction = packet["direction"]
+            hooks = self._hooks[direction][packet["type"]]
+            if hooks is None:
                 return True
+            filters, observers = hooks
+            packet = yield from self._packet_parser.parse(
+                packet, self.hook_fields[direction].get(action))
+            send_flag = True
+            for hook in filters:
+                if not (yield from hook(packet, connection)):
+                    send_flag = False
+                    break
+            for hook, sees_dropped in observers:
+                if send_flag or sees_dropped:
+                    yield from hook(packet, connection)
+            return send_flag
+        except asyncio.IncompleteReadError:
+            # A corrupt payload; the connection is dropped rather than the
+            # packet being sent on.
+            raise
         except Exception:
             self.logger.exception("Exception encountered in plugin on action: "
                                   "%s", action, exc_info=True)
@@ -149,16 +174,138 @@ class PluginManager:
                 overrides.update({x for x in override})
             self._overrides = overrides
             self._override_cache = self._activated_plugins
+            self.hooked_types = self._build_hooked_types(overrides)
+            self.hook_fields = tuple(
+                self._build_hook_fields(overrides, direction)
+                for direction in Direction)
+            self._refresh_hooks()
             return overrides
 
+    @staticmethod
+    def _build_hooked_types(overrides):
+        """
+        Build a lookup table, indexed by packet type, flagging which packet
+        types have at least one plugin hook attached. Packets with no hooks
+        can be forwarded without ever being decoded.
+
+        :param overrides: Set of overridden method names.
+        :return: Tuple of booleans, one for every possible packet type.
+        """
+        return tuple("on_" + info.name in overrides for info in registry)
+
+    def _build_hooks(self):
+        """
+        Build the dispatch tables for packet hooks, one for each direction,
+        indexed by packet type. Only the hooks of active plugins that
+        override them, and haven't limited them to the other direction with
+        utilities.directions, are included, so plugins that leave a hook
+        alone cost nothing when its packets come through.
+
+        Hooks are split into filters and observers (see utilities.observer).
+        Each tier is ordered by priority (see utilities.priority), highest
+        first, and then in dependency order.
+
+        :return: Tuple of tables, indexed by direction. Each is a tuple with
+                 an entry for every possible packet type: None if nothing
+                 hooks it, otherwise a tuple of the filter hooks, and of
+                 (observer hook, whether it sees dropped packets) tuples.
+        """
+        plugins = [plugin for plugin in self._plugins.values()
+                   if plugin in self._activated_plugins]
+        tables = []
+        for direction in Direction:
+            table = []
+            for info in registry:
+                name = "on_" + info.name
+                if not hasattr(BasePlugin, name):
+                    table.append(None)
+                    continue
+                hooks = sorted(
+                    (getattr(plugin, name) for plugin in plugins
+                     if self._hooks_direction(type(plugin), name, direction)),
+                    key=lambda hook: -getattr(hook, "priority", 0))
+                if not hooks:
+                    table.append(None)
+                    continue
+                filters = tuple(hook for hook in hooks
+                                if not getattr(hook, "observer", False))
+                observers = tuple((hook, hook.sees_dropped) for hook in hooks
+                                  if getattr(hook, "observer", False))
+                table.append((filters, observers))
+            tables.append(tuple(table))
+        return tuple(tables)
+
+    @staticmethod
+    def _hooks_direction(cls, name, direction):
+        """
+        Check whether a plugin class overrides a hook, for packets flowing in
+        a direction.
+
+        :param cls: Plugin class.
+        :param name: Name of the hook.
+        :param direction: Direction, or None for either of them.
+        :return: Boolean.
+        """
+        hook = getattr(cls, name, None)
+        if hook is None or hook is getattr(BasePlugin, name):
+            return False
+        directions = getattr(hook, "directions", None)
+        return direction is None or directions is None or \
+            direction in directions
+
+    def _refresh_hooks(self):
+        """
+        Rebuild the dispatch tables, and which packet types are hooked in
+        each direction, after the active plugins have changed.
+
+        :return: Null.
+        """
+        self._hooks = self._build_hooks()
+        self.hooked_directions = tuple(
+            tuple(hooks is not None for hooks in table)
+            for table in self._hooks)
+
+    def _build_hook_fields(self, overrides, direction=None):
+        """
+        Work out which fields of each hooked packet type are read by the
+        hooks on it, as declared with utilities.reads. Any hook without a
+        declaration needs the whole packet.
+
+        :param overrides: Set of overridden method names.
+        :param direction: Only count hooks on packets flowing in this
+                          direction. Counts every hook if None.
+        :return: Dictionary of action names to frozensets of field names,
+                 leaving out actions that need whole packets.
+        """
+        hook_fields = {}
+        for override in overrides:
+            if not override.startswith("on_"):
+                continue
+            fields = frozenset()
+            for plugin in self._plugins.values():
+                if not self._hooks_direction(type(plugin), override,
+                                             direction):
+                    continue
+                declared = getattr(getattr(type(plugin), override), "reads",
+                                   None)
+                if declared is None:
+                    break
+                fields |= declared
+            else:
+                hook_fields[override[3:]] = fields
+        return hook_fields
+
     def activate_all(self):
         self.logger.info("Activating plugins:")
         for plugin in self._plugins.values():
             self.logger.info(plugin.name)
             plugin.activate()
             self._activated_plugins.add(plugin)
+        self._refresh_hooks()
 
     def deactivate_all(self):
         for plugin in self._plugins.values():
             self.logger.info("Deactivating %s", plugin.name)
             plugin.deactivate()
+            self._activated_plugins.discard(plugin)
+        self._refresh_hooks()
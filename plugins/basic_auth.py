@@ -11,7 +11,7 @@ Original Authors: GermaniumSystem
 
 from base_plugin import SimpleCommandPlugin
 from data_parser import ConnectFailure
-from pparser import build_packet
+from pparser import packet_templates
 from packets import packets
 
 
@@ -105,7 +105,6 @@ class BasicAuth(SimpleCommandPlugin):
         :param reason: String. Reason for rejection.
         :return: Rejection packet.
         """
-        return build_packet(packets["connect_failure"],
-                            ConnectFailure.build(
-                                dict(reason=reason)))
+        return packet_templates.get(packets["connect_failure"],
+                                    ConnectFailure, dict(reason=reason))
 
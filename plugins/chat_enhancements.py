@@ -15,8 +15,8 @@ import re
 from datetime import datetime
 
 import data_parser
-import pparser
 import packets
+import pparser
 from base_plugin import StorageCommandPlugin
 from utilities import Command, ChatSendMode, ChatReceiveMode, \
     send_message, link_plugin_if_available
@@ -65,7 +65,18 @@ class ChatEnhancements(StorageCommandPlugin):
         return True
 
     def on_chat_received(self, data, connection):
+        """
+        Catch messages on their way to a player. Decorate the sender's name,
+        and reword join and leave notices. The changes are patched into the
+        packet, which is then sent on.
+
+        :param data: The packet containing the message.
+        :param connection: The connection the packet is going to.
+        :return: Boolean. False if the player is ignoring the sender, True
+                 otherwise.
+        """
         sender = ""
+        changes = {}
         if data["parsed"]["name"]:
             if data["parsed"]["name"] == "server":
                 joinmsg = re.match(r"Player '(.*)' (dis)?connected",
@@ -75,8 +86,8 @@ class ChatEnhancements(StorageCommandPlugin):
                         joinmsg.group(1))
                     type = "left" if joinmsg.group(2) is not None \
                         else "joined"
-                    data['parsed']['message'] = "{}{}^reset; has {} the " \
-                                                "server.".format(
+                    changes["message"] = "{}{}^reset; has {} the " \
+                                         "server.".format(
                         joiner.chat_prefix, joiner.alias, type)
                     sender = self.make_timestamp()
             else:
@@ -95,12 +106,11 @@ class ChatEnhancements(StorageCommandPlugin):
                                         "".format(data["parsed"]["name"]))
                     sender = data["parsed"]["name"]
 
-        yield from send_message(connection,
-                                data["parsed"]["message"],
-                                mode=data["parsed"]["header"]["mode"],
-                                client_id=data["parsed"]["header"]["client_id"],
-                                name=sender,
-                                channel=data["parsed"]["header"]["channel"])
+        if sender != data["parsed"]["name"]:
+            changes["name"] = sender
+        if changes:
+            pparser.patch_packet(data, **changes)
+        return True
 
     def on_chat_sent(self, data, connection):
         """
@@ -154,10 +164,9 @@ class ChatEnhancements(StorageCommandPlugin):
 
     @asyncio.coroutine
     def _send_to_server(self, message, mode, connection):
-        msg_base = data_parser.ChatSent.build(dict(message=" ".join(message),
-                                                   send_mode=mode))
-        msg_packet = pparser.build_packet(packets.packets['chat_sent'],
-                                          msg_base)
+        msg_packet = data_parser.ChatSent.build_packet(
+            packets.packets['chat_sent'],
+            dict(message=" ".join(message), send_mode=mode))
         yield from connection.client_raw_write(msg_packet)
 
     # Commands - In-game actions that can be performed
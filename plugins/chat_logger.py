@@ -7,6 +7,7 @@ Original authors: kharidiron
 """
 
 from base_plugin import BasePlugin
+from utilities import reads, observer
 
 
 class ChatLogger(BasePlugin):
@@ -18,13 +19,15 @@ class ChatLogger(BasePlugin):
     def activate(self):
         super().activate()
 
+    @reads("message")
+    @observer(dropped=True)
     def on_chat_sent(self, data, connection):
         """
         Catch when someone sends any form of message or command and log it.
 
         :param data: The packet containing the message.
         :param connection: The connection from which the packet came.
-        :return: Boolean; Always true.
+        :return: Boolean; Always true. Ignored, as this only observes.
         """
         message = data["parsed"]["message"]
         self.logger.info("{}: {}".format(connection.player.name, message))
@@ -12,8 +12,9 @@ import packets
 
 from base_plugin import StorageCommandPlugin
 from data_parser import PlayerWarp
-from pparser import build_packet
-from utilities import Command, send_message, link_plugin_if_available
+from pparser import packet_templates
+from utilities import Command, send_message, link_plugin_if_available, \
+    reads
 
 
 class Claims(StorageCommandPlugin):
@@ -50,6 +51,7 @@ class Claims(StorageCommandPlugin):
         else:
             return True
 
+    @reads()
     def on_world_start(self, data, connection):
         """
         Catch when a player beams onto a world.
@@ -103,16 +105,22 @@ class Claims(StorageCommandPlugin):
                 return
             elif connection.player.uuid in access["list"] and not \
                     access["whitelist"]:
-                wp = PlayerWarp.build({"warp_action": {"warp_type": 3,
-                                                       "alias_id": 2}})
-                full = build_packet(packets.packets['player_warp'], wp)
-                yield from connection.client_raw_write(full)
+                yield from connection.client_raw_write(self._warp_to_ship())
             elif connection.player.uuid not in access["list"] and \
                     access["whitelist"]:
-                wp = PlayerWarp.build({"warp_action": {"warp_type": 3,
-                                                       "alias_id": 2}})
-                full = build_packet(packets.packets['player_warp'], wp)
-                yield from connection.client_raw_write(full)
+                yield from connection.client_raw_write(self._warp_to_ship())
+
+    # noinspection PyMethodMayBeStatic
+    def _warp_to_ship(self):
+        """
+        Packet that sends a player back to their ship.
+
+        :return: Bytes. The packet.
+        """
+        return packet_templates.get(packets.packets['player_warp'],
+                                    PlayerWarp,
+                                    {"warp_action": {"warp_type": 3,
+                                                     "alias_id": 2}})
 
     # noinspection PyMethodMayBeStatic
     def _pretty_world_name(self, location):
@@ -17,7 +17,6 @@ import packets
 from base_plugin import BasePlugin
 from utilities import extractor, get_syntax, send_message
 from data_parser import ChatSent
-from pparser import build_packet
 
 
 class CommandDispatcher(BasePlugin):
@@ -50,9 +49,10 @@ class CommandDispatcher(BasePlugin):
                 # Bypass StarryPy command processing and send to the
                 # starbound server
                 cmd = data['parsed']['message'].replace("sb:", "")
-                pkt = ChatSent.build({"message": cmd, "send_mode": data[
-                    'parsed']['send_mode']})
-                full = build_packet(packets.packets['chat_sent'], pkt)
+                full = ChatSent.build_packet(packets.packets['chat_sent'],
+                                             {"message": cmd,
+                                              "send_mode": data['parsed'][
+                                                  'send_mode']})
                 yield from connection.client_raw_write(full)
                 return False
             to_parse = data['parsed']['message'][len(
@@ -14,7 +14,8 @@ import asyncio
 import discord
 
 from base_plugin import BasePlugin
-from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available
+from utilities import ChatSendMode, ChatReceiveMode, \
+    link_plugin_if_available, observer
 
 
 # Mock Objects
@@ -165,6 +166,7 @@ class DiscordPlugin(BasePlugin, discord.Client):
         asyncio.ensure_future(self.make_announce(connection, "left"))
         return True
 
+    @observer()
     def on_chat_sent(self, data, connection):
         """
         Hook on message being broadcast on server. Display it in Discord.
@@ -11,7 +11,6 @@ import asyncio
 
 import data_parser
 import packets
-import pparser
 from base_plugin import SimpleCommandPlugin
 from utilities import Command, send_message, StorageMixin, broadcast, \
     link_plugin_if_available, ChatSendMode
@@ -62,10 +61,9 @@ class Emotes(StorageMixin, SimpleCommandPlugin):
 
     @asyncio.coroutine
     def _send_to_server(self, message, mode, connection):
-        msg_base = data_parser.ChatSent.build(dict(message="".join(message),
-                                                   send_mode=mode))
-        msg_packet = pparser.build_packet(packets.packets['chat_sent'],
-                                          msg_base)
+        msg_packet = data_parser.ChatSent.build_packet(
+            packets.packets['chat_sent'],
+            dict(message="".join(message), send_mode=mode))
         yield from connection.client_raw_write(msg_packet)
 
     # Commands - In-game actions that can be performed
@@ -7,7 +7,7 @@ Original authors: medeor413
 """
 
 from base_plugin import BasePlugin
-from utilities import Direction
+from utilities import Direction, reads, directions
 
 
 class ChatLogger(BasePlugin):
@@ -31,6 +31,8 @@ class ChatLogger(BasePlugin):
             "invinciblePlayers"
         ]
 
+    @reads("message_name")
+    @directions(Direction.TO_SERVER)
     def on_entity_message(self, data, connection):
         """
         Catch when an entity message is sent and block it, depending on its
@@ -41,18 +43,17 @@ class ChatLogger(BasePlugin):
         :return: Boolean; True if the message is allowed, false if it's
         blocked.
         """
-        if data['direction'] == Direction.TO_CLIENT:
-            # The server probably isn't sending malicious messages
-            return True
-        else:
-            if data['parsed']['message_name'] in self.blocked_messages:
-                if not connection.player.perm_check("emsg_blocker.bypass"):
-                    self.logger.debug("Blocked message {} from player {}."
-                                      .format(data['parsed']['message_name'],
-                                              connection.player.alias))
-                    return False
-            return True
+        # The server probably isn't sending malicious messages, so only
+        # messages from players are checked.
+        if data['parsed']['message_name'] in self.blocked_messages:
+            if not connection.player.perm_check("emsg_blocker.bypass"):
+                self.logger.debug("Blocked message {} from player {}."
+                                  .format(data['parsed']['message_name'],
+                                          connection.player.alias))
+                return False
+        return True
 
+    @directions(Direction.TO_SERVER)
     def on_update_world_properties(self, data, connection):
         """
         Catch when world properties are modified and block it, depending on
@@ -61,15 +62,13 @@ class ChatLogger(BasePlugin):
         :param connection:
         :return: Boolean: True if the change is allowed, false otherwise
         """
-        if data['direction'] == Direction.TO_CLIENT:
-            # The server is just informing the clients of changes.
-            return True
-        else:
-            for key in data['parsed'].keys():
-                if key in self.blocked_world_properties:
-                    if not connection.player.perm_check("emsg_blocker.bypass"):
-                        self.logger.debug("Blocked change of world property "
-                                          "{} from player {}.".format(
-                            key, connection.player.alias))
-                        return False
-            return True
\ No newline at end of file
+        # The server is just informing the clients of changes, so only
+        # changes from players are checked.
+        for key in data['parsed'].keys():
+            if key in self.blocked_world_properties:
+                if not connection.player.perm_check("emsg_blocker.bypass"):
+                    self.logger.debug("Blocked change of world property "
+                                      "{} from player {}.".format(
+                                          key, connection.player.alias))
+                    return False
+        return True
\ No newline at end of file
@@ -98,8 +98,11 @@ class GeneralCommands(SimpleCommandPlugin):
         :return: Null.
         """
         ret_list = []
-        for player in self.plugins['player_manager'].players_online:
-            target = self.plugins['player_manager'].get_player_by_uuid(player)
+        player_manager = self.plugins['player_manager']
+        targets = [player_manager.get_player_by_uuid(player)
+                   for player in player_manager.players_online]
+        targets.extend(player_manager.remote_players)
+        for target in targets:
             if connection.player.perm_check("general_commands.who_clientids"):
                 ret_list.append(
                     "[^red;{}^reset;] {}{}^reset;".format(target.client_id,
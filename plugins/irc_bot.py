@@ -14,7 +14,8 @@ import asyncio
 import irc3
 
 from base_plugin import BasePlugin
-from utilities import ChatSendMode, ChatReceiveMode, link_plugin_if_available
+from utilities import ChatSendMode, ChatReceiveMode, \
+    link_plugin_if_available, observer
 
 
 # Mock Objects
@@ -205,6 +206,7 @@ class IRCPlugin(BasePlugin):
         asyncio.ensure_future(self.announce_leave(connection.player))
         return True
 
+    @observer()
     def on_chat_sent(self, data, connection):
         """
         Hook on message being broadcast on server. Display it in IRC.
@@ -12,10 +12,10 @@ Original authors: kharidiron
 import asyncio
 
 import packets
-import pparser
 from base_plugin import SimpleCommandPlugin
 from data_parser import GiveItem
-from utilities import send_message, ChatReceiveMode, DotDict
+from pparser import packet_templates
+from utilities import send_message, ChatReceiveMode, DotDict, reads
 
 
 ###
@@ -39,6 +39,7 @@ class NewPlayerGreeter(SimpleCommandPlugin):
         self.greeting = self.config.get_plugin_config(self.name)["greeting"]
         self.gifts = self.config.get_plugin_config(self.name)["gifts"]
 
+    @reads()
     def on_world_start(self, data, connection):
         """
         Client on world hook. After a client connects, when their world
@@ -90,12 +91,12 @@ class NewPlayerGreeter(SimpleCommandPlugin):
             count = int(count)
             if count > 10000 and item != "money":
                 count = 10000
-            item_base = GiveItem.build(dict(name=item,
-                                            count=count,
-                                            variant_type=7,
-                                            description=""))
-            item_packet = pparser.build_packet(packets.packets['give_item'],
-                                               item_base)
+            item_packet = packet_templates.get(packets.packets['give_item'],
+                                               GiveItem,
+                                               dict(name=item,
+                                                    count=count,
+                                                    variant_type=7,
+                                                    description=""))
             yield from asyncio.sleep(.1)
             yield from connection.raw_write(item_packet)
             send_message(connection,
@@ -10,7 +10,7 @@ Reimplemented for StarryPy3k by medeor413.
 import asyncio
 
 from base_plugin import StorageCommandPlugin
-from utilities import send_message, Command
+from utilities import send_message, Command, reads
 
 
 class PlanetAnnouncer(StorageCommandPlugin):
@@ -25,6 +25,7 @@ class PlanetAnnouncer(StorageCommandPlugin):
         if "greetings" not in self.storage:
             self.storage["greetings"] = {}
 
+    @reads()
     def on_world_start(self, data, connection):
         asyncio.ensure_future(self._announce(connection))
         return True
@@ -17,7 +17,7 @@ import pparser
 from base_plugin import StorageCommandPlugin
 from data_parser import GiveItem
 from utilities import Direction, Command, send_message, \
-    EntityInteractionType, EntitySpawnType
+    EntityInteractionType, EntitySpawnType, reads, directions
 
 
 ###
@@ -72,6 +72,7 @@ class PlanetProtect(StorageCommandPlugin):
 
     # Packet hooks - look for these packets and act on them
 
+    @reads("spawn_type", "payload")
     def on_spawn_entity(self, data, connection):
         """
         Catch when a player tries spawning an object in the world.
@@ -109,6 +110,7 @@ class PlanetProtect(StorageCommandPlugin):
         yield from connection.raw_write(item_packet)
         return False
 
+    @reads("interaction_type")
     def on_entity_interact_result(self, data, connection):
         """
         Catch when a player interacts with an object in the world.
@@ -146,6 +148,8 @@ class PlanetProtect(StorageCommandPlugin):
         yield from self._protection_warn(data, connection)
         return False
 
+    @reads()
+    @directions(Direction.TO_SERVER)
     def on_tile_update(self, data, connection):
         """
         Hook for tile update packet. Use to verify if changes to tiles are
@@ -159,8 +163,6 @@ class PlanetProtect(StorageCommandPlugin):
                  builders, let it pass. Otherwise, block the packet from
                  reaching the server.
         """
-        if data["direction"] == Direction.TO_CLIENT:
-            return True
         if not self.check_protection(connection.player.location):
             return True
         protection = self.get_protection(connection.player.location)
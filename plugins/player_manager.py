@@ -20,9 +20,9 @@ from operator import attrgetter
 
 from base_plugin import SimpleCommandPlugin
 from data_parser import ConnectFailure, ServerDisconnect
-from pparser import build_packet
+from pparser import build_packet, packet_templates
 from utilities import Command, DotDict, State, broadcast, send_message, \
-    WarpType, WarpWorldType, WarpAliasType
+    WarpType, WarpWorldType, WarpAliasType, reads
 from packets import packets
 
 
@@ -30,6 +30,11 @@ class Player:
     """
     Prototype class for a player.
     """
+    # Attributes that describe the player's live connection, rather than the
+    # player. Only the worker they are connected to gets to change these.
+    local_state = ("connection", "logged_in", "client_id", "ip", "location",
+                   "last_location")
+
     def __init__(self, uuid, species="unknown", name="", alias="",
                  last_seen=None, ranks=None, logged_in=False,
                  connection=None, client_id=-1, ip="", planet="",
@@ -86,6 +91,16 @@ class Player:
         """
         return pprint.pformat(self.__dict__)
 
+    def __getstate__(self):
+        """
+        Leave the live connection out when the player is stored.
+
+        :return: Dictionary of Player object attributes.
+        """
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
     def update_ranks(self, ranks):
         """
         Update the player's info to match any changes made to their ranks.
@@ -189,7 +204,15 @@ class PlayerManager(SimpleCommandPlugin):
                                "owner_ranks": ["Owner"],
                                "new_user_ranks": ["Guest"]}
         super().__init__()
-        self.shelf = shelve.open(self.plugin_config.player_db, writeback=True)
+        self.cluster = getattr(self.factory, "cluster", None)
+        if self.cluster is not None:
+            # The cluster hub owns the database file; work on its copy.
+            self.shelf = self.cluster.shelf
+            self.cluster.subscribe("player_offline", self._remote_offline)
+            self.cluster.subscribe("kick", self._remote_kick)
+        else:
+            self.shelf = shelve.open(self.plugin_config.player_db,
+                                     writeback=True)
         self.sync()
         self.players = self.shelf["players"]
         self.planets = self.shelf["planets"]
@@ -291,6 +314,7 @@ class PlayerManager(SimpleCommandPlugin):
         connection.player.logged_in = True
         connection.player.last_seen = datetime.datetime.now()
         self.players_online.append(connection.player.uuid)
+        self._publish_online(connection.player)
         return True
 
     def on_client_disconnect_request(self, data, connection):
@@ -318,6 +342,7 @@ class PlayerManager(SimpleCommandPlugin):
         self._set_offline(connection)
         return True
 
+    @reads("template_data")
     def on_world_start(self, data, connection):
         """
         Hook when a new world instance is started. Use the details passed to
@@ -330,8 +355,10 @@ class PlayerManager(SimpleCommandPlugin):
         """
         planet = data["parsed"]["template_data"]
         if planet["celestialParameters"] is not None:
+            # Decoded in full, so as not to keep the packet alive with it.
+            coordinate = planet["celestialParameters"]["coordinate"]
             location = yield from self._add_or_get_planet(
-                **planet["celestialParameters"]["coordinate"])
+                **coordinate.materialize())
             connection.player.location = location
         self.logger.info("Player {} is now at location: {}".format(
             connection.player.alias,
@@ -419,6 +446,7 @@ class PlayerManager(SimpleCommandPlugin):
     #             continue
     #     return True
 
+    @reads()
     def on_step_update(self, data, connection):
         """
         Catch when the first heartbeat packet is sent to a player. This is the
@@ -453,6 +481,7 @@ class PlayerManager(SimpleCommandPlugin):
                     target.logged_in = False
                     target.location = None
                     self.players_online.remove(target.uuid)
+                    self._publish_offline(target)
 
     def _set_offline(self, connection):
         """
@@ -466,8 +495,71 @@ class PlayerManager(SimpleCommandPlugin):
         connection.player.location = None
         connection.player.last_seen = datetime.datetime.now()
         self.players_online.remove(connection.player.uuid)
+        self._publish_offline(connection.player)
         return True
 
+    def _publish_online(self, player):
+        """
+        Let the other workers know a player has come online here.
+
+        :param player: Player object.
+        :return: Null.
+        """
+        if self.cluster is not None:
+            # Connected players are changed through connection.player, so
+            # keep checking them for changes while they are here.
+            self.shelf.watch("players", player.uuid)
+            self.cluster.publish("player_online", uuid=player.uuid,
+                                 alias=player.alias,
+                                 chat_prefix=player.chat_prefix,
+                                 client_id=player.client_id)
+
+    def _publish_offline(self, player):
+        """
+        Let the other workers know a player connected here has gone.
+
+        :param player: Player object.
+        :return: Null.
+        """
+        if self.cluster is not None:
+            self.cluster.publish("player_offline", uuid=player.uuid)
+
+    def _remote_offline(self, message):
+        """
+        Another worker lost a player. Normally the database update says as
+        much already; this covers a worker going away without saying so.
+
+        :param message: Cluster message.
+        :return: Null.
+        """
+        player = self.get_player_by_uuid(message["uuid"])
+        if player is not None and player.connection is None:
+            player.logged_in = False
+            player.location = None
+
+    @asyncio.coroutine
+    def _remote_kick(self, message):
+        """
+        Kick a player connected here, on behalf of another worker.
+
+        :param message: Cluster message.
+        :return: Null.
+        """
+        player = self.get_player_by_uuid(message["uuid"])
+        if player is not None and player.connection is not None:
+            yield from self._kick_player(player, message["reason"])
+
+    @property
+    def remote_players(self):
+        """
+        Players online on other workers, when running as a cluster.
+
+        :return: List of DotDicts with uuid, alias, chat_prefix and client_id.
+        """
+        if self.cluster is None:
+            return []
+        return [DotDict(entry) for entry in self.cluster.roster.values()]
+
     def clean_name(self, name):
         color_strip = re.compile("\^(.*?);")
         alias = color_strip.sub("", name)
@@ -492,9 +584,8 @@ class PlayerManager(SimpleCommandPlugin):
         :param reason: String. Reason for rejection.
         :return: Rejection packet.
         """
-        return build_packet(packets["connect_failure"],
-                            ConnectFailure.build(
-                                dict(reason=reason)))
+        return packet_templates.get(packets["connect_failure"],
+                                    ConnectFailure, dict(reason=reason))
 
     def sync(self):
         """
@@ -520,7 +611,13 @@ class PlayerManager(SimpleCommandPlugin):
 
         :return: Null
         """
-        for player in self.shelf["players"].values():
+        if self.cluster is not None:
+            # Players on other workers are still around.
+            players = [self.get_player_by_uuid(uuid)
+                       for uuid in self.players_online]
+        else:
+            players = self.shelf["players"].values()
+        for player in players:
             player.connection = None
             player.logged_in = False
         self.shelf.close()
@@ -658,6 +755,19 @@ class PlayerManager(SimpleCommandPlugin):
             self.plugin_shelf[name] = DotDict({})
         return self.plugin_shelf[name]
 
+    def _found(self, player):
+        """
+        Hand back a player found by searching through the players, rather
+        than by looking them up, marking them to be checked for changes when
+        running as a cluster, since whoever asked may well change them.
+
+        :param player: Player object.
+        :return: Player object.
+        """
+        if self.cluster is not None:
+            self.shelf.mark_dirty("players", player.uuid)
+        return player
+
     def get_player_by_uuid(self, uuid):
         """
         Grab a hook to a player by their uuid. Returns player object.
@@ -682,7 +792,7 @@ class PlayerManager(SimpleCommandPlugin):
         for player in self.shelf["players"].values():
             if player.name.lower() == lname:
                 if not check_logged_in or player.logged_in:
-                    return player
+                    return self._found(player)
 
     def get_player_by_alias(self, alias, check_logged_in=False) -> Player:
         """
@@ -698,7 +808,7 @@ class PlayerManager(SimpleCommandPlugin):
         for player in self.shelf["players"].values():
             if player.alias.lower() == lname:
                 if not check_logged_in or player.logged_in:
-                    return player
+                    return self._found(player)
 
     def get_player_by_client_id(self, id) -> Player:
         """
@@ -709,7 +819,7 @@ class PlayerManager(SimpleCommandPlugin):
         """
         for player in self.shelf["players"].values():
             if player.client_id == id and player.logged_in:
-                return player
+                return self._found(player)
 
     def get_player_by_ip(self, ip, check_logged_in=False) -> Player:
         """
@@ -724,7 +834,7 @@ class PlayerManager(SimpleCommandPlugin):
         for player in self.shelf["players"].values():
             if player.ip == ip:
                 if not check_logged_in or player.logged_in:
-                    return player
+                    return self._found(player)
 
     def find_player(self, search, check_logged_in=False):
         """
@@ -934,23 +1044,39 @@ class PlayerManager(SimpleCommandPlugin):
             send_message(connection,
                          "Player {} is not currently logged in.".format(alias))
             return
-        if p.client_id == -1 or p.connection is None:
+        if self.cluster is not None and p.uuid in self.cluster.roster:
+            # Connected to another worker; have that one kick them.
+            self.cluster.publish("kick", uuid=p.uuid, reason=reason)
+        elif p.client_id == -1 or p.connection is None:
             p.connection = None
             p.logged_in = False
             p.location = None
             self.players_online.remove(p.uuid)
             return
+        else:
+            yield from self._kick_player(p, reason)
+        broadcast(self, "^red;{} has been kicked for reason: "
+                        "{}^reset;".format(alias, reason))
+
+    @asyncio.coroutine
+    def _kick_player(self, player, reason):
+        """
+        Disconnect a player connected to this process.
+
+        :param player: Player object.
+        :param reason: String. Reason for the kick.
+        :return: Null.
+        """
         kick_string = "You were kicked.\n Reason: {}".format(reason)
         kick_packet = build_packet(packets["server_disconnect"],
                                    ServerDisconnect.build(
                                        dict(reason=kick_string)))
-        yield from p.connection.raw_write(kick_packet)
-        p.connection = None
-        p.logged_in = False
-        p.location = None
-        self.players_online.remove(p.uuid)
-        broadcast(self, "^red;{} has been kicked for reason: "
-                        "{}^reset;".format(alias, reason))
+        yield from player.connection.raw_write(kick_packet)
+        player.connection = None
+        player.logged_in = False
+        player.location = None
+        self.players_online.remove(player.uuid)
+        self._publish_offline(player)
 
     @Command("ban",
              perm="player_manager.ban",
@@ -47,21 +47,20 @@ class POI(StorageCommandPlugin):
             raise NotImplementedError
         else:
             location = self.storage["pois"][location]
-            destination = data_parser.FlyShip.build(dict(
-                world_x=location.x,
-                world_y=location.y,
-                world_z=location.z,
-                location=dict(
-                    type=SystemLocationType.COORDINATE,
+            flyship_packet = pparser.packet_templates.get(
+                packets.packets["fly_ship"], data_parser.FlyShip, dict(
                     world_x=location.x,
                     world_y=location.y,
                     world_z=location.z,
-                    world_planet=location.planet,
-                    world_satellite=location.satellite
-                )
-            ))
-            flyship_packet = pparser.build_packet(packets.packets["fly_ship"],
-                                                  destination)
+                    location=dict(
+                        type=SystemLocationType.COORDINATE,
+                        world_x=location.x,
+                        world_y=location.y,
+                        world_z=location.z,
+                        world_planet=location.planet,
+                        world_satellite=location.satellite
+                    )
+                ))
             yield from connection.client_raw_write(flyship_packet)
 
     # Commands - In-game actions that can be performed
@@ -152,6 +151,7 @@ class POI(StorageCommandPlugin):
         poi_name = " ".join(data).lower()
         if poi_name in self.storage["pois"]:
             self.storage["pois"].pop(poi_name)
+            pparser.packet_templates.invalidate(packets.packets["fly_ship"])
             send_message(connection,
                          "Deleted POI {}.".format(poi_name))
         else:
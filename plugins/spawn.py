@@ -47,21 +47,20 @@ class Spawn(StorageCommandPlugin):
             raise NotImplementedError
         else:
             spawn_location = self.storage["spawn"]["spawn_location"]
-            destination = data_parser.FlyShip.build(dict(
-                world_x=spawn_location.x,
-                world_y=spawn_location.y,
-                world_z=spawn_location.z,
-                location=dict(
-                    type=SystemLocationType.COORDINATE,
+            flyship_packet = pparser.packet_templates.get(
+                packets.packets["fly_ship"], data_parser.FlyShip, dict(
                     world_x=spawn_location.x,
                     world_y=spawn_location.y,
                     world_z=spawn_location.z,
-                    world_planet=spawn_location.planet,
-                    world_satellite=spawn_location.satellite
-                )
-            ))
-            flyship_packet = pparser.build_packet(packets.packets["fly_ship"],
-                                                  destination)
+                    location=dict(
+                        type=SystemLocationType.COORDINATE,
+                        world_x=spawn_location.x,
+                        world_y=spawn_location.y,
+                        world_z=spawn_location.z,
+                        world_planet=spawn_location.planet,
+                        world_satellite=spawn_location.satellite
+                    )
+                ))
             yield from connection.client_raw_write(flyship_packet)
 
     # Commands - In-game actions that can be performed
@@ -111,6 +110,7 @@ class Spawn(StorageCommandPlugin):
                          "You must be standing on a planet for this to work.")
             return
         self.storage["spawn"]["spawn_location"] = planet
+        pparser.packet_templates.invalidate(packets.packets["fly_ship"])
         send_message(connection, "Spawn planet set to {}.".format(str(planet)))
 
     @Command("show_spawn",
@@ -1,76 +1,22 @@
 import asyncio
+import logging
+import time
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from configuration_manager import ConfigurationManager
 from data_parser import *
+from packets import packets, registry
+from utilities import Packet, ParsePolicy
 
-parse_map = {
-    0: ProtocolRequest,
-    1: ProtocolResponse,
-    2: ServerDisconnect,
-    3: ConnectSuccess,
-    4: ConnectFailure,
-    5: HandshakeChallenge,
-    6: ChatReceived,
-    7: None,
-    8: None,
-    9: PlayerWarpResult,
-    10: None,
-    11: None,
-    12: ClientConnect,
-    13: ClientDisconnectRequest,
-    14: None,
-    15: PlayerWarp,
-    16: FlyShip,
-    17: ChatSent,
-    18: None,
-    19: ClientContextUpdate,
-    20: WorldStart,
-    21: WorldStop,
-    22: None,
-    23: None,
-    24: None,
-    25: None,
-    26: None,
-    27: None,
-    28: None,
-    29: None,
-    30: GiveItem,
-    31: None,
-    32: None,
-    33: None,
-    34: None,
-    35: None,
-    36: None,
-    37: ModifyTileList,
-    38: None,
-    39: None,
-    40: None,
-    41: SpawnEntity,
-    42: None,
-    43: None,
-    44: None,
-    45: None,
-    46: EntityCreate,
-    47: None,
-    48: None,
-    49: EntityInteract,
-    50: EntityInteractResult,
-    51: None,
-    52: DamageRequest,
-    53: DamageNotification,
-    54: EntityMessage,
-    55: EntityMessageResponse,
-    56: DictVariant,
-    57: StepUpdate,
-    58: None,
-    59: None,
-    60: None,
-    61: None,
-    62: None,
-    63: None,
-    64: None
-}
+logger = logging.getLogger("starrypy.pparser")
+
+# Kept for the code that still looks packets up by these; the registry in
+# packets.py is where packet types are defined.
+parse_map = {info.id: info.struct for info in registry
+             if info.name in packets}
+uncached_types = {info.id for info in registry if not info.cached}
 
 
 class PacketParser:
@@ -78,109 +24,430 @@ class PacketParser:
     Object for handling the parsing and caching of packets.
     """
     def __init__(self, config: ConfigurationManager):
-        self._cache = {}
         self.config = config
+        self._cache = None
         self.loop = asyncio.get_event_loop()
-        self._reaper = self.loop.create_task(self._reap())
+        self._reporter = self.loop.create_task(self._report())
+        self._executor = None
+        self.offloaded = 0
+        self.offload_time = 0.0
 
     @asyncio.coroutine
-    def parse(self, packet):
+    def parse(self, packet, fields=None):
         """
         Given a packet preped packet from the stream, parse it down to its
-        parts. First check if the packet is one we've seen before; if it is,
-        pull its parsed form from the cache, and run with that. Otherwise,
-        pass it to the appropriate parser for parsing.
+        parts, as its type's parse policy says. First check if the packet is
+        one we've seen before; if it is, pull its parsed form from the cache,
+        and run with that. Otherwise, pass it to the appropriate parser for
+        parsing.
+
+        If only some of the packet's fields are needed, it is parsed just
+        far enough to get at them (bypassing the cache, which only holds
+        whole packets). If none are, it isn't parsed at all. Packets of
+        types parsed lazily are left to be parsed when their parsed form is
+        first looked up.
 
         :param packet: Packet with header information parsed.
+        :param fields: Names of the fields needed, or None for all of them.
         :return: Fully parsed packet.
         """
         try:
-            if packet["size"] >= self.config.config["min_cache_size"]:
-                packet["hash"] = hash(packet["original_data"])
-                if packet["hash"] in self._cache:
-                    self._cache[packet["hash"]].count += 1
-                    packet["parsed"] = self._cache[packet["hash"]].packet[
-                        "parsed"]
+            info = registry[packet["type"]]
+            if info.policy == ParsePolicy.NEVER or fields is not None and \
+                    not fields:
+                packet["parsed"] = {}
+            elif info.policy == ParsePolicy.LAZY and \
+                    isinstance(packet, Packet):
+                packet.parse_later(
+                    lambda packet: self._parse_now(info, packet, fields))
+            elif fields is not None:
+                packet = yield from self._parse_packet(packet, fields)
+            elif self._cacheable(packet):
+                parsed = self.cache.get(packet["original_data"])
+                if parsed is not None:
+                    packet["parsed"] = parsed
                 else:
                     packet = yield from self._parse_and_cache_packet(packet)
             else:
                 packet = yield from self._parse_packet(packet)
+        except asyncio.IncompleteReadError:
+            # The payload could not be inflated; let the connection drop.
+            raise
         except Exception as e:
             print("Error during parsing.")
             print(traceback.print_exc())
-        finally:
-            return packet
+        return packet
+
+    def _cacheable(self, packet):
+        """
+        Decide whether a packet is worth looking up in, and adding to, the
+        cache.
+
+        :param packet: Packet with header information parsed.
+        :return: Boolean.
+        """
+        info = registry[packet["type"]]
+        return (self.cache.capacity and
+                packet["size"] >= self.config.config["min_cache_size"] and
+                info.struct is not None and
+                info.cached)
+
+    def _offer(self, packet, parsed):
+        """
+        Offer a freshly parsed packet to the cache.
+
+        :param packet: Packet with header information parsed.
+        :param parsed: Parsed form of the packet.
+        :return: Null.
+        """
+        cost = len(packet["original_data"])
+        if packet["compressed"]:
+            # The parsed form is closer in size to the inflated payload.
+            cost += len(packet["data"])
+        self.cache.put(packet["original_data"], parsed, cost)
+
+    def _parse_now(self, info, packet, fields=None):
+        """
+        Parse a packet on the spot, going through the cache when it can.
+        Used for packets parsed lazily, which are parsed whenever a hook
+        first gets at their parsed form.
+
+        :param info: Registry entry for the packet's type.
+        :param packet: Packet with header information parsed.
+        :param fields: Names of the fields needed, or None for all of them.
+        :return: Parsed packet contents.
+        """
+        if fields is not None:
+            return info.struct.parse_partial(packet["data"], fields)
+        if not self._cacheable(packet):
+            return info.struct.parse(packet["data"])
+        parsed = self.cache.get(packet["original_data"])
+        if parsed is None:
+            parsed = info.struct.parse(packet["data"])
+            self._offer(packet, parsed)
+        return parsed
 
     @asyncio.coroutine
-    def _reap(self):
+    def _report(self):
         """
-        Prune packets from the cache that are not being used, and that are
-        older than the "packet_reap_time".
+        Periodically log how well the cache and offloaded parsing are doing.
 
         :return: None.
         """
         while True:
-            yield from asyncio.sleep(self.config.config["packet_reap_time"])
-            for h, cached_packet in self._cache.copy().items():
-                cached_packet.count -= 1
-                if cached_packet.count <= 0:
-                    del (self._cache[h])
+            yield from asyncio.sleep(
+                self.config.config["parser_stats_interval"])
+            logger.debug("Packet cache: {hits} hits, {misses} misses, "
+                         "{evictions} evictions, {rejected} rejected; "
+                         "{entries} packets in {size} bytes.".format(
+                             **self.cache_stats()))
+            if self.offloaded:
+                logger.debug("Offloaded parsing: {offloaded} packets, "
+                             "{reclaimed:.3f}s of loop time "
+                             "reclaimed.".format(**self.offload_stats()))
 
     @asyncio.coroutine
     def _parse_and_cache_packet(self, packet):
         """
         Take a new packet and pass it to the parser. Once we get it back,
-        make a copy of it to the cache.
+        offer it to the cache.
 
         :param packet: Packet with header information parsed.
         :return: Fully parsed packet.
         """
         packet = yield from self._parse_packet(packet)
-        self._cache[packet["hash"]] = CachedPacket(packet=packet)
+        self._offer(packet, packet["parsed"])
         return packet
 
     @asyncio.coroutine
-    def _parse_packet(self, packet):
+    def _parse_packet(self, packet, fields=None):
         """
-        Parse the packet by giving it to the appropriate parser.
+        Parse the packet by giving it to the appropriate parser. Packets of
+        types that may be offloaded, and are larger than
+        "parse_offload_size", are decompressed and parsed in a separate
+        thread, so they don't stall everyone else's traffic. The caller waits
+        for the result either way, so packets on a connection are still
+        handled in order.
 
         :param packet: Packet with header information parsed.
+        :param fields: Names of the fields needed, or None for all of them.
         :return: Fully parsed packet.
         """
-        res = parse_map[packet["type"]]
+        info = registry[packet["type"]]
+        res = info.struct
         if res is None:
             packet["parsed"] = {}
+        elif info.policy == ParsePolicy.OFFLOAD and \
+                0 < self.config.config["parse_offload_size"] <= packet["size"]:
+            packet["parsed"], elapsed = yield from self.loop.run_in_executor(
+                self.executor, self._offloaded_parse, res, packet, fields)
+            self.offloaded += 1
+            self.offload_time += elapsed
+        elif fields is not None:
+            packet["parsed"] = res.parse_partial(packet["data"], fields)
         else:
-            #packet["parsed"] = yield from self.loop.run_in_executor(
-            #    self.loop.executor, res.parse, packet["data"])
-            # Removed due to issues with testers. Need to evaluate what's going
-            # on.
             packet["parsed"] = res.parse(packet["data"])
         return packet
 
-    # def __del__(self):
-    #     self._reaper.cancel()
+    @property
+    def cache(self):
+        """
+        Cache of parsed packets, created on first use.
+        """
+        if self._cache is None:
+            self._cache = PacketCache(self.config.config["packet_cache_size"])
+        return self._cache
+
+    @property
+    def executor(self):
+        """
+        Dedicated thread pool for offloaded parsing, created on first use.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.config.config["parse_offload_workers"])
+        return self._executor
+
+    def _offloaded_parse(self, res, packet, fields=None):
+        """
+        Decompress and parse a packet. Runs in the executor; zlib releases
+        the GIL while inflating, so this is time the event loop gets back.
+
+        :param res: Parser to use.
+        :param packet: Packet with header information parsed.
+        :param fields: Names of the fields needed, or None for all of them.
+        :return: Tuple. Parsed packet contents, and the time spent on them.
+        """
+        start = time.perf_counter()
+        if fields is not None:
+            parsed = res.parse_partial(packet["data"], fields)
+        else:
+            parsed = res.parse(packet["data"])
+        return parsed, time.perf_counter() - start
+
+    def offload_stats(self):
+        """
+        Report how many packets have been parsed off of the event loop, and
+        how much loop time that has reclaimed.
+
+        :return: Dictionary.
+        """
+        return {"offloaded": self.offloaded,
+                "reclaimed": self.offload_time}
+
+    def cache_stats(self):
+        """
+        Report how the parsed packet cache is doing.
+
+        :return: Dictionary.
+        """
+        return self.cache.stats()
+
+
+class PacketCache:
+    """
+    Parsed forms of recently seen packets, keyed on their exact raw bytes.
+    Least recently used packets are dropped once the total size charged
+    for the packets held goes over `capacity` bytes.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, data):
+        """
+        Look up the parsed form of a packet, marking it as recently used.
+
+        :param data: Raw bytes of the packet.
+        :return: Parsed packet, or None if it isn't cached.
+        """
+        entry = self._entries.get(data)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(data)
+        return entry[0]
+
+    def put(self, data, parsed, cost):
+        """
+        Add a parsed packet, making room for it by dropping the least
+        recently used packets. Packets that would take up more than an
+        eighth of the cache on their own are turned away, so that a single
+        world doesn't flush out everything else.
+
+        :param data: Raw bytes of the packet.
+        :param parsed: Parsed form of the packet.
+        :param cost: Number of bytes to charge for the packet.
+        :return: Boolean. Whether the packet was added.
+        """
+        if cost > self.capacity // 8:
+            self.rejected += 1
+            return False
+        old = self._entries.pop(data, None)
+        if old is not None:
+            self.size -= old[1]
+        # Keep hold of the bytes themselves, rather than a view of a
+        # larger buffer that would stay alive with them.
+        self._entries[bytes(data)] = (parsed, cost)
+        self.size += cost
+        while self.size > self.capacity:
+            _, (_, dropped) = self._entries.popitem(last=False)
+            self.size -= dropped
+            self.evictions += 1
+        return True
 
+    def stats(self):
+        """
+        :return: Dictionary. Hit, miss, eviction and rejection counts, and
+                 how many packets, of how many bytes, are held.
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rejected": self.rejected,
+                "entries": len(self._entries),
+                "size": self.size}
 
-class CachedPacket:
+
+def _freeze(obj):
     """
-    Prototype for cached packets. Keep track of how often it is used,
-    as well as the full packet's contents.
+    Turn the contents of a packet into something hashable, to key a
+    template on.
+
+    :param obj: Object to build a packet from.
+    :return: Hashable equivalent of the object.
     """
-    def __init__(self, packet):
-        self.count = 1
-        self.packet = packet
+    if isinstance(obj, dict):
+        return tuple(sorted((key, _freeze(value))
+                            for key, value in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(value) for value in obj)
+    return obj
 
 
-def build_packet(packet_id, data, compressed=False):
+class PacketTemplates:
+    """
+    Fully framed packets that the proxy sends over and over, such as warps
+    to a fixed destination or a rejection for a given reason, keyed on what
+    they were built from. Each is built once, and every send after that is a
+    write of the cached bytes. Least recently used templates are dropped once
+    there are more than `capacity` of them.
+    """
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, packet_id, struct, obj):
+        """
+        Get the packet built from an object, building it if it isn't cached.
+
+        :param packet_id: ID value of packet.
+        :param struct: Struct to build the payload with.
+        :param obj: Contents of the packet.
+        :return: Bytes. The whole packet.
+        """
+        key = (packet_id, struct, _freeze(obj))
+        try:
+            packet = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            packet = bytes(struct.build_packet(packet_id, obj))
+            self._entries[key] = packet
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return packet
+
+    def invalidate(self, packet_id=None):
+        """
+        Drop cached packets, for when what they were built from has changed.
+
+        :param packet_id: Only drop packets of this type. Drops every packet
+                          if None.
+        :return: Null.
+        """
+        if packet_id is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == packet_id]:
+            del self._entries[key]
+
+
+packet_templates = PacketTemplates()
+
+
+def build_packet(packet_id, data, compressed=None):
     """
     Convenience method for building a packet.
 
     :param packet_id: ID value of packet.
     :param data: Contents of packet.
-    :param compressed: Whether or not to compress the packet.
+    :param compressed: Whether or not to compress the packet. If None, it is
+                       compressed if it is large enough to be worth it.
     :return: Built packet object.
     """
-    return BasePacket.build({"id": packet_id,
-                             "data": data,
-                             "compressed": compressed})
+    return BasePacket.build_into({"id": packet_id,
+                                  "data": data,
+                                  "compressed": compressed}, bytearray())
+
+
+def patch_packet(packet, **fields):
+    """
+    Change fields of a packet that has been read off of the wire, splicing
+    the new values into its payload in place of the old ones, rather than
+    rebuilding the whole packet. The packet's raw data, payload and parsed
+    form are all updated, so it can be sent on as usual.
+
+    Packets whose parser has no declared fields to find offsets for are
+    parsed and rebuilt in full instead. Patched packets are always sent
+    uncompressed.
+
+    :param packet: Packet, as passed to packet hooks.
+    :param fields: New values of the fields to change, by name.
+    :return: The packet.
+    """
+    res = registry[packet["type"]].struct
+    if res is None:
+        raise ValueError("No parser for packet type {}".format(
+            packet["type"]))
+    payload = packet["data"]
+    if res._struct_fields:
+        spans = res.field_spans(payload, fields)
+        pieces = []
+        pos = 0
+        for (start, end), name in sorted((spans[name], name)
+                                         for name in fields):
+            pieces.append(payload[pos:start])
+            pieces.append(getattr(res, name).build_into(fields[name],
+                                                        bytearray()))
+            pos = end
+        pieces.append(payload[pos:])
+        data = b"".join(pieces)
+    else:
+        parsed = res.parse(payload)
+        parsed.update(fields)
+        data = bytes(res.build(parsed))
+    # The parsed form may be shared with the packet cache, so it is
+    # replaced rather than changed.
+    packet["parsed"] = dict(packet.get("parsed") or {}, **fields)
+    packet["data"] = data
+    packet["size"] = len(data)
+    packet["compressed"] = False
+    packet["original_data"] = build_packet(packet["type"], data, False)
+    return packet
@@ -1,14 +1,20 @@
+import argparse
 import asyncio
+import functools
 import logging
 import sys
 import signal
 
+from cluster import ClusterClient, Supervisor
 from configuration_manager import ConfigurationManager
-from data_parser import ChatReceived
-from packets import packets
-from pparser import build_packet
+from data_parser import ChatReceived, enable_c_parser, configure_compression
+from frame_protocol import FrameProtocol
+from packets import packets, registry
+from pipeline import PacketPipeline
 from plugin_manager import PluginManager
-from utilities import path, read_packet, State, Direction, ChatReceiveMode
+from upstream_pool import UpstreamPool
+from utilities import path, read_frame, make_packet, OutputScheduler, \
+    State, Direction, ChatReceiveMode
 
 
 class StarryPyServer:
@@ -27,7 +33,10 @@ class StarryPyServer:
         self.state = None
         self._alive = True
         self.config = config.config
-        self.client_ip = reader._transport.get_extra_info('peername')[0]
+        self._output = self.output_scheduler(writer)
+        self._client_output = None
+        self.pipelines = {}
+        self.client_ip = writer.get_extra_info('peername')[0]
         self._server_read_future = None
         self._client_read_future = None
         self._server_write_future = None
@@ -43,20 +52,11 @@ class StarryPyServer:
 
         :return:
         """
-        (self._client_reader, self._client_writer) = \
-            yield from asyncio.open_connection(self.config['upstream_host'],
-                                               self.config['upstream_port'])
+        yield from self.connect_upstream()
         self._client_loop_future = asyncio.ensure_future(self.client_loop())
         try:
-            while True:
-                packet = yield from read_packet(self._reader,
-                                                Direction.TO_SERVER)
-                # Break in case of emergencies:
-                # if packet['type'] not in [17, 40, 41, 43, 48, 51]:
-                #    logger.debug('c->s  {}'.format(packet['type']))
-
-                if (yield from self.check_plugins(packet)):
-                    yield from self.write_client(packet)
+            yield from self.run_pipeline(self._reader, self._client_output,
+                                         Direction.TO_SERVER)
         except asyncio.IncompleteReadError:
             # Pass on these errors. These occur when a player disconnects badly
             pass
@@ -68,6 +68,41 @@ class StarryPyServer:
         finally:
             self.die()
 
+    @asyncio.coroutine
+    def connect_upstream(self):
+        """
+        Open the connection to the upstream Starbound server, or take one
+        from the pool if there is one.
+
+        :return: Null.
+        """
+        (self._client_reader, self._client_writer) = \
+            yield from self.factory.upstream_connection()
+        self._client_output = self.output_scheduler(self._client_writer)
+
+    def output_scheduler(self, writer):
+        """
+        Wrap one side's writer so that writes going out to it are coalesced.
+
+        :param writer: Writer for one side of the connection.
+        :return: OutputScheduler.
+        """
+        return OutputScheduler(writer,
+                               self.config['write_buffer_high_water'],
+                               self.config['write_buffer_low_water'])
+
+    @staticmethod
+    def read_frame(reader, cut_through=None):
+        """
+        Read the next frame from one side of the connection.
+
+        :param reader: Side of the connection to read from.
+        :param cut_through: Optional cut-through handler, as taken by
+                            utilities.read_frame.
+        :return: Frame tuple, as returned by utilities.read_frame.
+        """
+        return read_frame(reader, cut_through)
+
     @asyncio.coroutine
     def client_loop(self):
         """
@@ -77,21 +112,73 @@ class StarryPyServer:
         :return:
         """
         try:
-            while True:
-                packet = yield from read_packet(self._client_reader,
-                                                Direction.TO_CLIENT)
-                # Break in case of emergencies:
-                # if packet['type'] not in [7, 17, 23, 27, 31, 43, 49, 51]:
-                #     logger.debug('s->c  {}'.format(packet['type']))
-
-                send_flag = yield from self.check_plugins(packet)
-                if send_flag:
-                    yield from self.write(packet)
+            yield from self.run_pipeline(self._client_reader, self._output,
+                                         Direction.TO_CLIENT)
         except asyncio.IncompleteReadError:
             logger.error("IncompleteReadError: Connection ended abruptly.")
         finally:
             self.die()
 
+    @asyncio.coroutine
+    def run_pipeline(self, reader, output, direction):
+        """
+        Pump frames from one side of the connection to the other, through a
+        pipeline that keeps reading while the plugins are busy.
+
+        :param reader: Side of the connection to read from.
+        :param output: OutputScheduler for the other side.
+        :param direction: Direction the frames are flowing in.
+        :return: Null.
+        """
+        pipeline = PacketPipeline(self, reader, output, direction,
+                                  self.config['pipeline_queue_size'],
+                                  self.config['cut_through_size'])
+        self.pipelines[direction] = pipeline
+        yield from pipeline.run()
+
+    @asyncio.coroutine
+    def handle_frame(self, frame, direction):
+        """
+        Run a single frame past the plugins and send it on its way, unless one
+        of them asks for it to be dropped.
+
+        :param frame: Frame tuple, as returned by utilities.read_frame.
+        :param direction: Direction the frame is flowing in.
+        :return: Null.
+        """
+        if direction == Direction.TO_SERVER:
+            if not self.is_hooked(frame[0], direction):
+                yield from self.client_raw_write(frame[2])
+                return
+            packet = make_packet(*frame, direction=direction)
+            # Break in case of emergencies:
+            # if packet['type'] not in [17, 40, 41, 43, 48, 51]:
+            #    logger.debug('c->s  {}'.format(packet['type']))
+
+            if (yield from self.check_plugins(packet)):
+                yield from self.write_client(packet)
+        else:
+            if not self.is_hooked(frame[0], direction):
+                yield from self.raw_write(frame[2])
+                return
+            packet = make_packet(*frame, direction=direction)
+            # Break in case of emergencies:
+            # if packet['type'] not in [7, 17, 23, 27, 31, 43, 49, 51]:
+            #     logger.debug('s->c  {}'.format(packet['type']))
+
+            if (yield from self.check_plugins(packet)):
+                yield from self.write(packet)
+
+    def pipeline_stats(self):
+        """
+        Report queue depth and stall time for both directions of this
+        connection.
+
+        :return: Dictionary of pipeline statistics, keyed by direction.
+        """
+        return {direction.name: pipeline.stats()
+                for direction, pipeline in self.pipelines.items()}
+
     @asyncio.coroutine
     def send_message(self, message, *messages, mode=ChatReceiveMode.BROADCAST,
                      client_id=0, name="", channel=""):
@@ -128,11 +215,11 @@ class StarryPyServer:
                 return
 
             if self.state >= State.CONNECTED:
-                chat_packet = ChatReceived.build({"message": message,
-                                                  "name": name,
-                                                  "junk": 0,
-                                                  "header": header})
-                to_send = build_packet(packets['chat_received'], chat_packet)
+                to_send = ChatReceived.build_packet(packets['chat_received'],
+                                                    {"message": message,
+                                                     "name": name,
+                                                     "junk": 0,
+                                                     "header": header})
                 yield from self.raw_write(to_send)
         except Exception as err:
             logger.exception("Error while trying to send message.")
@@ -140,18 +227,17 @@ class StarryPyServer:
 
     @asyncio.coroutine
     def raw_write(self, data):
-        self._writer.write(data)
-        yield from self._writer.drain()
+        self._output.write(data)
+        yield from self._output.drain()
 
     @asyncio.coroutine
     def client_raw_write(self, data):
-        self._client_writer.write(data)
-        yield from self._client_writer.drain()
+        self._client_output.write(data)
+        yield from self._client_output.drain()
 
     @asyncio.coroutine
     def write(self, packet):
-        self._writer.write(packet['original_data'])
-        yield from self._writer.drain()
+        yield from self.raw_write(packet['original_data'])
 
     @asyncio.coroutine
     def write_client(self, packet):
@@ -168,19 +254,33 @@ class StarryPyServer:
                 logger.info("Removing player %s.", self.player.name)
             else:
                 logger.info("Removing unknown player.")
-            self._writer.close()
-            self._client_writer.close()
+            logger.debug("Pipeline stats: {}".format(self.pipeline_stats()))
+            self._output.close()
+            if self._client_output is not None:
+                self._client_output.close()
             self._server_loop_future.cancel()
             self._client_loop_future.cancel()
             self.factory.remove(self)
             self.state = State.DISCONNECTED
             self._alive = False
 
+    def is_hooked(self, packet_type, direction=None):
+        """
+        Check whether any plugin is interested in a packet type. Packets that
+        nobody hooks are passed straight through without being decoded.
+
+        :param packet_type: Integer ID of the packet.
+        :param direction: Direction the packet is flowing in, or None to
+                          check for hooks in either direction.
+        :return: Boolean.
+        """
+        return self.factory.is_hooked(packet_type, direction)
+
     @asyncio.coroutine
     def check_plugins(self, packet):
         return (yield from self.factory.plugin_manager.do(
             self,
-            packets[packet['type']],
+            registry[packet['type']].name,
             packet))
 
     def __del__(self):
@@ -190,14 +290,49 @@ class StarryPyServer:
             logger.error("An error occurred while a player was disconnecting.")
 
 
+class ProtocolStarryPyServer(StarryPyServer):
+    """
+    Connection core running on FrameProtocol instead of streams. Frames that
+    no plugin hooks are forwarded between the two sides as they arrive,
+    without ever reaching the server and client loops; everything else goes
+    through the same plugin-facing loops as StarryPyServer.
+    """
+    @asyncio.coroutine
+    def connect_upstream(self):
+        upstream, _ = yield from self.factory.upstream_connection()
+        self._reader.pair(upstream)
+        (self._client_reader, self._client_writer) = (upstream, upstream)
+        self._client_output = self.output_scheduler(upstream)
+        # Frames forwarded straight from the protocols have to queue up
+        # behind everything else going out in the same direction.
+        self._reader.output = self._client_output
+        upstream.output = self._output
+
+    @asyncio.coroutine
+    def run_pipeline(self, reader, output, direction):
+        # FrameProtocol already does the reading (and queueing) as data
+        # arrives, so only the plugin stage is left to run here. It keeps
+        # the queue's statistics as well.
+        self.pipelines[direction] = reader
+        while True:
+            frame = yield from reader.read_frame()
+            yield from self.handle_frame(frame, direction)
+
+
 class ServerFactory:
-    def __init__(self):
+    def __init__(self, cluster=None):
         try:
             self.connections = []
+            self.cluster = cluster
             self.configuration_manager = ConfigurationManager()
             self.configuration_manager.load_config(
                 path / 'config' / 'config.json',
                 default=True)
+            config = self.configuration_manager.config
+            if enable_c_parser(config['c_parser']):
+                logger.info("Using the compiled packet parser.")
+            configure_compression(config['compress_size'],
+                                  config['compress_level'])
             self.plugin_manager = PluginManager(self.configuration_manager,
                                                 factory=self)
             self.plugin_manager.load_from_path(
@@ -205,6 +340,14 @@ class ServerFactory:
             self.plugin_manager.resolve_dependencies()
             self.plugin_manager.activate_all()
             asyncio.ensure_future(self.plugin_manager.get_overrides())
+            self.upstream_pool = None
+            if config['upstream_pool_size'] > 0:
+                self.upstream_pool = UpstreamPool(
+                    self.open_upstream, config['upstream_pool_size'],
+                    idle_timeout=config['upstream_pool_idle_timeout'])
+                self.upstream_pool.start()
+            if cluster is not None:
+                cluster.subscribe("broadcast", self._remote_broadcast)
         except Exception as err:
             logger.exception("Error during server startup.", exc_info=True)
 
@@ -215,7 +358,21 @@ class ServerFactory:
     def broadcast(self, messages, *, mode=ChatReceiveMode.RADIO_MESSAGE,
                   **kwargs):
         """
-        Send a message to all connected clients.
+        Send a message to all connected clients, including those connected to
+        other workers when running as a cluster.
+
+        :param messages: Message(s) to be sent.
+        :param mode: Mode bit of message.
+        :return: Null.
+        """
+        if self.cluster is not None:
+            self.cluster.publish("broadcast", messages=messages, mode=mode)
+        yield from self.local_broadcast(messages, mode=mode)
+
+    @asyncio.coroutine
+    def local_broadcast(self, messages, *, mode=ChatReceiveMode.RADIO_MESSAGE):
+        """
+        Send a message to the clients connected to this process only.
 
         :param messages: Message(s) to be sent.
         :param mode: Mode bit of message.
@@ -232,6 +389,57 @@ class ServerFactory:
                 logger.exception(err)
                 continue
 
+    def _remote_broadcast(self, message):
+        return self.local_broadcast(message["messages"], mode=message["mode"])
+
+    @asyncio.coroutine
+    def upstream_connection(self):
+        """
+        Get a connection to the upstream Starbound server for a newly
+        connected client, from the pool if it is enabled.
+
+        :return: Tuple. Reader and writer for the upstream connection.
+        """
+        if self.upstream_pool is not None:
+            return (yield from self.upstream_pool.acquire())
+        return (yield from self.open_upstream())
+
+    @asyncio.coroutine
+    def open_upstream(self):
+        """
+        Open a new connection to the upstream Starbound server, to suit the
+        configured transport.
+
+        :return: Tuple. Reader and writer for the upstream connection.
+        """
+        config = self.configuration_manager.config
+        if config['transport'] == "protocol":
+            loop = asyncio.get_event_loop()
+            _, upstream = yield from loop.create_connection(
+                lambda: FrameProtocol(
+                    functools.partial(self.is_hooked,
+                                      direction=Direction.TO_CLIENT),
+                    max_queued=config['pipeline_queue_size'],
+                    cut_through_size=config['cut_through_size']),
+                config['upstream_host'],
+                config['upstream_port'])
+            return upstream, upstream
+        return (yield from asyncio.open_connection(config['upstream_host'],
+                                                   config['upstream_port']))
+
+    def is_hooked(self, packet_type, direction=None):
+        """
+        Check whether any plugin is interested in a packet type.
+
+        :param packet_type: Integer ID of the packet.
+        :param direction: Direction the packet is flowing in, or None to
+                          check for hooks in either direction.
+        :return: Boolean.
+        """
+        if direction is None:
+            return self.plugin_manager.hooked_types[packet_type]
+        return self.plugin_manager.hooked_directions[direction][packet_type]
+
     def remove(self, connection):
         """
         Remove a single connection.
@@ -255,6 +463,34 @@ class ServerFactory:
         self.connections.append(server)
         logger.debug("New connection established.")
 
+    def protocol_factory(self):
+        """
+        Build the FrameProtocol for a newly connecting client, when running
+        with the protocol-based transport.
+
+        :return: FrameProtocol.
+        """
+        config = self.configuration_manager.config
+        return FrameProtocol(
+            functools.partial(self.is_hooked, direction=Direction.TO_SERVER),
+            max_queued=config['pipeline_queue_size'],
+            cut_through_size=config['cut_through_size'],
+            on_connection_made=self._protocol_connected)
+
+    def _protocol_connected(self, protocol):
+        """
+        Whenever a client connects over the protocol-based transport, ping the
+        server factory to start handling it.
+
+        :param protocol: FrameProtocol for the client side.
+        :return: Null.
+        """
+        server = ProtocolStarryPyServer(protocol, protocol,
+                                        self.configuration_manager,
+                                        factory=self)
+        self.connections.append(server)
+        logger.debug("New connection established.")
+
     def kill_all(self):
         """
         Drop all connections.
@@ -264,20 +500,35 @@ class ServerFactory:
         logger.debug("Dropping all connections.")
         for connection in self.connections:
             connection.die()
+        if self.upstream_pool is not None:
+            logger.debug("Upstream pool stats: {}".format(
+                self.upstream_pool.stats()))
+            self.upstream_pool.close()
 
 
 @asyncio.coroutine
-def start_server():
+def start_server(cluster=None):
     """
     Main function for kicking off the server factory.
 
+    :param cluster: ClusterClient, when running as one of several workers.
     :return: Server factory object.
     """
-    _server_factory = ServerFactory()
+    _server_factory = ServerFactory(cluster)
     config = _server_factory.configuration_manager.config
+    # Workers all listen on the same port, and the kernel spreads incoming
+    # connections between them.
+    options = {"reuse_port": True} if cluster is not None else {}
     try:
-        yield from asyncio.start_server(_server_factory,
-                                        port=config['listen_port'])
+        if config['transport'] == "protocol":
+            loop = asyncio.get_event_loop()
+            yield from loop.create_server(_server_factory.protocol_factory,
+                                          port=config['listen_port'],
+                                          **options)
+        else:
+            yield from asyncio.start_server(_server_factory,
+                                            port=config['listen_port'],
+                                            **options)
     except OSError as err:
         logger.error("Error while trying to start server.")
         logger.error("{}".format(str(err)))
@@ -285,7 +536,52 @@ def start_server():
     return _server_factory
 
 
+@asyncio.coroutine
+def start_worker(worker_id, cluster_path):
+    """
+    Join the cluster, then start serving as one of its workers.
+
+    :param worker_id: Integer. Number of this worker.
+    :param cluster_path: Path to the cluster hub's socket.
+    :return: Server factory object.
+    """
+    config = ConfigurationManager()
+    config.load_config(path / 'config' / 'config.json', default=True)
+    cluster = ClusterClient(cluster_path, worker_id,
+                            config.config['cluster_sync_interval'])
+    yield from cluster.connect()
+    return (yield from start_server(cluster))
+
+
+def run_supervisor(config):
+    """
+    Run the proxy as several worker processes sharing the listen port.
+
+    :param config: Configuration dictionary.
+    :return: Null.
+    """
+    player_db = config['plugins'].get('player_manager', {}).get(
+        'player_db', 'config/player')
+    supervisor = Supervisor(path / 'server.py', config['workers'], player_db,
+                            config['cluster_sync_interval'])
+    logger.info("Starting {} workers".format(config['workers']))
+    try:
+        loop.run_until_complete(supervisor.run())
+    except (KeyboardInterrupt, SystemExit):
+        logger.warning("Exiting")
+    finally:
+        loop.run_until_complete(supervisor.stop())
+        loop.close()
+        logger.info("Finished.")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="StarryPy proxy server.")
+    parser.add_argument("--worker", type=int, default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--cluster", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
     DEBUG = True
 
     if DEBUG:
@@ -319,9 +615,19 @@ if __name__ == "__main__":
     # loop.executor = ThreadPoolExecutor(max_workers=100)
     # loop.set_default_executor(loop.executor)
 
-    logger.info("Starting server")
-
-    server_factory = asyncio.ensure_future(start_server())
+    if args.worker is None:
+        startup_config = ConfigurationManager()
+        startup_config.load_config(path / 'config' / 'config.json',
+                                   default=True)
+        if startup_config.config['workers'] > 1:
+            run_supervisor(startup_config.config)
+            sys.exit()
+        logger.info("Starting server")
+        server_factory = asyncio.ensure_future(start_server())
+    else:
+        logger.info("Starting worker {}".format(args.worker))
+        server_factory = asyncio.ensure_future(
+            start_worker(args.worker, args.cluster))
 
     try:
         loop.run_forever()
@@ -333,7 +639,11 @@ if __name__ == "__main__":
         _factory = server_factory.result()
         _factory.kill_all()
         _factory.plugin_manager.deactivate_all()
-        _factory.configuration_manager.save_config()
+        if _factory.cluster is not None:
+            loop.run_until_complete(_factory.cluster.close())
+        # Workers share one config file; let only the first write it back.
+        if not args.worker:
+            _factory.configuration_manager.save_config()
         aiologger.removeHandler(fh_d)
         aiologger.removeHandler(ch)
         loop.stop()
@@ -0,0 +1,261 @@
+import math
+import random
+import struct
+
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+
+import data_parser
+from bench_parser import load_corpus, default_corpus
+from data_parser import Cursor, VLQ, SignedVLQ, UBInt16, SBInt16, UBInt32, \
+    SBInt32, UBInt64, SBInt64, BFloat32, BDouble, Flag, Byte, UUID, \
+    StarByteArray, StarString, Variant, VariantVariant, DictVariant, \
+    StringSet, CelestialCoordinates, SystemLocation, WarpAction, ChatHeader, \
+    ClientContextSet, WorldChunks, StatusEffectList, EntityMessage, \
+    EntityMessageResponse, ClientConnect, LazyVariant, VariantView
+
+uuid = b"000102030405060708090a0b0c0d0e0f"
+coordinates = {"world_x": 1, "world_y": -2, "world_z": 3, "world_planet": 4,
+               "world_satellite": 0}
+
+# Values for each struct with a compiled counterpart, that its build side
+# should accept.
+objects = {
+    VLQ: [0, 1, 127, 128, 300, 2 ** 40, 2 ** 70, -5],
+    SignedVLQ: [0, -1, 1, -300, 2 ** 62, -2 ** 70],
+    UBInt16: [0, 65535],
+    SBInt16: [-32768, 32767],
+    UBInt32: [0, 2 ** 32 - 1],
+    SBInt32: [-2 ** 31, 2 ** 31 - 1],
+    UBInt64: [0, 2 ** 64 - 1],
+    SBInt64: [-2 ** 63, 2 ** 63 - 1],
+    BFloat32: [0.5, -1e30, 3, float("inf")],
+    BDouble: [1.5, -0.0, float("nan")],
+    Flag: [True, False, 2],
+    Byte: [0, 255, True],
+    UUID: [bytes(range(16))],
+    StarByteArray: [b"", b"abc", bytearray(b"xy"), b"z" * 200],
+    StarString: ["", "h\xe9llo", "x" * 300],
+    Variant: [None, True, 1.5, -7, "s", b"\xff", [1, "a", None],
+              {"a": {"b": [1.0, False]}}, (2, 3)],
+    VariantVariant: [[], [1, [2, {"c": None}]]],
+    DictVariant: [{}, {"k": "v", "n": -1}],
+    LazyVariant: [None, 1.5, [1, "a", None], {"a": {"b": [1.0, False]}},
+                  {"k": b"\xff", "l": []}],
+    CelestialCoordinates: [coordinates],
+    SystemLocation: [
+        {"type": 0},
+        dict(coordinates, type=1),
+        dict(coordinates, type=2, direction=-1, enter_time=12.5,
+             enter_position=[1.5, -2.0]),
+        {"type": 3, "uuid": bytes(range(16))},
+        {"type": 4, "location": [0.25, 8.0]}],
+    WarpAction: [
+        {"warp_type": 1, "world_id": 1, "celestial_coordinates": coordinates,
+         "warp_target": 0},
+        {"warp_type": 1, "world_id": 2, "ship_id": uuid, "warp_target": 1,
+         "teleporter": "door"},
+        {"warp_type": 1, "world_id": 3, "world_name": "arena",
+         "is_instance": 1, "instance_id": uuid, "has_threatlevel": 1,
+         "threatlevel": 2.5, "warp_target": 2, "pos_x": 10, "pos_y": 20},
+        {"warp_type": 1, "world_id": 3, "world_name": "outpost",
+         "is_instance": 0, "has_threatlevel": 0, "warp_target": 3,
+         "pos_x": 4.5},
+        {"warp_type": 2, "player_id": uuid},
+        {"warp_type": 3, "alias_id": -1}],
+    ChatHeader: [{"mode": 0, "channel": "planet", "client_id": 7},
+                 {"mode": 2, "channel": "", "client_id": 1}],
+    StatusEffectList: [[], ["burning", {"effect": "wet", "duration": 2.0}]],
+    EntityMessage: [
+        {"target_unique": True, "unique_id": "merchant",
+         "message_name": "trade", "message_args": [1, "two", {"3": None}],
+         "message_uuid": uuid, "client_id": 0},
+        {"target_unique": False, "target_id": -5, "message_name": "ping",
+         "message_args": [], "message_uuid": uuid, "client_id": 3}],
+    EntityMessageResponse: [
+        {"success_level": 1, "error": "nope", "message_uuid": uuid},
+        {"success_level": 2, "result": {"ok": True}, "message_uuid": uuid}]
+}
+
+# Values that the build side of both implementations should reject.
+bad_objects = [(UBInt16, 70000), (UBInt16, -1), (UBInt16, 1.5),
+               (SBInt32, 2 ** 31), (UBInt64, -1), (BFloat32, 1e300),
+               (BFloat32, "1"), (Byte, 256), (Byte, -1), (Byte, 1.5),
+               (StarString, b"x"), (StarByteArray, "x"), (Variant, object()),
+               (WarpAction, {"warp_type": 2, "player_id": "zz"})]
+
+# Payloads for structs that are only ever parsed.
+payloads = {
+    StringSet: [b"\x00", b"\x02\x01a\x02\xff\xfe"],
+    ClientContextSet: [b"\x05\x03\x02\x01\x04\x06",
+                       b"\x81\x00\x01\x05\x01x"],
+    WorldChunks: [b"\x01\x02ab\x01\x01c", b"\x00"],
+    ClientConnect: [StarByteArray.build(b"digest") + b"\x01" +
+                    bytes(range(16)) + StarString.build("Player") +
+                    StarString.build("human") + b"\x01\x02ab\x01\x01c" +
+                    struct.pack(">LLLff", 3, 1000, 4, 1.0, 2.5) +
+                    b"\x02\x03one\x03two" + b"\x01" +
+                    StarString.build("account")]
+}
+
+
+def normalize(value):
+    """
+    Make results comparable: byte array slices become bytes, and NaNs equal.
+    """
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, VariantView):
+        return normalize(value.materialize())
+    if isinstance(value, float) and math.isnan(value):
+        return "nan"
+    if isinstance(value, dict):
+        # Nested declarative structs parse into, and refer to, the context.
+        return {k: "<ctx>" if v is value else normalize(v)
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(normalize(v) for v in value)
+    return value
+
+
+def parse(cls, data):
+    stream = Cursor(data)
+    return normalize(cls.parse_stream(stream, {})), stream.pos
+
+
+def attempt(fn, *args):
+    try:
+        return fn(*args)
+    except Exception as err:
+        return type(err)
+
+
+def both(fn, *args):
+    """
+    Run a function with the pure Python codec, and then with c_parser.
+    """
+    data_parser.enable_c_parser(False)
+    try:
+        py = attempt(fn, *args)
+    finally:
+        data_parser.enable_c_parser()
+    return py, attempt(fn, *args)
+
+
+def mutations(data, rng):
+    for n in range(len(data)):
+        yield data[:n]
+    for _ in range(50 if data else 0):
+        mutated = bytearray(data)
+        mutated[rng.randrange(len(data))] = rng.randrange(256)
+        yield bytes(mutated)
+
+
+class CompiledTest:
+    def setup(self):
+        if not data_parser.enable_c_parser():
+            raise SkipTest("c_parser has not been built")
+
+
+class TestParity(CompiledTest):
+    def check_build(self, cls, obj):
+        py, c = both(cls.build, obj)
+        assert_is_instance(py, bytes)
+        assert_equals(py, c)
+        py, c = both(lambda: bytes(cls.build_into(obj, bytearray(b"x"))))
+        assert_equals(py, c)
+        assert_equals(py, b"x" + cls.build(obj))
+
+    def check_bad_build(self, cls, obj):
+        py, c = both(cls.build, obj)
+        assert_true(isinstance(py, type) and issubclass(py, Exception))
+        assert_equals(py, c)
+
+    def check_parse(self, cls, data):
+        py, c = both(parse, cls, data)
+        assert_not_is_instance(py, type)
+        assert_equals(py, c)
+
+    def check_damaged(self, cls, data):
+        rng = random.Random(len(data))
+        for damaged in mutations(data, rng):
+            py, c = both(parse, cls, damaged)
+            if c is ValueError:
+                # Counts far beyond what the payload could hold are refused,
+                # where the pure Python codec pads them out with empty
+                # elements.
+                continue
+            if isinstance(c, type):
+                # Both reject it, though not always with the same error.
+                assert_is_instance(py, type, damaged)
+            else:
+                assert_equals(py, c, damaged)
+
+    def test_build(self):
+        for cls, values in objects.items():
+            for obj in values:
+                yield self.check_build, cls, obj
+
+    def test_bad_build(self):
+        for cls, obj in bad_objects:
+            yield self.check_bad_build, cls, obj
+
+    def test_parse(self):
+        for cls, values in objects.items():
+            for obj in values:
+                yield self.check_parse, cls, cls.build(obj)
+        for cls, values in payloads.items():
+            for data in values:
+                yield self.check_parse, cls, data
+        for cls, values in load_corpus(default_corpus).items():
+            for data in values:
+                yield self.check_parse, cls, data
+
+    def test_damaged_payloads(self):
+        for cls, values in objects.items():
+            for obj in values:
+                yield self.check_damaged, cls, cls.build(obj)
+        for cls, values in payloads.items():
+            for data in values:
+                yield self.check_damaged, cls, data
+
+
+class TestCompiledCodec(CompiledTest):
+    def test_covers_codec(self):
+        for cls, name in data_parser._c_codec.items():
+            assert_is(cls._parse,
+                      getattr(data_parser.c_parser, "parse_" + name))
+        assert_is(data_parser._skip_variant, data_parser.c_parser.skip_variant)
+
+    def test_byte_arrays_are_not_copied(self):
+        data = bytearray(StarByteArray.build(b"abc"))
+        res = StarByteArray.parse(data)
+        data[1] = ord("x")
+        assert_equals(bytes(res), b"xbc")
+
+    def test_deep_nesting(self):
+        data = b"\x06\x01" * 1000
+        assert_raises(RecursionError, Variant.parse, data)
+
+    def test_bogus_counts(self):
+        assert_raises(ValueError, VariantVariant.parse,
+                      VLQ.build(2 ** 40) + b"\x01")
+
+    def test_round_trip(self):
+        # Celestial coordinates are built and parsed with different keys.
+        for obj in objects[WarpAction][1:]:
+            assert_equals(WarpAction.parse(WarpAction.build(obj)), obj)
+        for cls in (EntityMessage, EntityMessageResponse):
+            for obj in objects[cls]:
+                assert_equals(cls.parse(cls.build(obj)), obj)
+
+    def test_stale_build_is_ignored(self):
+        version = data_parser.c_parser.VERSION
+        data_parser.c_parser.VERSION = version - 1
+        try:
+            assert_false(data_parser.enable_c_parser())
+            assert_is(VLQ._parse.__func__, data_parser._py_codec[
+                (VLQ, "_parse")].__func__)
+        finally:
+            data_parser.c_parser.VERSION = version
+            data_parser.enable_c_parser()
@@ -0,0 +1,133 @@
+import pickle
+
+from nose.tools import *
+
+import cluster
+from cluster import ClusterShelf
+from utilities import DotDict
+
+
+class FakeClient:
+    def __init__(self):
+        self.pushed = 0
+
+    def push_changes(self):
+        self.pushed += 1
+
+
+class Entry:
+    local_state = ("connection", "logged_in")
+
+    def __init__(self, name, logged_in=False, connection=None):
+        self.name = name
+        self.logged_in = logged_in
+        self.connection = connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
+
+class TestClusterShelf:
+    def setUp(self):
+        self.client = FakeClient()
+        self.shelf = ClusterShelf(self.client, {
+            "players": {"a": Entry("alpha")},
+            "plugins": {"claims": {"owners": []}}})
+
+    def test_no_changes(self):
+        assert_equals(self.shelf.changes(), ([], []))
+
+    def test_changes(self):
+        self.shelf["players"]["a"].name = "omega"
+        self.shelf["players"]["b"] = Entry("beta")
+        del self.shelf["plugins"]["claims"]
+        updates, deletes = self.shelf.changes()
+        assert_equals(sorted(key for _, key, _ in updates), ["a", "b"])
+        assert_equals(deletes, [("plugins", "claims")])
+        assert_equals(self.shelf.changes(), ([], []))
+
+    def test_apply_in_place(self):
+        player = self.shelf["players"]["a"]
+        storage = self.shelf["plugins"]["claims"]
+        self.shelf.apply([("players", "a", Entry("omega")),
+                          ("plugins", "claims", {"owners": ["a"]})], [])
+        assert_is(self.shelf["players"]["a"], player)
+        assert_equals(player.name, "omega")
+        assert_is(self.shelf["plugins"]["claims"], storage)
+        assert_equals(storage, {"owners": ["a"]})
+        # Changes that came in from elsewhere are not sent back out.
+        assert_equals(self.shelf.changes(), ([], []))
+
+    def test_apply_keeps_local_connection(self):
+        connection = object()
+        player = self.shelf["players"]["a"]
+        player.connection = connection
+        player.logged_in = True
+        self.shelf.apply([("players", "a", Entry("omega"))], [])
+        assert_equals(player.name, "omega")
+        assert_is(player.connection, connection)
+        assert_true(player.logged_in)
+
+    def test_apply_delete(self):
+        self.shelf.apply([], [("players", "a")])
+        assert_not_in("a", self.shelf["players"])
+        assert_equals(self.shelf.changes(), ([], []))
+
+    def test_sync(self):
+        self.shelf.sync()
+        assert_equals(self.client.pushed, 1)
+
+    def test_only_touched_entries_are_checked(self):
+        for i in range(100):
+            self.shelf["players"][str(i)] = Entry(str(i))
+        self.shelf.changes()
+        checked = []
+        digest = cluster.digest
+        cluster.digest = lambda value: checked.append(value) or digest(value)
+        try:
+            assert_equals(self.shelf.changes(), ([], []))
+            assert_equals(checked, [])
+            for player in self.shelf["players"].values():
+                player.name = "changed"
+            # Changes to entries that were never looked up have to be marked.
+            assert_equals(self.shelf.changes(), ([], []))
+            self.shelf.mark_dirty("players", "5")
+            self.shelf["players"]["7"]
+            updates, _ = self.shelf.changes()
+            assert_equals(sorted(key for _, key, _ in updates), ["5", "7"])
+            assert_equals(len(checked), 2)
+        finally:
+            cluster.digest = digest
+
+    def test_plugin_storage(self):
+        storage = self.shelf["plugins"]["claims"]
+        self.shelf.changes()
+        storage["owners"].append("a")
+        updates, _ = self.shelf.changes()
+        assert_equals(updates, [("plugins", "claims", {"owners": ["a"]})])
+        self.shelf["plugins"]["mail"] = DotDict({})
+        mail = self.shelf["plugins"]["mail"]
+        self.shelf.changes()
+        mail.inbox = []
+        updates, _ = self.shelf.changes()
+        assert_equals([key for _, key, _ in updates], ["mail"])
+        # Storage reaches the hub as a plain DotDict.
+        copied = pickle.loads(pickle.dumps(mail))
+        assert_is(type(copied), DotDict)
+        assert_equals(copied, {"inbox": []})
+
+    def test_watched_entries(self):
+        player = self.shelf["players"]["a"]
+        player.connection = object()
+        self.shelf.watch("players", "a")
+        self.shelf.changes()
+        player.name = "omega"
+        assert_equals(len(self.shelf.changes()[0]), 1)
+        player.connection = None
+        player.name = "alpha"
+        assert_equals(len(self.shelf.changes()[0]), 1)
+        # Once disconnected, it is no longer watched.
+        player.name = "beta"
+        assert_equals(self.shelf.changes(), ([], []))
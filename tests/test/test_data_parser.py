@@ -0,0 +1,293 @@
+import inspect
+import os
+import pickle
+import struct
+import zlib
+
+from nose.tools import *
+
+import data_parser
+import pparser
+from bench_parser import load_corpus, default_corpus
+from data_parser import Struct, Cursor, VLQ, SignedVLQ, StarString, \
+    StarByteArray
+
+
+def sample(field):
+    """
+    Bytes of a valid encoding of a field, whatever its type.
+    """
+    if field._struct_fields:
+        return b"".join(sample(f) for _, f in field._struct_fields)
+    fixed = data_parser._fixed_formats.get(field)
+    if fixed == "16s":
+        return bytes(range(16))
+    if fixed is not None:
+        return struct.pack(">" + fixed, 1)
+    return {
+        VLQ: VLQ.build(300),
+        SignedVLQ: SignedVLQ.build(-5),
+        StarString: StarString.build("hello"),
+        StarByteArray: StarByteArray.build(b"\x00\x01"),
+        data_parser.Variant: b"\x05" + StarString.build("v"),
+        data_parser.VariantVariant: b"\x01\x04\x06",
+        data_parser.LazyVariant: b"\x07\x01" + StarString.build("k") +
+        b"\x06\x01\x04\x06",
+        data_parser.StringSet: b"\x02" + StarString.build("a") +
+        StarString.build("b"),
+        data_parser.WorldChunks: b"\x01\x02ab\x01\x01c",
+        data_parser.StatusEffectList: b"\x02" + StarString.build("x") +
+        b"\x00" + StarString.build("y") + b"\x01" + struct.pack(">f", 2),
+        data_parser.ChatHeader: b"\x00" + StarString.build("ch") +
+        struct.pack(">H", 3),
+        data_parser.WarpAction: b"\x03" + struct.pack(">l", -1),
+        data_parser.SystemLocation: b"\x00",
+        data_parser.ClientContextSet: b"\x05\x03\x01\x01",
+    }[field]
+
+
+def declarative_structs():
+    return [cls for _, cls in inspect.getmembers(data_parser, inspect.isclass)
+            if issubclass(cls, Struct) and cls._struct_fields]
+
+
+def unloop(d):
+    """
+    Nested declarative structs parse into the enclosing context, and end up
+    referring to it; replace those references so results can be compared.
+    """
+    return {k: "<ctx>" if v is d else v for k, v in d.items()}
+
+
+class TestCompiledStructs:
+    def check_parse(self, cls):
+        data = sample(cls)
+        stream = Cursor(data)
+        expected = cls._parse_fields(stream, {})
+        assert_equals(stream.pos, len(data))
+        stream = Cursor(data)
+        result = cls.parse_stream(stream, {})
+        assert_equals(stream.pos, len(data))
+        assert_equals(unloop(result), unloop(expected))
+
+    def check_build(self, cls):
+        obj = cls.parse(sample(cls))
+        try:
+            expected = cls._build_fields(obj, {})
+        except Exception as err:
+            assert_raises(type(err), cls.build, obj)
+        else:
+            assert_equals(cls.build(obj), expected)
+
+    def test_parse_matches_reference(self):
+        for cls in declarative_structs():
+            yield self.check_parse, cls
+
+    def test_build_matches_reference(self):
+        for cls in declarative_structs():
+            yield self.check_build, cls
+
+    def test_round_trip(self):
+        obj = {"source_id": 1, "source_x": 1.5, "source_y": -2.5,
+               "target_id": 2, "target_x": 0.25, "target_y": 8.0,
+               "request_id": bytes(range(16))}
+        data = data_parser.EntityInteract.build(obj)
+        assert_equals(data, data_parser.EntityInteract._build_fields(obj, {}))
+        parsed = data_parser.EntityInteract.parse(data)
+        obj["request_id"] = b"000102030405060708090a0b0c0d0e0f"
+        assert_equals(parsed, obj)
+
+    def test_fixed_width_runs_are_merged(self):
+        parse, build = data_parser.compile_struct(data_parser.ConnectSuccess)
+        structs = [v for v in parse.__globals__.values()
+                   if isinstance(v, struct.Struct)]
+        # The UUID splits the build side, but not the parse side.
+        assert_equals(sorted(s.size for s in structs), [28, 44])
+
+
+class TestCorpus:
+    def test_covers_parse_map(self):
+        corpus = load_corpus(default_corpus)
+        assert_equals(set(corpus), {cls for cls in pparser.parse_map.values()
+                                    if cls is not None})
+
+    def test_payloads_parse(self):
+        for cls, values in load_corpus(default_corpus).items():
+            for data in values:
+                assert_is_instance(cls.parse(data), dict, cls.__name__)
+
+
+class TestCursor:
+    def test_byte_arrays_are_not_copied(self):
+        data = bytearray(StarByteArray.build(b"abc") + b"\x05")
+        res = StarByteArray.parse(data)
+        assert_is_instance(res, memoryview)
+        assert_equals(bytes(res), b"abc")
+        data[1] = ord("x")
+        assert_equals(bytes(res), b"xbc")
+
+    def test_strings(self):
+        assert_equals(StarString.parse(StarString.build("héllo")), "héllo")
+        assert_equals(StarString.parse(b"\x02\xff\xfe"), b"\xff\xfe")
+
+    def test_stream_interface(self):
+        stream = Cursor(b"abcdef")
+        assert_equals(stream.read(2), b"ab")
+        assert_equals(bytes(stream.peek()), b"cdef")
+        assert_equals(stream.read(), b"cdef")
+        assert_equals(stream.read(1), b"")
+
+    def test_short_payloads(self):
+        assert_equals(VLQ.parse(b"\x81"), 1)
+        assert_equals(data_parser.Byte.parse(b""), 0)
+        with assert_raises(struct.error):
+            data_parser.UBInt32.parse(b"\x00\x01")
+
+    def test_parse_accepts_streams(self):
+        stream = Cursor(b"\x00\x00\x00\x07")
+        assert_equals(data_parser.ProtocolRequest.parse(
+            memoryview(b"\x00\x00\x00\x07")), {"client_build": 7})
+        assert_equals(data_parser.UBInt32.parse(stream), 7)
+
+
+class TestBuildInto:
+    def test_appends_to_buffer(self):
+        out = bytearray(b"xy")
+        res = StarString.build_into("hello", out)
+        assert_is(res, out)
+        assert_equals(bytes(out), b"xy" + StarString.build("hello"))
+
+    def test_vlq(self):
+        for value, data in [(0, b"\x00"), (127, b"\x7f"), (128, b"\x81\x00"),
+                            (300, b"\x82\x2c"), (-5, b"")]:
+            assert_equals(VLQ.build(value), data)
+        for value in [2 ** 40, 2 ** 70]:
+            assert_equals(VLQ.parse(VLQ.build(value)), value)
+
+    def test_build_packet(self):
+        obj = {"message": "hello", "send_mode": 0}
+        for obj["message"] in ["hello", "x" * 70000]:
+            packet = data_parser.ChatSent.build_packet(11, obj)
+            assert_is_instance(packet, bytearray)
+            assert_equals(packet, pparser.build_packet(
+                11, data_parser.ChatSent.build(obj)))
+        packet = data_parser.ChatSent.build_packet(11, obj, compressed=True)
+        stream = Cursor(packet)
+        assert_equals(data_parser.Byte.parse_stream(stream), 11)
+        size = SignedVLQ.parse_stream(stream)
+        assert_equals(size, -(len(packet) - stream.pos))
+
+    def test_compression(self):
+        obj = {"message": "hello there " * 100, "send_mode": 0}
+        packet = data_parser.ChatSent.build_packet(11, obj)
+        stream = Cursor(packet)
+        data_parser.Byte.parse_stream(stream)
+        size = SignedVLQ.parse_stream(stream)
+        assert_equals(size, -(len(packet) - stream.pos))
+        assert_equals(zlib.decompress(packet[stream.pos:]),
+                      data_parser.ChatSent.build(obj))
+        assert_equals(packet, pparser.build_packet(
+            11, data_parser.ChatSent.build(obj)))
+        # Payloads that are too small, or don't shrink, are sent as they are.
+        for data in [b"hello", os.urandom(512)]:
+            assert_equals(pparser.build_packet(11, data)[-len(data):], data)
+        uncompressed = data_parser.ChatSent.build_packet(11, obj, False)
+        assert_equals(uncompressed[-len(obj["message"]) - 1:-1],
+                      obj["message"].encode())
+
+    def test_compressed_payloads_are_reused(self):
+        data = b"abc" * 1000
+        first, compressed = data_parser.compress_payload(data)
+        assert_true(compressed)
+        assert_is(data_parser.compress_payload(bytearray(data))[0], first)
+
+    def test_structs_with_only_build(self):
+        class Doubled(Struct):
+            @classmethod
+            def _build(cls, obj, ctx=None):
+                return bytes(2 * obj)
+
+        out = bytearray(b"a")
+        assert_equals(bytes(Doubled.build_into(b"b", out)), b"abb")
+        assert_equals(Doubled.build(b"c"), b"cc")
+
+
+class TestPartialParsing:
+    def test_declarative_structs(self):
+        data = sample(data_parser.EntityInteractResult)
+        full = data_parser.EntityInteractResult.parse(data)
+        res = data_parser.EntityInteractResult.parse_partial(
+            data, {"interaction_type"})
+        assert_equals(res, {"interaction_type": full["interaction_type"]})
+        res = data_parser.EntityInteractResult.parse_partial(
+            data, {"target_id"})
+        assert_equals(set(res), {"interaction_type", "target_id"})
+
+    def test_whole_structs(self):
+        data = sample(data_parser.EntityInteractResult)
+        full = data_parser.EntityInteractResult.parse(data)
+        for fields in [{"request_id"}, {"interaction_type", "bogus"}]:
+            assert_equals(data_parser.EntityInteractResult.parse_partial(
+                data, fields), full)
+
+    def test_entity_message(self):
+        obj = {"target_unique": False, "target_id": 4,
+               "message_name": "warp", "message_args": [1, "two"],
+               "message_uuid": b"000102030405060708090a0b0c0d0e0f",
+               "client_id": 2}
+        data = data_parser.EntityMessage.build(obj)
+        res = data_parser.EntityMessage.parse_partial(data, {"message_name"})
+        assert_equals(res, {"target_unique": False, "target_id": 4,
+                            "message_name": "warp"})
+        res = data_parser.EntityMessage.parse_partial(data, {"client_id"})
+        assert_equals(res, obj)
+
+
+class TestLazyVariant:
+    obj = {"celestialParameters": {"coordinate": {"location": [1, -2, 3],
+                                                  "planet": 4},
+                                   "biomes": ["forest"] * 50},
+           "raw": b"\xff", "flag": True}
+
+    def test_views(self):
+        data = data_parser.Variant.build(self.obj)
+        res = data_parser.LazyVariant.parse(data)
+        assert_is_instance(res, data_parser.VariantDict)
+        params = res["celestialParameters"]
+        assert_equals(params["coordinate"]["location"][-1], 3)
+        assert_equals(params["biomes"][1:3], ["forest", "forest"])
+        # Only what was looked at has been decoded.
+        assert_equals(len(params._values), 2)
+        assert_equals(len(params["biomes"]._values), 2)
+        assert_equals(res, self.obj)
+        assert_equals(res.materialize(), data_parser.Variant.parse(data))
+        assert_equals(dict(**params["coordinate"]),
+                      {"location": [1, -2, 3], "planet": 4})
+        assert_in("raw", res)
+        assert_not_in("bogus", res)
+
+    def test_scalars(self):
+        for obj in [None, 1.5, -7, "s"]:
+            assert_equals(data_parser.LazyVariant.parse(
+                data_parser.Variant.build(obj)), obj)
+
+    def test_building_views(self):
+        # Views build back into the bytes they came from, even where
+        # those aren't how the values would be built from scratch.
+        data = b"\x06\x02\x04\x80\x02\x07\x00"
+        res = data_parser.LazyVariant.parse(data)
+        assert_equals(data_parser.LazyVariant.build(res), data)
+        assert_equals(data_parser.Variant.build({"a": res}),
+                      b"\x07\x01\x01a" + data)
+
+    def test_pickled_as_plain_values(self):
+        res = data_parser.LazyVariant.parse(
+            data_parser.Variant.build(self.obj))
+        copied = pickle.loads(pickle.dumps(res))
+        assert_is(type(copied), dict)
+        assert_is(type(copied["celestialParameters"]["biomes"]), list)
+        assert_equals(copied, self.obj)
+
+    def test_bogus_counts(self):
+        assert_raises(ValueError, data_parser.LazyVariant.parse,
+                      b"\x06" + VLQ.build(2 ** 40) + b"\x01")
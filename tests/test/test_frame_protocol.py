@@ -0,0 +1,292 @@
+import asyncio
+import logging
+
+from nose.tools import *
+
+import server
+from frame_protocol import FrameProtocol
+
+
+def frame(packet_type, payload):
+    """
+    Build a raw frame: packet type, signed VLQ size, then the payload.
+    """
+    value = len(payload) << 1
+    size = bytearray([value & 0x7f])
+    value >>= 7
+    while value:
+        size.insert(0, (value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes([packet_type]) + bytes(size) + payload
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = []
+        self.closing = False
+        self.paused = False
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def writelines(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+    def close(self):
+        self.closing = True
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 21025) if name == "peername" else default
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+class FakeOutput:
+    """
+    Stands in for the OutputScheduler frames are forwarded to, recording
+    exactly what is handed to it.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def write(self, data):
+        self.calls.append(("write", data))
+
+    def begin_cut_through(self):
+        self.calls.append(("begin", None))
+
+    def write_cut_through(self, data):
+        self.calls.append(("cut", bytes(data)))
+
+    def end_cut_through(self):
+        self.calls.append(("end", None))
+
+
+class TestFrameProtocol:
+    def setup(self):
+        self.previous_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    def protocol(self, max_queued=4, cut_through_size=0, output=None):
+        protocol = FrameProtocol(lambda packet_type: packet_type == 17,
+                                 max_queued=max_queued,
+                                 cut_through_size=cut_through_size)
+        protocol.connection_made(FakeTransport())
+        protocol.output = output
+        return protocol
+
+    def read(self, protocol):
+        return self.loop.run_until_complete(protocol.read_frame())
+
+    def test_frames_split_across_reads(self):
+        frames = [frame(17, b"hello"), frame(47, bytes(200)),
+                  frame(17, b"")]
+        protocol = self.protocol(max_queued=16)
+        for byte in b"".join(frames):
+            protocol.data_received(bytes([byte]))
+        for raw in frames:
+            packet_type, packet_size, data, header_length = \
+                self.read(protocol)
+            assert_equals(data, raw)
+            assert_equals(packet_type, raw[0])
+            assert_equals(packet_size, len(raw) - header_length)
+        assert_equals(protocol.buffered(), 0)
+
+    def test_header_split_across_reads(self):
+        raw = frame(17, bytes(200))
+        protocol = self.protocol()
+        protocol.data_received(raw[:2])
+        assert_equals(protocol.buffered(), 2)
+        protocol.data_received(raw[2:])
+        assert_equals(self.read(protocol), (17, 200, raw, 3))
+
+    def test_forwarding_order(self):
+        output = FakeOutput()
+        protocol = self.protocol(output=output)
+        first, second = frame(47, b"a"), frame(47, b"bb")
+        hooked, after = frame(17, b"c"), frame(47, b"d")
+        protocol.data_received(first + second + hooked + after)
+        # The unhooked run ahead of the hooked frame goes out in one slice
+        # of the received data; the frame behind it has to wait its turn.
+        assert_equals(len(output.calls), 1)
+        call, data = output.calls[0]
+        assert_equals(call, "write")
+        assert_is_instance(data, memoryview)
+        assert_equals(bytes(data), first + second)
+        assert_equals(self.read(protocol)[2], hooked)
+        assert_equals(self.read(protocol)[2], after)
+        # While the hooked frame is in flight, nothing may overtake it.
+        protocol.data_received(frame(47, b"e"))
+        assert_equals(len(output.calls), 1)
+        assert_equals(self.read(protocol)[2], frame(47, b"e"))
+        assert_equals(protocol.forwarded, 2)
+        assert_equals(protocol.queued, 3)
+
+    def test_cut_through(self):
+        output = FakeOutput()
+        protocol = self.protocol(cut_through_size=100, output=output)
+        large, small = frame(47, bytes(range(200))), frame(47, b"x")
+        protocol.data_received(large[:50])
+        protocol.data_received(large[50:120])
+        assert_equals([call for call, _ in output.calls],
+                      ["begin", "cut", "cut"])
+        protocol.data_received(large[120:] + small)
+        assert_equals([call for call, _ in output.calls],
+                      ["begin", "cut", "cut", "cut", "end", "write"])
+        assert_equals(b"".join(data for call, data in output.calls
+                               if call == "cut"), large)
+        assert_equals(bytes(output.calls[-1][1]), small)
+        assert_equals(protocol.streamed, 1)
+
+    def test_hooked_frames_are_not_cut_through(self):
+        output = FakeOutput()
+        protocol = self.protocol(cut_through_size=100, output=output)
+        large = frame(17, bytes(200))
+        protocol.data_received(large[:50])
+        protocol.data_received(large[50:])
+        assert_equals(output.calls, [])
+        assert_equals(self.read(protocol)[2], large)
+
+    def test_reading_pauses_when_queue_is_full(self):
+        protocol = self.protocol(max_queued=4)
+        protocol.data_received(b"".join(frame(17, bytes([i]))
+                                        for i in range(4)))
+        assert_true(protocol.transport.paused)
+        self.read(protocol)
+        assert_true(protocol.transport.paused)
+        self.read(protocol)
+        assert_false(protocol.transport.paused)
+        stats = protocol.stats()
+        assert_equals(stats["depth"], 2)
+        assert_equals(stats["max_depth"], 4)
+        assert_equals(stats["stalls"], 1)
+        assert_true(stats["stall_time"] >= 0)
+
+    def test_every_drain_is_woken(self):
+        protocol = self.protocol()
+        protocol.pause_writing()
+        first = self.loop.create_task(protocol.drain())
+        second = self.loop.create_task(protocol.drain())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        assert_false(first.done() or second.done())
+        protocol.resume_writing()
+        self.loop.run_until_complete(asyncio.wait([first, second],
+                                                  timeout=1))
+        assert_true(first.done() and second.done())
+        assert_is_none(first.result())
+        assert_is_none(second.result())
+
+    def test_connection_lost_wakes_reader(self):
+        protocol = self.protocol()
+        reader = self.loop.create_task(protocol.read_frame())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        protocol.connection_lost(None)
+        with assert_raises(asyncio.IncompleteReadError):
+            self.loop.run_until_complete(reader)
+        assert_true(protocol.at_eof())
+
+    def test_connection_lost_fails_drains(self):
+        protocol = self.protocol()
+        protocol.pause_writing()
+        drains = [self.loop.create_task(protocol.drain()) for _ in range(2)]
+        self.loop.run_until_complete(asyncio.sleep(0))
+        protocol.connection_lost(None)
+        for drain in drains:
+            with assert_raises(ConnectionResetError):
+                self.loop.run_until_complete(drain)
+
+
+class FakePluginManager:
+    def __init__(self):
+        self.seen = []
+
+    @asyncio.coroutine
+    def do(self, connection, name, packet):
+        self.seen.append(name)
+        return True
+
+
+class FakeFactory:
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.plugin_manager = FakePluginManager()
+        self.removed = []
+
+    @asyncio.coroutine
+    def upstream_connection(self):
+        return self.upstream, self.upstream
+
+    def is_hooked(self, packet_type, direction=None):
+        return packet_type == 17
+
+    def remove(self, connection):
+        self.removed.append(connection)
+
+
+class FakeConfig:
+    config = {"write_buffer_high_water": 65536,
+              "write_buffer_low_water": 16384}
+
+
+class TestProtocolStarryPyServer:
+    def setup(self):
+        self.previous_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # server.py only sets up its logger when run as a script.
+        self.previous_logger = getattr(server, "logger", None)
+        server.logger = logging.getLogger("starrypy")
+
+    def teardown(self):
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+        if self.previous_logger is None:
+            del server.logger
+        else:
+            server.logger = self.previous_logger
+
+    def protocol(self):
+        protocol = FrameProtocol(
+            lambda packet_type: packet_type == 17, max_queued=4)
+        protocol.connection_made(FakeTransport())
+        return protocol
+
+    def test_frames_reach_the_other_side_in_order(self):
+        client = self.protocol()
+        upstream = self.protocol()
+        factory = FakeFactory(upstream)
+        connection = server.ProtocolStarryPyServer(client, client,
+                                                   FakeConfig(), factory)
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        frames = [frame(47, b"a"), frame(17, b"b"), frame(47, b"c")]
+        client.data_received(b"".join(frames))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        assert_equals(b"".join(upstream.transport.written),
+                      b"".join(frames))
+        assert_equals(factory.plugin_manager.seen, ["chat_sent"])
+        stats = connection.pipeline_stats()["TO_SERVER"]
+        assert_equals(stats["forwarded"], 1)
+        assert_equals(stats["queued"], 2)
+        assert_equals(stats["depth"], 0)
+        connection.die()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        assert_equals(factory.removed, [connection])
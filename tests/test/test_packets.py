@@ -0,0 +1,23 @@
+from nose.tools import *
+
+from packets import packets, registry
+from utilities import ParsePolicy
+
+
+class TestRegistry:
+    def test_indexed_by_id(self):
+        assert_equals(len(registry), 256)
+        for packet_id, info in enumerate(registry):
+            assert_equals(info.id, packet_id)
+
+    def test_names(self):
+        assert_equals(registry[12].name, "client_connect")
+        assert_equals(registry[54].name, "entity_message")
+        for name in ["chat_sent", "world_start", "system_object_spawn"]:
+            assert_equals(registry[packets[name]].name, name)
+        assert_equals(registry[200].policy, ParsePolicy.NEVER)
+
+    def test_policies(self):
+        for info in registry:
+            assert_equals(info.struct is None,
+                          info.policy == ParsePolicy.NEVER, info.name)
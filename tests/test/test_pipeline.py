@@ -0,0 +1,87 @@
+import asyncio
+
+from nose.tools import *
+
+from pipeline import PacketPipeline
+from utilities import Direction
+
+
+class FakeOutput:
+    def __init__(self, sent):
+        self.sent = sent
+
+    def write(self, data):
+        self.sent.append(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Feeds a fixed list of frames through the pipeline. Hooked frames (type
+    17) are slow to get through the plugins.
+    """
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+        self.output = FakeOutput(self.sent)
+
+    @asyncio.coroutine
+    def read_frame(self, reader, cut_through=None):
+        yield from asyncio.sleep(0)
+        if not self.frames:
+            raise asyncio.IncompleteReadError(b"", None)
+        return self.frames.pop(0)
+
+    def is_hooked(self, packet_type, direction=None):
+        return packet_type == 17
+
+    @asyncio.coroutine
+    def handle_frame(self, frame, direction):
+        if self.is_hooked(frame[0]):
+            yield from asyncio.sleep(0.01)
+        self.output.write(frame[2])
+
+    def die(self):
+        pass
+
+
+class TestPacketPipeline:
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        self.loop.close()
+
+    def run(self, frames, maxsize=256):
+        connection = FakeConnection(frames)
+        pipeline = PacketPipeline(connection, None, connection.output,
+                                  Direction.TO_SERVER, maxsize)
+        with assert_raises(asyncio.IncompleteReadError):
+            self.loop.run_until_complete(pipeline.run())
+        return connection.sent, pipeline
+
+    def test_order_is_preserved(self):
+        frames = [(17 if i % 5 == 0 else 47, 1, bytes([i]), 2)
+                  for i in range(50)]
+        sent, pipeline = self.run(frames)
+        assert_equals(sent, [f[2] for f in frames])
+        assert_equals(pipeline.depth, 0)
+
+    def test_unhooked_frames_skip_the_queue(self):
+        frames = [(47, 1, bytes([i]), 2) for i in range(10)]
+        sent, pipeline = self.run(frames)
+        assert_equals(sent, [f[2] for f in frames])
+        assert_equals(pipeline.forwarded, 10)
+        assert_equals(pipeline.queued, 0)
+
+    def test_stalls_are_counted(self):
+        frames = [(17, 1, bytes([i]), 2) for i in range(10)]
+        sent, pipeline = self.run(frames, maxsize=2)
+        assert_equals(sent, [f[2] for f in frames])
+        assert_equals(pipeline.max_depth, 2)
+        assert_true(pipeline.stalls > 0)
+        assert_true(pipeline.stall_time > 0)
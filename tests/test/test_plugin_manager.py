@@ -2,8 +2,10 @@ import asyncio
 
 from nose.tools import *
 
+from base_plugin import BasePlugin
 from plugin_manager import PluginManager
-from utilities import path
+from utilities import path, reads, directions, make_packet, Direction, \
+    priority, observer
 
 
 class TestPluginManager:
@@ -114,4 +116,167 @@ class TestPluginManager:
         assert_equal({x.name for x in self.plugin_manager._activated_plugins},
                      {'test_plugin_1', 'test_plugin_2'})
 
+    def test_hooked_types(self):
+        hooked = self.plugin_manager._build_hooked_types(
+            {'on_chat_sent', 'on_world_start', 'activate'})
+        assert_equal(len(hooked), 256)
+        assert_equal({i for i, x in enumerate(hooked) if x}, {17, 20})
 
+    def test_hook_fields(self):
+        class Reader(BasePlugin):
+            @reads("message")
+            def on_chat_sent(self, data, connection):
+                return True
+
+            @reads()
+            def on_step_update(self, data, connection):
+                return True
+
+        class Other(BasePlugin):
+            @reads("send_mode")
+            def on_chat_sent(self, data, connection):
+                return True
+
+            def on_world_start(self, data, connection):
+                return True
+
+        self.plugin_manager._plugins = {"reader": Reader.__new__(Reader),
+                                        "other": Other.__new__(Other)}
+        fields = self.plugin_manager._build_hook_fields(
+            {"on_chat_sent", "on_step_update", "on_world_start"})
+        assert_equal(fields, {"chat_sent": {"message", "send_mode"},
+                              "step_update": set()})
+
+    def test_dispatch_table(self):
+        calls = []
+
+        class First(BasePlugin):
+            def on_chat_sent(self, data, connection):
+                calls.append("first")
+                return True
+
+        class Second(BasePlugin):
+            def on_chat_sent(self, data, connection):
+                calls.append("second")
+                return False
+
+            def on_world_start(self, data, connection):
+                return True
+
+        first, second = First.__new__(First), Second.__new__(Second)
+        self.plugin_manager._plugins = {"first": first, "second": second}
+        self.plugin_manager._activated_plugins = {first, second}
+        hooks = self.plugin_manager._build_hooks()[Direction.TO_SERVER]
+        assert_equal(len(hooks), 256)
+        assert_equal([hook.__self__ for hook in hooks[17][0]],
+                     [first, second])
+        assert_equal(hooks[20], ((second.on_world_start,), ()))
+        assert_is_none(hooks[6])
+        self.plugin_manager._refresh_hooks()
+        self.plugin_manager.hook_fields = ({"chat_sent": frozenset()},) * 2
+        result = self.loop.run_until_complete(self.plugin_manager.do(
+            None, "chat_sent", {"type": 17,
+                                "direction": Direction.TO_SERVER}))
+        assert_false(result)
+        assert_equal(calls, ["first", "second"])
+        self.plugin_manager._activated_plugins = {first}
+        assert_is_none(self.plugin_manager._build_hooks()[0][20])
+
+    def test_directions(self):
+        class Filter(BasePlugin):
+            @reads("message")
+            @directions(Direction.TO_SERVER)
+            def on_chat_sent(self, data, connection):
+                return False
+
+            @directions(Direction.TO_CLIENT)
+            def on_world_start(self, data, connection):
+                return True
+
+        class Logger(BasePlugin):
+            def on_world_start(self, data, connection):
+                return True
+
+        plugin, logger = Filter.__new__(Filter), Logger.__new__(Logger)
+        self.plugin_manager._plugins = {"filter": plugin, "logger": logger}
+        self.plugin_manager._activated_plugins = {plugin, logger}
+        self.plugin_manager._refresh_hooks()
+        to_client, to_server = self.plugin_manager.hooked_directions
+        assert_true(to_server[17])
+        assert_false(to_client[17])
+        assert_true(to_client[20] and to_server[20])
+        hooks = self.plugin_manager._hooks
+        assert_equal(hooks[Direction.TO_SERVER][20],
+                     ((logger.on_world_start,), ()))
+        assert_equal(len(hooks[Direction.TO_CLIENT][20][0]), 2)
+        overrides = {"on_chat_sent", "on_world_start"}
+        assert_equal(self.plugin_manager._build_hook_fields(
+            overrides, Direction.TO_CLIENT), {"chat_sent": set()})
+        assert_equal(self.plugin_manager._build_hook_fields(
+            overrides, Direction.TO_SERVER), {"chat_sent": {"message"}})
+        result = self.loop.run_until_complete(self.plugin_manager.do(
+            None, "chat_sent", {"type": 17,
+                                "direction": Direction.TO_CLIENT}))
+        assert_true(result)
+
+    def test_pipeline(self):
+        calls = []
+
+        class Spam(BasePlugin):
+            @priority(10)
+            def on_chat_sent(self, data, connection):
+                calls.append("spam")
+                return data["parsed"] != "spam"
+
+        class Relay(BasePlugin):
+            def on_chat_sent(self, data, connection):
+                calls.append("relay")
+                return True
+
+        class Logger(BasePlugin):
+            @observer(dropped=True)
+            def on_chat_sent(self, data, connection):
+                calls.append("logger")
+                return False
+
+        class Bridge(BasePlugin):
+            @observer()
+            def on_chat_sent(self, data, connection):
+                calls.append("bridge")
+
+        plugins = [cls.__new__(cls) for cls in [Logger, Bridge, Relay, Spam]]
+        self.plugin_manager._plugins = {str(i): plugin
+                                        for i, plugin in enumerate(plugins)}
+        self.plugin_manager._activated_plugins = set(plugins)
+        self.plugin_manager._refresh_hooks()
+        self.plugin_manager.hook_fields = ({},) * 2
+        self.plugin_manager._packet_parser.parse = asyncio.coroutine(
+            lambda packet, fields: packet)
+
+        def send(message):
+            del calls[:]
+            return self.loop.run_until_complete(self.plugin_manager.do(
+                None, "chat_sent", {"type": 17, "parsed": message,
+                                    "direction": Direction.TO_SERVER}))
+
+        assert_true(send("hello"))
+        assert_equal(calls, ["spam", "relay", "logger", "bridge"])
+        assert_false(send("spam"))
+        assert_equal(calls, ["spam", "logger"])
+
+    def test_corrupt_payloads_are_not_sent_on(self):
+        class Reader(BasePlugin):
+            def on_chat_sent(self, data, connection):
+                return data["data"] is not None
+
+        plugin = Reader.__new__(Reader)
+        self.plugin_manager._plugins = {"reader": plugin}
+        self.plugin_manager._activated_plugins = {plugin}
+        self.plugin_manager._refresh_hooks()
+        self.plugin_manager.hook_fields = ({},) * 2
+        self.plugin_manager._packet_parser.parse = asyncio.coroutine(
+            lambda packet, fields: packet)
+        packet = make_packet(17, -4, b"\x11\x07junk", 2, Direction.TO_SERVER)
+        with assert_raises(asyncio.IncompleteReadError):
+            self.loop.run_until_complete(self.plugin_manager.do(
+                None, "chat_sent", packet))
@@ -0,0 +1,247 @@
+import asyncio
+import zlib
+
+from nose.tools import *
+
+import data_parser
+import pparser
+from bench_parser import load_corpus, default_corpus
+from pparser import PacketCache, PacketParser, PacketTemplates, \
+    build_packet, patch_packet
+from utilities import DotDict, make_packet, Direction
+from data_parser import ChatSent, ChatReceived, EntityMessage, FlyShip, \
+    ConnectFailure
+
+
+class FakeConfig:
+    def __init__(self, **settings):
+        self.config = DotDict({"min_cache_size": 4,
+                               "packet_cache_size": 4096,
+                               "parse_offload_size": 0,
+                               "parser_stats_interval": 600})
+        self.config.update(settings)
+
+
+def chat(message):
+    frame = bytes(build_packet(17, ChatSent.build({"message": message,
+                                                   "send_mode": 0})))
+    return make_packet(17, len(frame) - 2, frame, 2, Direction.TO_SERVER)
+
+
+class TestPacketCache:
+    def test_lru_eviction(self):
+        cache = PacketCache(80)
+        for key in [b"a", b"b", b"c"]:
+            assert_true(cache.put(key, key.upper(), 10))
+        assert_equals(cache.get(b"a"), b"A")
+        for key in [b"d", b"e", b"f", b"g", b"h", b"i"]:
+            cache.put(key, key.upper(), 10)
+        assert_equals(cache.size, 80)
+        assert_is_none(cache.get(b"b"))
+        assert_equals(cache.get(b"a"), b"A")
+        assert_equals(cache.evictions, 1)
+
+    def test_exact_keys(self):
+        cache = PacketCache(800)
+        cache.put(b"abc", 1, 3)
+        assert_is_none(cache.get(b"abd"))
+        assert_equals(cache.get(memoryview(b"abc")), 1)
+        stats = cache.stats()
+        assert_equals((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_replacing_an_entry(self):
+        cache = PacketCache(800)
+        cache.put(b"abc", 1, 30)
+        cache.put(b"abc", 2, 40)
+        assert_equals((len(cache), cache.size), (1, 40))
+        assert_equals(cache.get(b"abc"), 2)
+
+    def test_oversized_entries_are_rejected(self):
+        cache = PacketCache(800)
+        assert_false(cache.put(b"world", {}, 101))
+        assert_equals((len(cache), cache.rejected), (0, 1))
+
+
+class TestPacketTemplates:
+    destination = {"world_x": 1, "world_y": 2, "world_z": 3,
+                   "location": {"type": 0}}
+
+    def test_built_once(self):
+        templates = PacketTemplates()
+        first = templates.get(16, FlyShip, self.destination)
+        assert_equals(first, bytes(FlyShip.build_packet(16, self.destination)))
+        assert_is(templates.get(16, FlyShip, dict(self.destination)), first)
+        other = templates.get(16, FlyShip, dict(self.destination, world_z=4))
+        assert_not_equals(other, first)
+        assert_equals((templates.hits, templates.misses), (1, 2))
+
+    def test_capacity(self):
+        templates = PacketTemplates(2)
+        for reason in ["a", "b", "a", "c"]:
+            templates.get(4, ConnectFailure, {"reason": reason})
+        assert_equals(len(templates), 2)
+        templates.get(4, ConnectFailure, {"reason": "b"})
+        assert_equals(templates.misses, 4)
+
+    def test_invalidation(self):
+        templates = PacketTemplates()
+        templates.get(16, FlyShip, self.destination)
+        templates.get(4, ConnectFailure, {"reason": "a"})
+        templates.invalidate(16)
+        assert_equals(len(templates), 1)
+        templates.invalidate()
+        assert_equals(len(templates), 0)
+
+
+class TestPacketParser:
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.parsers = []
+
+    def teardown(self):
+        for parser in self.parsers:
+            parser._reporter.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def parser(self, **settings):
+        parser = PacketParser(FakeConfig(**settings))
+        self.parsers.append(parser)
+        return parser
+
+    def parse(self, parser, packet, fields=None):
+        return self.loop.run_until_complete(parser.parse(packet, fields))
+
+    def test_repeats_are_cached(self):
+        parser = self.parser()
+        first = self.parse(parser, chat("hello"))
+        second = self.parse(parser, chat("hello"))
+        other = self.parse(parser, chat("hullo"))
+        assert_is(second["parsed"], first["parsed"])
+        assert_equals(other["parsed"]["message"], "hullo")
+        stats = parser.cache_stats()
+        assert_equals((stats["hits"], stats["misses"], stats["entries"]),
+                      (1, 2, 2))
+
+    def test_admission(self):
+        parser = self.parser(min_cache_size=100)
+        self.parse(parser, chat("hello"))
+        assert_equals(parser.cache_stats()["misses"], 0)
+        parser = self.parser(packet_cache_size=0)
+        packet = self.parse(parser, chat("hello"))
+        assert_equals(packet["parsed"]["message"], "hello")
+        assert_equals(parser.cache_stats()["entries"], 0)
+
+    def test_uncached_types(self):
+        parser = self.parser()
+        packet = chat("hello")
+        packet["type"] = 54
+        assert_in(54, pparser.uncached_types)
+        assert_false(parser._cacheable(packet))
+
+    def test_lazy_types(self):
+        parser = self.parser()
+        packet = chat("hello")
+        packet["type"] = 54
+        packet["data"] = EntityMessage.build(
+            {"target_unique": False, "target_id": 4, "message_name": "warp",
+             "message_args": [], "client_id": 2,
+             "message_uuid": b"000102030405060708090a0b0c0d0e0f"})
+        packet = self.parse(parser, packet)
+        assert_not_in("parsed", dict(packet))
+        assert_equals(packet["parsed"]["message_name"], "warp")
+        packet = chat("hello")
+        packet["type"] = 54
+        packet = self.parse(parser, packet, set())
+        assert_equals(packet["parsed"], {})
+
+    def test_never_parsed_types(self):
+        parser = self.parser()
+        packet = chat("hello")
+        packet["type"] = 18
+        assert_equals(self.parse(parser, packet)["parsed"], {})
+
+    def test_corrupt_payloads_drop_the_connection(self):
+        parser = self.parser()
+        packet = make_packet(17, -4, b"\x11\x07junk", 2, Direction.TO_SERVER)
+        with assert_raises(asyncio.IncompleteReadError):
+            self.parse(parser, packet)
+
+    def test_only_offload_types_are_offloaded(self):
+        parser = self.parser(parse_offload_size=1,
+                             parse_offload_workers=1)
+        packet = self.parse(parser, chat("hello"))
+        assert_equals(packet["parsed"]["message"], "hello")
+        assert_equals(parser.offloaded, 0)
+        data = load_corpus(default_corpus)[data_parser.WorldStart][0]
+        frame = bytes(build_packet(20, data, False))
+        packet = make_packet(20, len(data), frame, len(frame) - len(data),
+                             Direction.TO_CLIENT)
+        packet = self.parse(parser, packet)
+        assert_in("client_id", packet["parsed"])
+        assert_equals(parser.offloaded, 1)
+        parser.executor.shutdown()
+
+    def test_projections(self):
+        parser = self.parser()
+        packet = self.parse(parser, chat("hello"), {"message"})
+        assert_equals(packet["parsed"]["message"], "hello")
+        packet = self.parse(parser, chat("hello"), set())
+        assert_equals(packet["parsed"], {})
+        # Only whole packets go in the cache.
+        assert_equals(parser.cache_stats()["entries"], 0)
+
+
+class TestPatchPacket:
+    received = {"header": {"mode": 0, "channel": "c", "client_id": 3},
+                "name": "bob", "junk": 0, "message": "hi"}
+
+    def packet(self, packet_type, struct, obj, compressed=False):
+        data = struct.build(obj)
+        if compressed:
+            frame = bytes([packet_type]) + \
+                data_parser.SignedVLQ.build(-len(zlib.compress(data))) + \
+                zlib.compress(data)
+        else:
+            frame = bytes(build_packet(packet_type, data))
+        size = len(zlib.compress(data)) if compressed else len(data)
+        return make_packet(packet_type, -size if compressed else size,
+                           frame, len(frame) - size, Direction.TO_CLIENT)
+
+    def test_splices_fields(self):
+        packet = self.packet(6, ChatReceived, self.received)
+        patch_packet(packet, name="^red;bob^reset;", message="hello" * 40)
+        expected = dict(self.received, name="^red;bob^reset;",
+                        message="hello" * 40)
+        assert_equals(bytes(packet["original_data"]),
+                      bytes(build_packet(6, ChatReceived.build(expected))))
+        assert_equals(packet["parsed"]["message"], "hello" * 40)
+        assert_equals(packet["size"], len(packet["data"]))
+
+    def test_compressed_packets(self):
+        packet = self.packet(6, ChatReceived, self.received, True)
+        patch_packet(packet, message="yo")
+        assert_false(packet["compressed"])
+        assert_equals(ChatReceived.parse(packet["data"]),
+                      dict(self.received, message="yo"))
+
+    def test_shared_parsed_forms_are_left_alone(self):
+        packet = self.packet(6, ChatReceived, self.received)
+        parsed = packet["parsed"] = ChatReceived.parse(packet["data"])
+        patch_packet(packet, name="alice")
+        assert_equals(parsed["name"], "bob")
+        assert_equals(packet["parsed"]["name"], "alice")
+
+    def test_structs_without_fields_are_rebuilt(self):
+        obj = {"target_unique": False, "target_id": 1,
+               "message_name": "a", "message_args": [],
+               "message_uuid": b"00" * 16, "client_id": 0}
+        packet = self.packet(54, EntityMessage, obj)
+        patch_packet(packet, message_name="warp")
+        assert_equals(EntityMessage.parse(packet["data"])["message_name"],
+                      "warp")
+
+    def test_unknown_fields(self):
+        packet = self.packet(6, ChatReceived, self.received)
+        assert_raises(KeyError, patch_packet, packet, bogus=1)
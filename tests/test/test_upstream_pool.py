@@ -0,0 +1,117 @@
+import asyncio
+
+from nose.tools import *
+
+from upstream_pool import UpstreamPool
+
+
+class FakeTransport:
+    def __init__(self):
+        self.closing = False
+
+    def is_closing(self):
+        return self.closing
+
+
+class FakeWriter:
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def close(self):
+        self.transport.closing = True
+
+
+class TestUpstreamPool:
+    def setup(self):
+        self.previous_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.opened = []
+        self.pool = UpstreamPool(self.opener, 4, idle_timeout=30, window=10,
+                                 check_interval=0.01)
+
+    def teardown(self):
+        self.pool.close()
+        # Let the cancelled maintainer and any pending opens finish.
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(self.previous_loop)
+
+    @asyncio.coroutine
+    def opener(self):
+        connection = (asyncio.StreamReader(), FakeWriter())
+        self.opened.append(connection)
+        return connection
+
+    def settle(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def acquire(self):
+        return self.loop.run_until_complete(self.pool.acquire())
+
+    def test_prewarm(self):
+        self.pool.start()
+        self.settle()
+        assert_equals(self.pool.size, 1)
+        connection = self.acquire()
+        assert_equals(connection, self.opened[0])
+        assert_equals(self.pool.hits, 1)
+
+    def test_grows_with_demand(self):
+        self.pool.start()
+        self.settle()
+        for _ in range(6):
+            self.acquire()
+        self.settle()
+        assert_equals(self.pool.target, 4)
+        assert_equals(self.pool.size, 4)
+
+    def test_closed_connections_are_skipped(self):
+        self.pool.start()
+        self.settle()
+        stale = self.opened[0]
+        stale[0].feed_eof()
+        connection = self.acquire()
+        assert_not_equal(connection, stale)
+        assert_true(stale[1].transport.closing)
+        assert_equals(self.pool.discarded, 1)
+
+    def test_connections_with_data_are_skipped(self):
+        self.pool.start()
+        self.settle()
+        stale = self.opened[0]
+        stale[0].feed_data(b"x")
+        connection = self.acquire()
+        assert_not_equal(connection, stale)
+        assert_true(stale[1].transport.closing)
+        assert_equals(self.pool.discarded, 1)
+
+    def test_failed_opens_are_counted(self):
+        errors = [asyncio.TimeoutError(), ConnectionRefusedError(),
+                  ValueError("bad address")]
+
+        @asyncio.coroutine
+        def opener():
+            raise errors.pop(0)
+
+        self.pool._opener = opener
+        self.pool.max_size = self.pool.min_size = 3
+        self.pool._refill()
+        self.settle()
+        assert_equals(self.pool.failures, 3)
+        assert_equals(self.pool.size, 0)
+        assert_equals(self.pool._opening, 0)
+
+    def test_idle_expiry(self):
+        self.pool.idle_timeout = 0.02
+        self.pool.start()
+        self.settle()
+        assert_true(self.pool.expired > 0)
+        assert_true(self.opened[0][1].transport.closing)
+
+    def test_close(self):
+        self.pool.start()
+        self.settle()
+        self.pool.close()
+        assert_equals(self.pool.size, 0)
+        assert_true(self.opened[0][1].transport.closing)
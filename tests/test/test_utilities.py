@@ -0,0 +1,243 @@
+import asyncio
+import zlib
+
+from nose.tools import *
+
+from utilities import make_packet, decode_frame_header, Direction, Packet, \
+    OutputScheduler, cut_through, read_frame
+
+
+class TestPacket:
+    def setup(self):
+        self.payload = b"starbound" * 100
+        self.compressed = zlib.compress(self.payload)
+
+    def test_uncompressed_packet(self):
+        p = make_packet(17, 1, b"\x11\x02\x00", 2, Direction.TO_SERVER)
+        assert_is_instance(p, Packet)
+        assert_equals(p["data"], b"\x00")
+        assert_equals(p["original_data"], b"\x11\x02\x00")
+        assert_false(p["compressed"])
+
+    def test_compressed_packet_is_lazy(self):
+        p = make_packet(20, -len(self.compressed),
+                        b"\x14\x00" + self.compressed, 2,
+                        Direction.TO_CLIENT)
+        assert_true(p["compressed"])
+        assert_equals(p["size"], len(self.compressed))
+        assert_not_in("data", dict(p))
+        assert_in("data", p)
+        assert_equals(p["data"], self.payload)
+        assert_equals(dict(p)["data"], self.payload)
+        assert_is(p["data"], p.get("data"))
+
+    def test_corrupt_compressed_packet(self):
+        p = make_packet(20, -4, b"\x14\x07junk", 2, Direction.TO_CLIENT)
+        assert_raises(asyncio.IncompleteReadError, lambda: p["data"])
+        assert_raises(asyncio.IncompleteReadError, p.get, "data")
+
+    def test_missing_key(self):
+        p = make_packet(17, 1, b"\x11\x02\x00", 2, Direction.TO_SERVER)
+        assert_raises(KeyError, lambda: p["parsed"])
+        assert_is_none(p.get("parsed"))
+
+    def test_parse_later(self):
+        p = make_packet(17, 1, b"\x11\x02\x00", 2, Direction.TO_SERVER)
+        calls = []
+
+        def parser(packet):
+            calls.append(packet)
+            return {"parsed": packet["data"]}
+
+        p.parse_later(parser)
+        assert_in("parsed", p)
+        assert_equals(calls, [])
+        assert_equals(p["parsed"], {"parsed": b"\x00"})
+        assert_is(p.get("parsed"), p["parsed"])
+        assert_equals(len(calls), 1)
+
+    def test_failed_parse_is_retried(self):
+        p = make_packet(17, 1, b"\x11\x02\x00", 2, Direction.TO_SERVER)
+        calls = []
+
+        def parser(packet):
+            calls.append(packet)
+            if len(calls) == 1:
+                raise ValueError("bad packet")
+            return {}
+
+        p.parse_later(parser)
+        assert_raises(ValueError, lambda: p["parsed"])
+        assert_in("parsed", p)
+        assert_equals(p["parsed"], {})
+        assert_equals(len(calls), 2)
+
+
+class TestFrameHeader:
+    def test_decode_header(self):
+        assert_equals(decode_frame_header(b"\x11\x04abcd"), (17, 2, 2))
+
+    def test_decode_multibyte_header(self):
+        # 300 bytes, compressed: signed VLQ of -300 is 599.
+        assert_equals(decode_frame_header(b"\x14\x84\x57" + b"x" * 10),
+                      (20, -300, 3))
+
+    def test_decode_with_offset(self):
+        assert_equals(decode_frame_header(b"junk\x06\x02", 4), (6, 1, 2))
+
+    def test_incomplete_header(self):
+        assert_is_none(decode_frame_header(b""))
+        assert_is_none(decode_frame_header(b"\x14"))
+        assert_is_none(decode_frame_header(b"\x14\x84"))
+
+
+class FakeWriter:
+    def __init__(self):
+        self.calls = []
+        self.drained = 0
+
+    def write(self, data):
+        self.calls.append([data])
+
+    def writelines(self, data):
+        self.calls.append(list(data))
+
+    @asyncio.coroutine
+    def drain(self):
+        self.drained += 1
+
+    def close(self):
+        self.calls.append(None)
+
+
+class TestOutputScheduler:
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.writer = FakeWriter()
+        self.output = OutputScheduler(self.writer, high_water=10)
+
+    def teardown(self):
+        self.loop.close()
+
+    def test_writes_are_coalesced(self):
+        self.output.write(b"a")
+        self.output.write(b"b")
+        self.output.write(b"c")
+        assert_equals(self.writer.calls, [])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        assert_equals(self.writer.calls, [[b"a", b"b", b"c"]])
+
+    @asyncio.coroutine
+    def write_and_drain(self, *data):
+        for d in data:
+            self.output.write(d)
+        yield from self.output.drain()
+        return list(self.writer.calls)
+
+    def test_drain_below_high_water(self):
+        calls = self.loop.run_until_complete(self.write_and_drain(b"abc"))
+        assert_equals(self.writer.drained, 0)
+        assert_equals(calls, [])
+
+    def test_drain_above_high_water(self):
+        calls = self.loop.run_until_complete(
+            self.write_and_drain(b"abcdef", b"ghijkl"))
+        assert_equals(self.writer.drained, 1)
+        assert_equals(calls, [[b"abcdef", b"ghijkl"]])
+
+    def test_close_flushes(self):
+        self.output.write(b"abc")
+        self.output.close()
+        assert_equals(self.writer.calls, [[b"abc"], None])
+
+    def test_cut_through_holds_other_writes(self):
+        self.output.begin_cut_through()
+        self.output.write_cut_through(b"head")
+        self.output.write(b"chat")
+        self.output.write_cut_through(b"tail")
+        self.output.end_cut_through()
+        self.output.flush()
+        assert_equals(self.writer.calls, [[b"head", b"tail", b"chat"]])
+
+
+class TestCutThrough:
+    def setup(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.writer = FakeWriter()
+        self.output = OutputScheduler(self.writer)
+
+    def teardown(self):
+        self.loop.close()
+
+    def reader(self, data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def sent(self):
+        self.output.flush()
+        return b"".join(b"".join(call) for call in self.writer.calls)
+
+    def test_frame_is_passed_on_in_chunks(self):
+        reader = self.reader(b"x" * 1000)
+        self.loop.run_until_complete(
+            cut_through(reader, self.output, 900, b"hd", chunk_size=100))
+        assert_equals(self.sent(), b"hd" + b"x" * 900)
+        assert_true(len(self.writer.calls[0]) > 1)
+
+    def test_short_frame(self):
+        reader = self.reader(b"x" * 10)
+        with assert_raises(asyncio.IncompleteReadError):
+            self.loop.run_until_complete(
+                cut_through(reader, self.output, 20))
+
+    def test_read_frame_offers_cut_through(self):
+        frame = b"\x07\x10" + b"y" * 8
+        reader = self.reader(frame + frame)
+        offered = []
+
+        @asyncio.coroutine
+        def offer(packet_type, packet_size, head, remaining):
+            offered.append((packet_type, packet_size, head, remaining))
+            if len(offered) > 1:
+                return False
+            yield from cut_through(reader, self.output, remaining, head)
+            return True
+
+        first = self.loop.run_until_complete(read_frame(reader, offer))
+        second = self.loop.run_until_complete(read_frame(reader, offer))
+        assert_is_none(first)
+        assert_equals(second, (7, 8, frame, 2))
+        assert_equals(self.sent(), frame)
+
+    def test_read_frame_waits_for_data_once(self):
+        frame = b"\x07\x10" + b"y" * 8
+        reader = asyncio.StreamReader()
+        reads = []
+        readexactly = reader.readexactly
+
+        def counting_readexactly(n):
+            reads.append(n)
+            return readexactly(n)
+
+        reader.readexactly = counting_readexactly
+        pending = self.loop.create_task(read_frame(reader))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        reader.feed_data(frame)
+        assert_equals(self.loop.run_until_complete(pending),
+                      (7, 8, frame, 2))
+        assert_equals(reads, [len(frame)])
+
+    def test_read_frame_with_split_header(self):
+        frame = b"\x07\x83\x10" + b"z" * 200
+        reader = asyncio.StreamReader()
+        pending = self.loop.create_task(read_frame(reader))
+        self.loop.run_until_complete(asyncio.sleep(0))
+        reader.feed_data(frame[:2])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        reader.feed_data(frame[2:])
+        assert_equals(self.loop.run_until_complete(pending),
+                      (7, 200, frame, 3))
@@ -0,0 +1,200 @@
+"""
+StarryPy Upstream Pool
+
+Keeps a few connections to the upstream Starbound server open ahead of time,
+so that a player logging in gets one straight away instead of waiting for a
+new connection to be made. The pool grows and shrinks with the rate at which
+players have been connecting lately.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger("starrypy.upstream_pool")
+
+
+def _buffered(reader):
+    """
+    Count the bytes a pooled reader has received but not handed out yet.
+    FrameProtocol keeps its own count; asyncio's StreamReader has no public
+    way to ask, so look at its buffer directly.
+
+    :param reader: FrameProtocol or StreamReader.
+    :return: Integer.
+    """
+    if hasattr(reader, "buffered"):
+        return reader.buffered()
+    return len(reader._buffer)
+
+
+class UpstreamPool:
+    """
+    Pool of idle upstream connections.
+
+    `opener` is a coroutine function that opens a new upstream connection
+    and returns a (reader, writer) pair. Connections are handed out at most
+    once, and dropped when they have sat idle for `idle_timeout` seconds, or
+    when the upstream server has closed them in the meantime.
+    """
+    def __init__(self, opener, max_size, *, min_size=1, idle_timeout=30,
+                 window=10, check_interval=1):
+        self._opener = opener
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.idle_timeout = idle_timeout
+        self.window = window
+        self.check_interval = check_interval
+        self._idle = collections.deque()
+        self._taken = collections.deque()
+        self._opening = 0
+        self._maintainer = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.discarded = 0
+        self.failures = 0
+
+    @property
+    def size(self):
+        """
+        Number of idle connections ready to be handed out.
+        """
+        return len(self._idle)
+
+    @property
+    def target(self):
+        """
+        Number of idle connections to keep around: as many as were handed
+        out over the last `window` seconds, within the pool's limits.
+        """
+        self._forget_taken(time.monotonic())
+        return max(self.min_size, min(self.max_size, len(self._taken)))
+
+    def stats(self):
+        """
+        Snapshot of the pool's counters.
+
+        :return: Dictionary.
+        """
+        return {"size": self.size,
+                "target": self.target,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "discarded": self.discarded,
+                "failures": self.failures}
+
+    def start(self):
+        """
+        Fill the pool, and start looking after it.
+
+        :return: Null.
+        """
+        self._maintainer = asyncio.ensure_future(self._maintain())
+        self._refill()
+
+    def close(self):
+        """
+        Stop looking after the pool, and close every idle connection.
+
+        :return: Null.
+        """
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+            self._maintainer = None
+        while self._idle:
+            self._discard(self._idle.popleft())
+
+    @asyncio.coroutine
+    def acquire(self):
+        """
+        Hand out an upstream connection, from the pool when there is a
+        usable one, or else a newly opened one.
+
+        :return: Tuple. Reader and writer for the upstream connection.
+        """
+        now = time.monotonic()
+        self._taken.append(now)
+        while self._idle:
+            entry = self._idle.popleft()
+            if self._usable(entry, now):
+                self.hits += 1
+                self._refill()
+                return entry[0], entry[1]
+            self._discard(entry)
+        self.misses += 1
+        self._refill()
+        return (yield from self._opener())
+
+    # Internals
+
+    def _usable(self, entry, now):
+        """
+        Check a pooled connection is still worth handing out. Starbound does
+        not send anything until the client has spoken, so a connection that
+        has seen data or an EOF while idle has been dropped by the server.
+        """
+        reader, writer, opened = entry
+        if now - opened >= self.idle_timeout:
+            self.expired += 1
+            return False
+        if writer.transport.is_closing() or reader.at_eof() or \
+                _buffered(reader):
+            self.discarded += 1
+            return False
+        return True
+
+    def _discard(self, entry):
+        entry[1].close()
+
+    def _forget_taken(self, now):
+        while self._taken and now - self._taken[0] > self.window:
+            self._taken.popleft()
+
+    def _refill(self):
+        missing = self.target - len(self._idle) - self._opening
+        for _ in range(missing):
+            self._opening += 1
+            asyncio.ensure_future(self._open())
+
+    @asyncio.coroutine
+    def _open(self):
+        try:
+            reader, writer = yield from self._opener()
+        except (OSError, asyncio.TimeoutError) as err:
+            # Includes ConnectionError; the upstream server is down or busy.
+            self.failures += 1
+            logger.debug("Could not open pooled upstream connection: "
+                         "{}".format(err))
+            return
+        except Exception:
+            # Nothing waits on this task, so report the error here rather
+            # than leaving it unretrieved.
+            self.failures += 1
+            logger.exception("Error while opening pooled upstream "
+                             "connection.")
+            return
+        finally:
+            self._opening -= 1
+        if self._maintainer is None:
+            # The pool was closed while this connection was being opened.
+            writer.close()
+            return
+        self._idle.append((reader, writer, time.monotonic()))
+
+    @asyncio.coroutine
+    def _maintain(self):
+        while True:
+            yield from asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            for entry in list(self._idle):
+                if not self._usable(entry, now):
+                    self._idle.remove(entry)
+                    self._discard(entry)
+            # Let go of the oldest connections once fewer players are
+            # connecting than there are connections waiting for them.
+            while len(self._idle) > self.target:
+                self._discard(self._idle.popleft())
+            self._refill()
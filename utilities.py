@@ -128,6 +128,13 @@ class EntitySpawnType(IntEnum):
     PLAYER = 9
 
 
+class ParsePolicy(IntEnum):
+    NEVER = 0
+    LAZY = 1
+    EAGER = 2
+    OFFLOAD = 3
+
+
 # Useful things
 
 def recursive_dictionary_update(d, u):
@@ -224,6 +231,65 @@ class BiDict(dict):
         super().__delitem__(key)
 
 
+class Packet(dict):
+    """
+    A packet as read off of the wire. Behaves like a normal dictionary, except
+    that a compressed payload is only inflated the first time 'data' is
+    looked up. The inflated payload is then kept on the packet, so it is only
+    ever decompressed once; if it turns out to be corrupt, the lookup raises
+    IncompleteReadError, which drops the connection. Likewise, a packet can be given a parser to run
+    the first time 'parsed' is looked up, rather than being parsed up front.
+    """
+    __slots__ = ("_compressed_data", "_parser")
+
+    def __init__(self, *args, compressed_data=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compressed_data = compressed_data
+        self._parser = None
+
+    def __missing__(self, key):
+        if key == "parsed" and self._parser is not None:
+            # Only let go of the parser once it has succeeded.
+            parsed = self["parsed"] = self._parser(self)
+            self._parser = None
+            return parsed
+        if key != "data" or self._compressed_data is None:
+            raise KeyError(key)
+        try:
+            zobj = zlib.decompressobj()
+            data = zobj.decompress(self._compressed_data)
+        except zlib.error as err:
+            # A corrupt payload ends the connection, as it always has.
+            raise asyncio.IncompleteReadError(b"", None) from err
+        self["data"] = data
+        self._compressed_data = None
+        return data
+
+    def __contains__(self, key):
+        if key == "data" and self._compressed_data is not None:
+            return True
+        if key == "parsed" and self._parser is not None:
+            return True
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def parse_later(self, parser):
+        """
+        Put off parsing the packet until its parsed form is looked up.
+
+        :param parser: Callable taking the packet, and returning its parsed
+                       form.
+        :return: Null.
+        """
+        self.pop("parsed", None)
+        self._parser = parser
+
+
 class AsyncBytesIO(io.BytesIO):
     """
     This class just wraps a normal BytesIO.read() in a coroutine to make it
@@ -243,18 +309,18 @@ def read_vlq(bytestream):
     We have to do this as a stream, since we don't know how long a VLQ is
     until we observe its end.
     """
-    d = b""
+    d = bytearray()
     v = 0
     while True:
         tmp = yield from bytestream.readexactly(1)
-        d += tmp
-        tmp = ord(tmp)
+        tmp = tmp[0]
+        d.append(tmp)
         v <<= 7
         v |= tmp & 0x7f
 
         if tmp & 0x80 == 0:
             break
-    return v, d
+    return v, bytes(d)
 
 
 @asyncio.coroutine
@@ -269,6 +335,38 @@ def read_signed_vlq(reader):
         return -((v >> 1) + 1), d
 
 
+def decode_frame_header(buf, offset=0):
+    """
+    Decode a frame header (packet type and signed VLQ size) directly out of
+    a buffer of bytes that have already arrived, without consuming anything.
+
+    :param buf: Bytes-like object holding the start of a frame.
+    :param offset: Position in the buffer where the frame begins.
+    :return: Tuple of packet type, signed packet size (negative when
+             compressed) and header length; or None if the buffer does not
+             yet hold a complete header.
+    """
+    end = len(buf)
+    if offset >= end:
+        return None
+    packet_type = buf[offset]
+    i = offset + 1
+    v = 0
+    while True:
+        if i >= end:
+            return None
+        tmp = buf[i]
+        i += 1
+        v = (v << 7) | (tmp & 0x7f)
+        if tmp & 0x80 == 0:
+            break
+    if (v & 1) == 0x00:
+        v >>= 1
+    else:
+        v = -((v >> 1) + 1)
+    return packet_type, v, i - offset
+
+
 def extractor(*args):
     """
     Extracts quoted arguments and puts them as a single argument in the
@@ -282,6 +380,117 @@ def extractor(*args):
     return [x for x in filter(None, x)]
 
 
+@asyncio.coroutine
+def read_frame(reader, cut_through=None):
+    """
+    Read the next frame off of the wire without interpreting its contents.
+    Only the header (packet type and signed VLQ size) is decoded, which is
+    enough to decide whether anything further needs to happen with it.
+
+    The header is decoded straight out of the reader's buffer, so the whole
+    frame is pulled in with a single read. When nothing has arrived yet (as
+    after the connection has been idle), we wait for data once and look
+    again, since the header almost always arrives in one piece. Only when
+    the header itself is split across reads do we fall back to reading it a
+    byte at a time.
+
+    :param reader: Stream from which to read the frame.
+    :param cut_through: Optional coroutine function, offered every frame
+                        once its header is known. It is given the packet
+                        type, signed packet size, the part of the frame
+                        already read off the wire, and the number of bytes
+                        of the frame left to read. If it returns True, it
+                        has taken care of the rest of the frame.
+    :return: Tuple. Packet type, signed packet size (negative when
+             compressed), the raw frame bytes, and the length of the header
+             at the start of the frame. None if the frame was cut through.
+    """
+    buffer = getattr(reader, "_buffer", b"")
+    header = decode_frame_header(buffer)
+    if header is None and not buffer and hasattr(reader, "_wait_for_data") \
+            and not reader.at_eof():
+        yield from reader._wait_for_data("read_frame")
+        header = decode_frame_header(buffer)
+    if header is not None:
+        packet_type, packet_size, header_length = header
+        if cut_through is not None and (yield from cut_through(
+                packet_type, packet_size, b"",
+                header_length + abs(packet_size))):
+            return None
+        frame = yield from reader.readexactly(header_length +
+                                              abs(packet_size))
+        return packet_type, packet_size, frame, header_length
+
+    packet_type = (yield from reader.readexactly(1))
+    packet_size, packet_size_data = yield from read_signed_vlq(reader)
+    if cut_through is not None and (yield from cut_through(
+            ord(packet_type), packet_size, packet_type + packet_size_data,
+            abs(packet_size))):
+        return None
+    data = yield from reader.readexactly(abs(packet_size))
+    header_length = 1 + len(packet_size_data)
+    return (ord(packet_type), packet_size,
+            packet_type + packet_size_data + data, header_length)
+
+
+@asyncio.coroutine
+def cut_through(reader, output, size, head=b"", chunk_size=65536):
+    """
+    Pass a frame from one side of the connection to the other as it
+    arrives, rather than waiting for all of it first. Only as much of the
+    frame as one chunk is held in memory at a time.
+
+    :param reader: Stream from which to read the frame.
+    :param output: OutputScheduler for the other side of the connection.
+    :param size: Number of bytes of the frame left to read.
+    :param head: Part of the frame already read off the wire.
+    :param chunk_size: Largest piece of the frame to read at a time.
+    :return: Null.
+    """
+    output.begin_cut_through()
+    try:
+        if head:
+            output.write_cut_through(head)
+        remaining = size
+        while remaining:
+            chunk = yield from reader.read(min(remaining, chunk_size))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(chunk)
+            output.write_cut_through(chunk)
+            yield from output.drain()
+    finally:
+        output.end_cut_through()
+
+
+def make_packet(packet_type, packet_size, frame, header_length, direction):
+    """
+    Turn a raw frame (as returned by read_frame) into a packet object for
+    further processing down the line.
+
+    :param packet_type: Integer ID of the packet.
+    :param packet_size: Signed size of the frame; negative when compressed.
+    :param frame: Raw bytes of the whole frame, header included.
+    :param header_length: Length of the header at the start of the frame.
+    :param direction: Destination for the packet (SERVER or CLIENT).
+    :return: Packet. Contains both raw and decoded versions of the packet.
+    """
+    compressed = packet_size < 0
+    if not compressed:
+        p = Packet(data=frame[header_length:])
+    else:
+        # Decompression is deferred until someone actually looks at 'data'.
+        p = Packet(compressed_data=memoryview(frame)[header_length:])
+
+    p['type'] = packet_type
+    p['size'] = abs(packet_size)
+    p['compressed'] = compressed
+    p['original_data'] = frame
+    p['direction'] = direction
+
+    return p
+
+
 @asyncio.coroutine
 def read_packet(reader, direction):
     """
@@ -294,32 +503,124 @@ def read_packet(reader, direction):
     :param direction: Destination for the packet (SERVER or CLIENT).
     :return: Dictionary. Contains both raw and decoded versions of the packet.
     """
-    p = {}
-    compressed = False
+    frame = yield from read_frame(reader)
+    return make_packet(*frame, direction=direction)
 
-    packet_type = (yield from reader.readexactly(1))
-    packet_size, packet_size_data = yield from read_signed_vlq(reader)
-    if packet_size < 0:
-        packet_size = abs(packet_size)
-        compressed = True
 
-    data = yield from reader.readexactly(packet_size)
-    p['type'] = ord(packet_type)
-    p['size'] = packet_size
-    p['compressed'] = compressed
-    if not compressed:
-        p['data'] = data
-    else:
-        try:
-            zobj = zlib.decompressobj()
-            p['data'] = zobj.decompress(data)
-        except zlib.error as e:
-            raise asyncio.IncompleteReadError
+class OutputScheduler:
+    """
+    Coalesces writes going out to one side of a connection. Data handed to
+    write() is collected and flushed to the underlying writer in a single
+    batch once the event loop gets around to it, rather than being sent out
+    packet by packet. drain() only waits on the writer once the amount of
+    unsent data has crossed the high watermark, so callers are not stalled
+    while there is still plenty of room in the socket buffer.
+
+    While a frame is being cut through (sent on piece by piece as it
+    arrives), anything else written is held back until the frame is
+    complete, so that nothing ends up in the middle of it.
+    """
+    def __init__(self, writer, high_water=65536, low_water=16384):
+        self._writer = writer
+        self._loop = asyncio.get_event_loop()
+        self._pending = []
+        self._pending_size = 0
+        self._flush_handle = None
+        self._held = None
+        self.high_water = high_water
+        self._transport = getattr(writer, "transport", None)
+        if self._transport is not None:
+            self._transport.set_write_buffer_limits(high=high_water,
+                                                    low=low_water)
+
+    def write(self, data):
+        """
+        Queue data to be sent out with the next flush.
 
-    p['original_data'] = packet_type + packet_size_data + data
-    p['direction'] = direction
+        :param data: Bytes-like object to send.
+        :return: Null.
+        """
+        if self._held is not None:
+            self._held.append(data)
+            return
+        self._queue(data)
 
-    return p
+    def begin_cut_through(self):
+        """
+        Start sending a frame piece by piece; until end_cut_through() is
+        called, only write_cut_through() gets data out.
+
+        :return: Null.
+        """
+        self._held = []
+
+    def write_cut_through(self, data):
+        """
+        Queue the next piece of the frame being cut through.
+
+        :param data: Bytes-like object to send.
+        :return: Null.
+        """
+        self._queue(data)
+
+    def end_cut_through(self):
+        """
+        Finish the frame being cut through, and let anything written in the
+        meantime go out after it.
+
+        :return: Null.
+        """
+        held, self._held = self._held, None
+        for data in held or ():
+            self._queue(data)
+
+    def _queue(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self.flush)
+
+    def flush(self):
+        """
+        Hand everything queued so far to the writer in one go.
+
+        :return: Null.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        if len(self._pending) == 1:
+            self._writer.write(self._pending[0])
+        else:
+            self._writer.writelines(self._pending)
+        self._pending = []
+        self._pending_size = 0
+
+    @asyncio.coroutine
+    def drain(self):
+        """
+        Apply backpressure, but only once the high watermark is crossed by
+        the data queued here plus whatever the transport has yet to send.
+
+        :return: Null.
+        """
+        unsent = self._pending_size
+        if self._transport is not None:
+            unsent += self._transport.get_write_buffer_size()
+        if unsent >= self.high_water:
+            self.flush()
+            yield from self._writer.drain()
+
+    def close(self):
+        """
+        Flush anything still queued, then close the writer.
+
+        :return: Null.
+        """
+        self.flush()
+        self._writer.close()
 
 
 def get_syntax(command, fn, command_prefix):
@@ -421,6 +722,75 @@ class Command:
         return wrapped
 
 
+def reads(*fields):
+    """
+    Defines a decorator for packet hooks, declaring which fields of the
+    parsed packet the hook looks at. Packets are then only parsed as far as
+    the hooks on them need; a hook declaring no fields at all (one that only
+    looks at the packet's direction, say) doesn't need the packet parsed.
+    Hooks without a declaration get every field.
+
+    :param fields: Names of the fields in data['parsed'] the hook reads.
+    :return: The decorator.
+    """
+    def decorator(f):
+        f.reads = frozenset(fields)
+        return f
+    return decorator
+
+
+def directions(*directions):
+    """
+    Defines a decorator for packet hooks, limiting the hook to packets
+    flowing in the given directions. Packets flowing the other way are
+    neither passed to the hook, nor parsed for it. Hooks without a
+    declaration see packets flowing either way.
+
+    :param directions: Directions (Direction.TO_CLIENT, Direction.TO_SERVER)
+                       of the packets the hook wants.
+    :return: The decorator.
+    """
+    def decorator(f):
+        f.directions = frozenset(directions)
+        return f
+    return decorator
+
+
+def priority(value):
+    """
+    Defines a decorator for packet hooks, setting the order they are called
+    in. Hooks with a higher priority are called first; hooks that don't set
+    one have a priority of 0. Hooks with the same priority are called in
+    dependency order.
+
+    :param value: Number. Priority of the hook.
+    :return: The decorator.
+    """
+    def decorator(f):
+        f.priority = value
+        return f
+    return decorator
+
+
+def observer(dropped=False):
+    """
+    Defines a decorator for packet hooks that only watch packets go by,
+    rather than deciding whether they are sent on. Observers are called
+    after every other hook on the packet, and what they return is ignored.
+    Once a hook drops a packet, no more hooks are called on it, except for
+    observers that ask to see dropped packets too.
+
+    :param dropped: Boolean. Whether the hook sees packets that have been
+                    dropped.
+    :return: The decorator.
+    """
+    def decorator(f):
+        f.observer = True
+        f.sees_dropped = dropped
+        return f
+    return decorator
+
+
 class StorageMixin:
     """
     Convenience class for adding access to a player's server-based storage.